@@ -1,4 +1,5 @@
 """Utility functions for chplenv modules"""
+import codecs
 import os
 import subprocess
 import sys
@@ -73,19 +74,52 @@ def run_command(command, stdout=True, stderr=False, cmd_input=None):
         return None
 
 
-def run_live_command(command):
+def run_live_command(command, lines=False, tee=None):
     """Run a command, yielding the merged output (stdout/stderr) as the process
-       runs rather than returning the output after the process finishes"""
+       runs rather than returning the output after the process finishes.
+
+       Output is yielded in chunks of whatever the process has written so
+       far, or one line at a time (newline included) if `lines` is set. It is
+       decoded as UTF-8 incrementally, so a character split across reads
+       comes out whole; bytes that aren't valid UTF-8 are replaced.
+
+       If `tee` is given (a file name), the raw output is also written there
+       as it arrives."""
     try:
         process = subprocess.Popen(command,
                                    stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
+                                   stderr=subprocess.STDOUT,
+                                   bufsize=0)
     except OSError:
         error("command not found: {0}".format(command[0]), OSError)
 
-    for stdout_char in iter(lambda: process.stdout.read(1), str.encode("", "utf-8")):
-        yield stdout_char.decode("utf-8")
-    process.stdout.close()
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    tee_file = open(tee, "wb") if tee else None
+    partial = ""
+    try:
+        fd = process.stdout.fileno()
+        while True:
+            # returns as soon as anything is available, up to the chunk size
+            data = os.read(fd, 64 * 1024)
+            if tee_file:
+                tee_file.write(data)
+            text = decoder.decode(data, final=not data)
+            if lines:
+                text = partial + text
+                end = text.rfind("\n") + 1
+                partial = text[end:]
+                for line in text[:end].split("\n")[:-1]:
+                    yield line + "\n"
+            elif text:
+                yield text
+            if not data:
+                break
+        if partial:
+            yield partial
+    finally:
+        if tee_file:
+            tee_file.close()
+        process.stdout.close()
     returncode = process.wait()
 
     if returncode != 0:
@@ -0,0 +1,179 @@
+"""
+Content-addressed cache of compiled test executables, used by sub_test when
+$CHPL_TEST_BUILD_CACHE_DIR is set (start_test --build-cache-dir).
+
+A compile is identified by:
+
+  - the toolchain (compiler binaries, modules, runtime and third-party
+    builds; see result_cache.toolchain_key()),
+  - the chplenv snapshot and relevant environment (which pins down the
+    runtime subdirectory the program links against) plus the test's
+    compile-time environment,
+  - the compiler command line, with the output name factored out,
+  - the source closure: the source files (.chpl, .h, .c, .o, .so, ...) in
+    the test's directory and its subdirectories, any files or directories
+    named on the command line, the source files in the directories named by
+    -M/-I/-L/--module-dir (as `-M dir` or `-Mdir`, also inside
+    --ccflags/--ldflags) and on $CHPL_MODULE_PATH, and stdin.
+
+Instead of a module list from the compiler (which would cost most of a
+compile), every source file in those places is taken as one of the test's
+sources; modules from CHPL_HOME are covered by the toolchain key. Files of
+other kinds outside the test's directory aren't covered.
+
+Only successful compiles whose sole products are the executable (and its
+_real, for launchers) are stored. On a hit the executables are hard linked
+into place (copied if that isn't possible) and the recorded compiler output
+is reused. Entries are read-only so that writing through a link fails rather
+than corrupting the cache.
+
+The cache is trimmed to $CHPL_TEST_BUILD_CACHE_SIZE megabytes (default 10240)
+by evicting the least recently used entries; start_test does this once per
+run, so the cache can temporarily grow past the limit by one run's builds.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+import result_cache
+
+_meta_name = 'meta.json'
+_default_size_mb = 10240
+
+
+def compile_key(base_key, cmd, args, execname, env, stdin_path):
+    """Fingerprint of one compile.
+
+    `base_key` covers the toolchain and environment; `env` is the test's
+    compile environment additions.
+    """
+    h = hashlib.sha1()
+    h.update(base_key.encode('utf-8'))
+    h.update(cmd.encode('utf-8'))
+    for arg in args:
+        if arg == execname:
+            arg = '<exec>'
+        h.update(b'\0' + arg.encode('utf-8'))
+        if arg != '<exec>' and os.path.isfile(arg):
+            result_cache.hash_file(h, arg)
+        elif arg != '<exec>' and os.path.isdir(arg):
+            result_cache.hash_tree(h, arg)
+    for var, val in sorted(env.items()):
+        h.update('\0{0}={1}'.format(var, val).encode('utf-8'))
+
+    result_cache.hash_tree(h, '.')
+    environ = dict(os.environ)
+    environ.update(env)
+    for path in result_cache.search_paths(cmd.split() + list(args), environ):
+        result_cache.hash_tree(h, path)
+    if stdin_path and stdin_path != '/dev/null':
+        result_cache.hash_file(h, stdin_path)
+    return h.hexdigest()
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _place(src, dst):
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def fetch(cache_dir, key, execname):
+    """Put the cached executables for `key` in place as `execname`.
+
+    Returns the recorded compiler output, or None on a miss.
+    """
+    entry = _entry_dir(cache_dir, key)
+    meta_path = os.path.join(entry, _meta_name)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        for name, suffix in (('exec', ''), ('exec_real', '_real')):
+            if name in meta['files']:
+                _place(os.path.join(entry, name), execname + suffix)
+        # mark the entry as recently used for eviction
+        os.utime(meta_path, None)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return meta['output']
+
+
+def store(cache_dir, key, execname, output):
+    """Record a successful compile of `execname`. Errors are ignored."""
+    entry = _entry_dir(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    try:
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp_entry = tempfile.mkdtemp(prefix='.entry-', dir=parent)
+        files = []
+        for name, suffix in (('exec', ''), ('exec_real', '_real')):
+            if os.path.isfile(execname + suffix):
+                dst = os.path.join(tmp_entry, name)
+                shutil.copy2(execname + suffix, dst)
+                mode = os.stat(dst).st_mode
+                os.chmod(dst, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                files.append(name)
+        with open(os.path.join(tmp_entry, _meta_name), 'w') as f:
+            json.dump({'files': files, 'output': output}, f)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # someone else stored it first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+    except (IOError, OSError):
+        pass
+
+
+def max_size():
+    """Cache size limit in bytes."""
+    try:
+        size_mb = int(os.getenv('CHPL_TEST_BUILD_CACHE_SIZE', _default_size_mb))
+    except ValueError:
+        size_mb = _default_size_mb
+    return size_mb * 1024 * 1024
+
+
+def evict(cache_dir, limit=None):
+    """Remove least recently used entries until the cache fits in `limit`
+    bytes. Returns the number of entries removed."""
+    if limit is None:
+        limit = max_size()
+    entries = []
+    total = 0
+    for prefix in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry = os.path.join(prefix_dir, key)
+            try:
+                last_used = os.stat(os.path.join(entry, _meta_name)).st_mtime
+                size = sum(os.stat(os.path.join(entry, f)).st_size
+                           for f in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+            total += size
+
+    removed = 0
+    entries.sort()
+    for last_used, size, entry in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
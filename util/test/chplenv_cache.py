@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Process-wide cache of the chplenv snapshot used by the testing system.
+
+sub_test, start_test and testEnv all need the output of
+`printchplenv --all --simple --no-tidy --internal`. Computing it means a
+Python startup and a full pass over the chplenv scripts, and sub_test used to
+do that for every line of every option file it expanded. Instead, the snapshot
+is computed once and stored on disk, keyed by a hash of everything that can
+change its result: the chplenv-relevant environment variables and the contents
+of the chplconfig file that would be picked up.
+
+The cache directory is $CHPL_TEST_CHPLENV_CACHE_DIR if set, otherwise
+$CHPL_TEST_TMP_DIR (i.e. one snapshot per start_test invocation). If neither
+is set the snapshot is only memoized in-process.
+
+start_test exports the path of the current snapshot as
+$CHPL_TEST_CHPLENV_SNAPSHOT so that non-Python consumers (testEnv) can read it
+directly. Run this script with --invalidate to throw away stale snapshots when
+the environment changes in a way the key can't see (e.g. rebuilt third-party
+packages).
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+
+import harness_trace
+
+# Environment variables outside of CHPL_* that the chplenv scripts consult.
+_extra_env_vars = ('CRAYPE_NETWORK_TARGET', 'CRAY_CC_VERSION',
+                   'CRAY_CPU_TARGET', 'LIBFABRIC_DIR', 'PE_ENV', 'PATH',
+                   'HOME')
+
+# CHPL_* variables owned by the testing system. These change from test to test
+# (or run to run) and don't affect printchplenv, so they're left out of the
+# key to avoid needless recomputation.
+_harness_env_prefixes = ('CHPL_TEST_', 'CHPL_ONETEST', 'CHPL_SYSTEM_',
+                         'CHPL_LAUNCHCMD_', 'CHPL_PRINT_PASSES_FILE',
+                         'CHPL_NO_STDIN_REDIRECT', 'CHPL_COMPONLY')
+
+_snapshot_prefix = 'chplenv-'
+_snapshot_suffix = '.txt'
+
+# In-process memo: key -> snapshot dict
+_memo = {}
+
+
+def _find_chplconfig(environ):
+    """Return the chplconfig file that overrides.py would use, or None."""
+    for path in (environ.get('CHPL_CONFIG'), os.path.expanduser('~'),
+                 environ.get('CHPL_HOME')):
+        if not path:
+            continue
+        for name in ('chplconfig', '.chplconfig'):
+            candidate = os.path.join(path, name)
+            if os.path.isfile(candidate):
+                return candidate
+    return None
+
+
+def snapshot_key(environ=None):
+    """Return a hash of the inputs that determine the chplenv snapshot."""
+    if environ is None:
+        environ = os.environ
+
+    h = hashlib.sha1()
+    for var in sorted(environ):
+        if var.startswith('CHPL_'):
+            if var.startswith(_harness_env_prefixes):
+                continue
+        elif var not in _extra_env_vars:
+            continue
+        h.update('{0}={1}\n'.format(var, environ[var]).encode('utf-8'))
+
+    chplconfig = _find_chplconfig(environ)
+    if chplconfig:
+        h.update(chplconfig.encode('utf-8'))
+        try:
+            with open(chplconfig, 'rb') as f:
+                h.update(f.read())
+        except (IOError, OSError):
+            pass
+
+    return h.hexdigest()
+
+
+def cache_dir(environ=None):
+    """Return the directory snapshots are stored in, or None."""
+    if environ is None:
+        environ = os.environ
+    return (environ.get('CHPL_TEST_CHPLENV_CACHE_DIR') or
+            environ.get('CHPL_TEST_TMP_DIR'))
+
+
+def snapshot_path(key=None, environ=None):
+    """Return the on-disk location of the snapshot for `key`, or None."""
+    directory = cache_dir(environ)
+    if not directory:
+        return None
+    if key is None:
+        key = snapshot_key(environ)
+    return os.path.join(directory, _snapshot_prefix + key + _snapshot_suffix)
+
+
+def parse(text):
+    """Parse `printchplenv --simple` output into a dict."""
+    chpl_env = {}
+    for line in text.splitlines():
+        if line.startswith('export '):
+            line = line[len('export '):]
+        if '=' not in line:
+            continue
+        var, val = line.split('=', 1)
+        chpl_env[var] = val
+    return chpl_env
+
+
+def _default_util_dir():
+    return os.environ.get('CHPL_TEST_UTIL_DIR',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@harness_trace.traced('printchplenv')
+def _run_printchplenv(util_dir):
+    env_cmd = [os.path.join(util_dir, 'printchplenv'), '--all', '--simple',
+               '--no-tidy', '--internal']
+    output = subprocess.Popen(env_cmd, stdout=subprocess.PIPE).communicate()[0]
+    return output.decode('utf-8')
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + _snapshot_prefix, dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def get(util_dir=None, refresh=False):
+    """Return the chplenv snapshot as a dict, computing it at most once per key.
+
+    Looks in the in-process memo first, then on disk, and only runs
+    printchplenv when neither has a snapshot for the current key (or when
+    `refresh` is set).
+    """
+    key = snapshot_key()
+    if not refresh and key in _memo:
+        return dict(_memo[key])
+
+    path = snapshot_path(key)
+    text = None
+    if not refresh and path and os.path.isfile(path):
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+        except (IOError, OSError):
+            text = None
+
+    if text is None:
+        text = _run_printchplenv(util_dir or _default_util_dir())
+        if path:
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                _write_atomically(path, text)
+            except (IOError, OSError):
+                # A read-only or racing cache directory just means we don't
+                # share the snapshot; the in-process memo still works.
+                pass
+
+    _memo[key] = parse(text)
+    return dict(_memo[key])
+
+
+def invalidate(directory=None):
+    """Remove all cached snapshots (in-process and on disk)."""
+    _memo.clear()
+    if directory is None:
+        directory = cache_dir()
+    if not directory or not os.path.isdir(directory):
+        return
+    for f in os.listdir(directory):
+        if f.startswith(_snapshot_prefix) and f.endswith(_snapshot_suffix):
+            try:
+                os.unlink(os.path.join(directory, f))
+            except OSError:
+                pass
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Manage the cached chplenv '
+                                     'snapshot used by the testing system')
+    parser.add_argument('--invalidate', action='store_true',
+                        help='remove cached snapshots')
+    parser.add_argument('--print', action='store_true', dest='print_env',
+                        help='print the (possibly cached) snapshot')
+    parser.add_argument('--path', action='store_true',
+                        help='print the path of the snapshot for this env')
+    args = parser.parse_args(argv)
+
+    if args.invalidate:
+        invalidate()
+    if args.path:
+        print(snapshot_path() or '')
+    if args.print_env:
+        for var, val in sorted(get().items()):
+            print('{0}={1}'.format(var, val))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
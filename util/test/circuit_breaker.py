@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Circuit breakers that stop a test run early.
+
+When a compiler change breaks something fundamental every test fails, often
+only after running into its timeout, and a full run takes as long to say so
+as a good one. A CircuitBreaker watches the results as they come in and
+trips on
+
+  - --stop-after-failures failures,
+  - a failure rate over --max-failure-rate percent in the first
+    --failure-rate-window results (checked as soon as it can't come out
+    under any more, so a broken run stops after a fraction of the window),
+  - any failure in the smoke tests (--smoke-tests), which are run first.
+
+Results are the "[Success matching ..." and "[Error ..." lines of the log,
+the ones the end-of-run summary counts.
+
+Stopping goes through a halt file. start_test stops going into new
+directories when it exists, and sub_test stops before its next test, so a
+run stops within one test of tripping. paratest.server and its work queue
+create PARAHALT in the test directory, which stops the handing out of work
+and makes their start_test workers give up the directory they're in.
+
+Usage (for paratest.server):
+    circuit_breaker.py --state FILE --halt-file FILE [--smoke]
+                       [--stop-after-failures N] [--max-failure-rate PCT]
+                       [--failure-rate-window N] LOG...
+        adds the results in LOGs to the totals kept in the state file, and
+        if that trips a breaker, writes the reason to the halt file and
+        prints it
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+default_rate_window = 100
+
+
+class CircuitBreaker(object):
+    """Running totals of a run's results, and the rules for giving up on it.
+    A limit of 0 turns that rule off."""
+
+    def __init__(self, max_failures=0, max_failure_rate=0,
+                 rate_window=default_rate_window):
+        self.max_failures = max_failures
+        self.max_failure_rate = max_failure_rate
+        self.rate_window = rate_window
+        self.successes = 0
+        self.failures = 0
+        self.reason = None
+
+    def enabled(self):
+        return bool(self.max_failures or self.max_failure_rate)
+
+    def results(self):
+        return self.successes + self.failures
+
+    def add(self, successes, failures):
+        """Add some results; returns the reason to stop, if there is one
+        (now or from before)."""
+        in_window = self.results() < self.rate_window
+        self.successes += successes
+        self.failures += failures
+        if self.reason is not None:
+            return self.reason
+
+        if self.max_failures and self.failures >= self.max_failures:
+            self.reason = '{0} failure(s)'.format(self.failures)
+        elif (self.max_failure_rate and in_window and
+                self.failures * 100.0 >
+                self.max_failure_rate * self.rate_window):
+            self.reason = ('{0} failures in the first {1} results (more than '
+                           '{2:g}%)'.format(self.failures, self.results(),
+                                            self.max_failure_rate))
+        return self.reason
+
+    def update(self, successes, failures):
+        """Like add(), given the totals so far rather than new results."""
+        return self.add(successes - self.successes,
+                        failures - self.failures)
+
+
+def smoke_failed(failures, what):
+    return '{0} failure(s) in the smoke tests ({1})'.format(failures, what)
+
+
+def count_results(logfile):
+    """(successes, failures) in a start_test log, counted the way
+    paratest.server's summary counts them (the log's own summary, which
+    repeats the errors, isn't counted)."""
+    successes = failures = 0
+    try:
+        with open(logfile, 'rb') as f:
+            for line in f:
+                if line.startswith(b'[Test Summary'):
+                    break
+                if line.startswith(b'[Error'):
+                    failures += 1
+                elif line.startswith(b'[Success matching'):
+                    successes += 1
+    except (IOError, OSError):
+        pass
+    return successes, failures
+
+
+def halt(halt_file, reason):
+    """Create the halt file, saying why."""
+    try:
+        with open(halt_file, 'w') as f:
+            f.write('Stopped early: {0}\n'.format(reason))
+    except (IOError, OSError) as e:
+        sys.stderr.write('[Warning: could not create {0}: {1}]\n'.format(
+            halt_file, e.strerror))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Add the results in start_test logs to a running total '
+                    'and create the halt file if that trips a breaker.')
+    parser.add_argument('--stop-after-failures', type=int, default=0,
+                        metavar='N')
+    parser.add_argument('--max-failure-rate', type=float, default=0,
+                        metavar='PCT')
+    parser.add_argument('--failure-rate-window', type=int,
+                        default=default_rate_window, metavar='N')
+    parser.add_argument('--state', required=True,
+                        help='file holding the totals between calls')
+    parser.add_argument('--halt-file', required=True)
+    parser.add_argument('--smoke', action='store_true',
+                        help='the logs are from smoke tests: stop on any '
+                             'failure')
+    parser.add_argument('logs', nargs='+')
+    args = parser.parse_args(argv)
+
+    breaker = CircuitBreaker(args.stop_after_failures, args.max_failure_rate,
+                             args.failure_rate_window)
+    try:
+        with open(args.state, 'r') as f:
+            state = json.load(f)
+        breaker.successes = state['successes']
+        breaker.failures = state['failures']
+        breaker.reason = state['reason']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    tripped = breaker.reason is not None
+    for log in args.logs:
+        successes, failures = count_results(log)
+        breaker.add(successes, failures)
+        if args.smoke and failures and breaker.reason is None:
+            breaker.reason = smoke_failed(failures, log)
+
+    with open(args.state, 'w') as f:
+        json.dump({'successes': breaker.successes,
+                   'failures': breaker.failures,
+                   'reason': breaker.reason}, f)
+
+    if breaker.reason is not None and not tripped:
+        halt(args.halt_file, breaker.reason)
+        print('[Stopping early: {0}]'.format(breaker.reason))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
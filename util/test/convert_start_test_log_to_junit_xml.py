@@ -5,8 +5,8 @@
 
 from __future__ import print_function, unicode_literals
 
-import codecs
 import getpass
+import io
 import logging
 import optparse
 import os.path
@@ -20,6 +20,8 @@ sys.path.insert(0, os.path.abspath(chplenv_dir))
 
 import chpl_platform
 
+import result_index
+
 
 DEBUG = False
 
@@ -35,152 +37,230 @@ def main():
     if args.debug:
         DEBUG = True
 
-    test_cases = _parse_start_test_log(args.start_test_log)
-    _remove_prefixes(test_cases, args.remove_prefix)
+    test_cases = _read_result_index(args.start_test_log)
+    if test_cases is None:
+        test_cases = _parse_start_test_log(args.start_test_log)
+    test_cases = _remove_prefixes(test_cases, args.remove_prefix)
     _create_junit_report(test_cases, args.junit_xml)
 
 
 def _create_junit_report(test_cases, junit_file):
-    """Create jUnit XML report from test info.
+    """Create jUnit XML report from test info. Test cases are written out as
+    they come, so the report is never held in memory as a whole.
 
-    :type test_cases: list of dicts
-    :arg test_cases: list of dicts; each dict contains info about a single test case
+    :type test_cases: iterable of dicts
+    :arg test_cases: dicts that each contain info about a single test case
 
     :type junit_file: str
     :arg junit_file: filename to write the jUnit XML report
     """
     logging.debug('Creating jUnit XML report at: {0}'.format(junit_file))
-    test_suite = XML.Element('testsuite')
+    encoding = "unicode" if sys.version_info[0] >= 3 else "us-ascii"
 
-    for test_case in test_cases:
-        case_elem = XML.SubElement(test_suite, 'testcase')
-        case_elem.set('name', test_case['name'])
-        case_elem.set('classname', test_case['classname'])
-        case_elem.set('time', str(test_case['time']))
+    num_cases = 0
+    with open(junit_file, 'w') as fp:
+        for test_case in test_cases:
+            if num_cases == 0:
+                fp.write('<testsuite>')
+            num_cases += 1
 
-        test_error = test_case['error']
+            case_elem = XML.Element('testcase')
+            case_elem.set('name', test_case['name'])
+            case_elem.set('classname', test_case['classname'])
+            case_elem.set('time', str(test_case['time']))
 
-        if test_case['skipped']:
-            skip_elem = XML.SubElement(case_elem, 'skipped')
-        elif test_error is not None:
-            error_elem = XML.SubElement(case_elem, 'error')
-            error_elem.set('message', test_error['message'])
-            error_elem.text = test_error['content']
+            test_error = test_case['error']
 
-        system_out = XML.SubElement(case_elem, 'system-out')
-        system_out.text = test_case['system-out']
+            if test_case['skipped']:
+                skip_elem = XML.SubElement(case_elem, 'skipped')
+            elif test_error is not None:
+                error_elem = XML.SubElement(case_elem, 'error')
+                error_elem.set('message', test_error['message'])
+                error_elem.text = test_error['content']
 
-    encoding = "unicode" if sys.version_info[0] >= 3 else "us-ascii"
-    xml_content = XML.tostring(test_suite, encoding=encoding)
-    xml_content = _clean_xml(xml_content)
-    with open(junit_file, 'w') as fp:
-        fp.write(xml_content)
+            system_out = XML.SubElement(case_elem, 'system-out')
+            system_out.text = test_case['system-out']
+
+            fp.write(_clean_xml(XML.tostring(case_elem, encoding=encoding)))
+
+        fp.write('</testsuite>' if num_cases else '<testsuite />')
     logging.info('Wrote jUnit report to: {0}'.format(junit_file))
 
 
+def _read_result_index(start_test_log):
+    """Return test cases from the result index start_test wrote alongside the
+    log, if there is a complete one for this log, so the log doesn't have to
+    be parsed. The index is checked here; the output of each test is read
+    from the log at the offsets the index gives as the test cases are
+    consumed.
+
+    :type start_test_log: str
+    :arg start_test_log: start_test log filename
+
+    :rtype: iterator of dicts
+    :returns: dicts like _parse_start_test_log() yields, or None if there is
+              no usable index
+    """
+    records = result_index.read(result_index.index_path(start_test_log))
+    if records is None:
+        return None
+    end = records[-1]
+
+    with open(start_test_log, 'rb') as fp:
+        # make sure the index is for this log (and not, e.g., a log that was
+        # merged from several)
+        first_line = fp.readline().decode('utf-8', 'ignore').rstrip('\r\n')
+        if (first_line != end['first_line'] or
+                os.fstat(fp.fileno()).st_size < end['log_size']):
+            return None
+    logging.debug('Reading result index for: {0}'.format(start_test_log))
+    return _index_test_cases(start_test_log, records)
+
+
+def _index_test_cases(start_test_log, records):
+    """Yield the test cases of a checked result index (see
+    _read_result_index()), one at a time.
+    """
+    num_cases = 0
+    with open(start_test_log, 'rb') as fp:
+        for record in records:
+            if record['type'] != 'test':
+                continue
+            fp.seek(record['start'])
+            content = fp.read(record['end'] - record['start'])
+            classname, test_name = _split_test_name(record['test'])
+            num_cases += 1
+            yield {
+                'name': test_name,
+                'classname': classname,
+                'time': record['time'],
+                'error': _test_error(record['errors'], record['warnings']),
+                'skipped': record['skipped'],
+                'system-out': content.decode('utf-8', 'ignore'),
+            }
+
+    logging.info('Read {0} test cases from the index for "{1}".'.format(
+        num_cases, start_test_log))
+
+
+def _read_lines(start_test_log):
+    """Yield the lines of the start_test log, split the way
+    str.splitlines(True) splits (which is how the log has always been read).
+    """
+    with open(start_test_log, 'rb') as raw:
+        fp = io.TextIOWrapper(raw, encoding='utf-8', errors='ignore',
+                              newline='')
+        for line in fp:
+            parts = line.splitlines(True)
+            if len(parts) == 1:
+                yield line
+            else:
+                for part in parts:
+                    yield part
+
+
 def _parse_start_test_log(start_test_log):
-    """Parse start_test logfile and return results in python data structure.
+    """Parse start_test logfile, yielding results in python data structures
+    as they are read.
+
+    The log is read once, line by line. Test cases are only looked for
+    between "[Starting subtest - " and "[Finished subtest " lines. A test case
+    runs from its "[test: " line through the first
+    "[Elapsed time to compile and execute all versions of ..." or "[Skipping"
+    line, or the end of the subtest if neither comes first (usually meaning
+    the subtest failed).
 
     :type start_test_log: str
     :arg start_test_log: start_test log filename
 
-    :rtype: list of dicts
-    :returns: list of dicts; each dict contains info about a single test case
+    :rtype: iterator of dicts
+    :returns: dicts that each contain info about a single test case
     """
     logging.debug('Parsing start_test log: {0}'.format(start_test_log))
-    with codecs.open(start_test_log, 'r', encoding='utf-8', errors='ignore') as fp:
-        start_test_lines = fp.readlines()
-    logging.debug('Read {0} lines from "{1}".'.format(
-        len(start_test_lines), start_test_log))
 
-    test_cases = []
-    while len(start_test_lines) > 0:
-        subtest_start, subtest_end = _get_block(
-            start_test_lines, '[Starting subtest - ', '[Finished subtest ')
-
-        # No more sub_tests; delete the remaining lines and finish up.
-        if subtest_start == -1:
-            del start_test_lines[:]
+    num_lines = 0
+    num_cases = 0
+    in_subtest = False
+    test_case_lines = None
+    for line in _read_lines(start_test_log):
+        num_lines += 1
+        if not in_subtest:
+            in_subtest = line.startswith('[Starting subtest - ')
             continue
 
-        # Copy subtest lines into new list for further processing and delete
-        # them from start_test_lines.
-        sub_test_lines = start_test_lines[subtest_start:subtest_end+1:1]
-        del start_test_lines[:subtest_end+1]
-
-        while len(sub_test_lines) > 0:
-            test_start, test_end = _get_block(
-                sub_test_lines,
-                '[test: ',
-                '[Elapsed time to compile and execute all versions of "')
-            test_start_skip, test_end_skip = _get_block(
-                sub_test_lines,
-                '[test: ',
-                '[Skipping')
+        if test_case_lines is None:
+            if line.startswith('[test: '):
+                test_case_lines = [line]
+            elif line.startswith('[Finished subtest '):
+                in_subtest = False
+            continue
 
+        test_case_lines.append(line)
+        if line.startswith(
+                '[Elapsed time to compile and execute all versions of "'):
             test_skipped = False
-            if test_end_skip != -1 and (test_end == -1 or test_end_skip < test_end):
-                test_start, test_end = test_start_skip, test_end_skip
-                test_skipped = True
-
-                noperf_start, noperf_end = _get_block(
-                    sub_test_lines,
-                    '[test: ',
-                    '[Skipping noperf test:')
-
-                # If the test was skipped because it did not have performance
-                # configuration files, drop the lines and continue. We don't
-                # care about these for performance tests (as opposed to real
-                # perf tests that are skipped due to environment/etc).
-                if noperf_end != -1:
-                    del sub_test_lines[noperf_start:noperf_end+1]
-                    continue
-
-            # If test_end is still -1 (i.e. not found), look for end of subtest
-            # call (usually means subtest failed and did not tests).
-            if test_start != -1 and test_end == -1:
-                test_start, test_end = _get_block(
-                    sub_test_lines,
-                    '[test: ',
-                    '[Finished subtest "')
-                if test_end == -1:
-                    raise ValueError('Failed to parse test case from: {0}'.format(
-                        sub_test_lines))
-
-            # No more test cases; delete remaining lines and finish up.
-            if test_start == -1:
-                del sub_test_lines[:]
+        elif line.startswith('[Skipping'):
+            # If the test was skipped because it did not have performance
+            # configuration files, drop the lines and continue. We don't
+            # care about these for performance tests (as opposed to real
+            # perf tests that are skipped due to environment/etc).
+            if line.startswith('[Skipping noperf test:'):
+                test_case_lines = None
                 continue
+            test_skipped = True
+        elif line.startswith('[Finished subtest '):
+            in_subtest = False
+            if not line.startswith('[Finished subtest "'):
+                raise ValueError('Failed to parse test case from: {0}'.format(
+                    test_case_lines))
+            test_skipped = False
+        else:
+            continue
 
-            # Copy test lines into new list for further processing and delete
-            # from sub_test_lines.
-            test_case_lines = sub_test_lines[test_start:test_end+1:1]
-            del sub_test_lines[:test_end+1]
+        num_cases += 1
+        yield _make_test_case(test_case_lines, test_skipped)
+        test_case_lines = None
 
-            # Extract test name from "[test: <path to .chpl file>]" line.
-            classname, test_name = _get_test_name(test_case_lines)
-            if test_skipped:
-                test_time = 0.0
-                error = None
-            else:
-                test_time = _get_test_time(test_case_lines)
-                error = _get_test_error(test_case_lines)
-            test_content = ''.join(test_case_lines)
+    if test_case_lines is not None:
+        logging.warn('Log ended in the middle of a test case: {0}'.format(
+            test_case_lines[0].strip()))
 
-            test_case = {
-                'name': test_name,
-                'classname': classname,
-                'time': test_time,
-                'error': error,
-                'skipped': test_skipped,
-                'system-out': test_content,
-            }
+    logging.debug('Read {0} lines from "{1}".'.format(
+        num_lines, start_test_log))
+    logging.info('Parsed {0} test cases from "{1}".'.format(
+        num_cases, start_test_log))
 
-            test_cases.append(test_case)
 
-    logging.info('Parsed {0} test cases from "{1}".'.format(
-        len(test_cases), start_test_log))
-    return test_cases
+def _make_test_case(test_case_lines, test_skipped):
+    """Return the test case dict for the lines of one test case.
+
+    :type test_case_lines: list
+    :arg test_case_lines: lines for a single test case from start_test logfile
+
+    :type test_skipped: bool
+    :arg test_skipped: whether the test was skipped
+
+    :rtype: dict
+    :returns: info about the test case
+    """
+    # Extract test name from "[test: <path to .chpl file>]" line.
+    classname, test_name = _get_test_name(test_case_lines)
+    if test_skipped:
+        test_time = 0.0
+        error = None
+    else:
+        test_time = _get_test_time(test_case_lines)
+        error = _get_test_error(test_case_lines)
+    test_content = ''.join(test_case_lines)
+
+    return {
+        'name': test_name,
+        'classname': classname,
+        'time': test_time,
+        'error': error,
+        'skipped': test_skipped,
+        'system-out': test_content,
+    }
 
 
 def _remove_prefixes(test_cases, prefix):
@@ -189,17 +269,21 @@ def _remove_prefixes(test_cases, prefix):
     paths, instead of relative paths, in the logs. If a class name does not
     have the prefix, it is not changed.
 
-    :type test_cases: list of dicts
-    :arg test_cases: list of dicts; each dict contains info about a single test case
+    :type test_cases: iterable of dicts
+    :arg test_cases: dicts that each contain info about a single test case
 
     :type prefix: str
     :arg prefix: prefix to remove from all class names
+
+    :rtype: iterator of dicts
+    :returns: the test cases, updated
     """
     if prefix is None:
+        for test_case in test_cases:
+            yield test_case
         return
 
-    logging.debug('Removing prefix "{0}" from {1} test cases.'.format(
-        prefix, len(test_cases)))
+    logging.debug('Removing prefix "{0}" from test cases.'.format(prefix))
 
     # Remove the prefix, including a trailing slash.
     prefix_len = len(prefix.rstrip('/')) + 1
@@ -209,10 +293,9 @@ def _remove_prefixes(test_cases, prefix):
         else:
             return class_name
 
-    for i, test_case in enumerate(test_cases):
-        classname = test_case['classname']
-        updated_classname = remove_prefix(classname)
-        test_cases[i]['classname'] = updated_classname
+    for test_case in test_cases:
+        test_case['classname'] = remove_prefix(test_case['classname'])
+        yield test_case
 
 
 def _find_line(lines, prefix):
@@ -233,28 +316,6 @@ def _find_line(lines, prefix):
     return -1
 
 
-def _get_block(lines, start_prefix, end_prefix):
-    """Find the lines in the list between a given start point and end point.
-
-    :type lines: list
-    :arg lines: list of lines from start_test logfile.
-
-    :rtype: (int, int)
-    :returns: tuple for range of line numbers
-    """
-    start = _find_line(lines, start_prefix)
-
-    # No more subtests in log file.
-    if start == -1:
-        return -1, -1
-
-    end = _find_line(lines[start:], end_prefix)
-    if end == -1:
-        return start, end
-    else:
-        return start, start + end
-
-
 def _get_test_name(test_case_lines):
     """Return test name and classname from single test case lines. Extract from
     "[test: <path to .chpl file>]" line. Use the directory path as the
@@ -274,7 +335,12 @@ def _get_test_name(test_case_lines):
         raise ValueError('Could not find test name in: {0}'.format(
             test_case_lines[0].strip()))
 
-    test_file = match.group('test_name')
+    return _split_test_name(match.group('test_name'))
+
+
+def _split_test_name(test_file):
+    """Return classname (the directory) and test name (the file name without
+    extension) for a test file path."""
     classname = os.path.dirname(test_file)
     base_file = os.path.basename(test_file)
     test_name, _ = os.path.splitext(base_file)
@@ -333,7 +399,13 @@ def _get_test_error(test_case_lines):
     whole_test = ''.join(test_case_lines)
     errors = error_pattern.findall(whole_test)
     warnings = warn_pattern.findall(whole_test)
+    return _test_error(errors, warnings)
 
+
+def _test_error(errors, warnings):
+    """Return the error dict for a test's error and warning lines, or None if
+    there are neither.
+    """
     # No errors or warnings!
     if not (errors or warnings):
         return None
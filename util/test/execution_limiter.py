@@ -2,11 +2,19 @@
 running chpl executables """
 
 import getpass
+import math
+import multiprocessing
 import os
 import sys
 import tempfile
+import time
 import py3_compat
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import filelock
 except ImportError:
@@ -57,3 +65,134 @@ class FileLock():
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.lock.release()
+
+
+class SlotLock():
+    """ Lets up to `slots` executables run per user, per machine.
+
+        Each slot is a lock file held with `fcntl.flock`, so (as with FileLock)
+        the OS drops a slot if the program holding it crashes. A test can take
+        several slots at once (see `weight()`). To keep two tests from each
+        holding part of what they need and waiting on each other forever,
+        slots are only acquired while holding a separate "gate" lock: the
+        gate holder polls for free slots until it has enough, and releasing
+        slots never needs the gate.
+
+        Slot 0 is FileLock's lock file, so runs using different slot counts
+        (or a single slot) share it and never have more executables running
+        than the largest of their counts.
+
+        The time spent waiting is available as `wait_time` after entering. """
+
+    def __init__(self, slots, weight=1):
+        lock_name = '{0}-chpl_program_executing'.format(getpass.getuser())
+        lock_dir = os.getenv('CHPL_TEST_LIMIT_RUNNING_EXECUTABLES_DIR', tempfile.gettempdir())
+        py3_compat.makedirs(lock_dir, exist_ok=True)
+
+        self.slots = slots
+        self.weight = min(max(1, weight), slots)
+        self.gate_file = os.path.join(lock_dir, lock_name + '.gate')
+        self.slot_files = [os.path.join(lock_dir, lock_name)]
+        self.slot_files += [os.path.join(lock_dir, '{0}.slot{1}'.format(lock_name, i))
+                            for i in range(1, slots)]
+        self.held = []
+        self.wait_time = None
+
+    def _try_lock(self, fd, block=False):
+        flags = fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+            return True
+        except (IOError, OSError):
+            return False
+
+    def __enter__(self):
+        start = time.time()
+        gate = os.open(self.gate_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._try_lock(gate, block=True)
+            fds = [os.open(f, os.O_RDWR | os.O_CREAT, 0o600) for f in self.slot_files]
+            free = list(range(self.slots))
+            delay = 0.001
+            try:
+                while len(self.held) < self.weight:
+                    for i in list(free):
+                        if len(self.held) == self.weight:
+                            break
+                        if self._try_lock(fds[i]):
+                            self.held.append(fds[i])
+                            free.remove(i)
+                    if len(self.held) < self.weight:
+                        # Nothing else can be taken right now; poll until
+                        # some slot is released (whichever one it is).
+                        time.sleep(delay)
+                        delay = min(delay * 2, 0.05)
+            except BaseException:
+                self.__exit__(None, None, None)
+                raise
+            finally:
+                for i in free:
+                    os.close(fds[i])
+        finally:
+            os.close(gate)  # closing the descriptor drops the gate lock
+        self.wait_time = time.time() - start
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for fd in self.held:
+            os.close(fd)
+        self.held = []
+
+
+def default_slots():
+    """ Number of execution slots to use when asked to pick one ('auto'):
+        about 4 cores and 4GB of memory per slot, in the spirit of
+        paratest.local's get_good_nodepara(). """
+    cores_per_slot = 4
+    gb_per_slot = 4
+    slots = multiprocessing.cpu_count() // cores_per_slot
+
+    if os.access("/proc/meminfo", os.R_OK):
+        with open("/proc/meminfo", 'r') as f:
+            key, value, unit = f.readline().split()
+            if key == "MemTotal:" and unit == "kB":
+                mem_gb = int(value) / 1000 / 1000
+                slots = min(slots, int(mem_gb / gb_per_slot))
+    return max(1, slots)
+
+
+def get_slots():
+    """ Number of executables allowed to run at once, from
+        CHPL_TEST_EXECUTION_SLOTS (a number or 'auto', default 1). """
+    value = os.getenv('CHPL_TEST_EXECUTION_SLOTS', '1')
+    if value == 'auto':
+        return default_slots()
+    try:
+        return max(1, int(value))
+    except ValueError:
+        sys.stdout.write('[Warning: ignoring invalid CHPL_TEST_EXECUTION_SLOTS '
+                         '"{0}"]\n'.format(value))
+        return 1
+
+
+def weight(slots, numlocales=0, threads_per_locale=None):
+    """ Number of slots a test should take. Without weighting every test takes
+        one slot. With CHPL_TEST_EXECUTION_SLOT_WEIGHTING set, a test takes one
+        slot per slot-sized share of the cores its locales will use (all
+        locales run on this machine in oversubscribed testing). """
+    if not os.getenv('CHPL_TEST_EXECUTION_SLOT_WEIGHTING'):
+        return 1
+    cores_per_slot = max(1.0, multiprocessing.cpu_count() / float(slots))
+    try:
+        threads = float(threads_per_locale)
+    except (TypeError, ValueError):
+        threads = cores_per_slot
+    return int(math.ceil(max(1, numlocales) * threads / cores_per_slot))
+
+
+def create(numlocales=0, threads_per_locale=None):
+    """ Return the limiter to use when CHPL_TEST_LIMIT_RUNNING_EXECUTABLES is
+        set: FileLock for a single slot, SlotLock for more. """
+    slots = get_slots()
+    if slots == 1 or fcntl is None:
+        return FileLock()
+    return SlotLock(slots, weight(slots, numlocales, threads_per_locale))
@@ -0,0 +1,167 @@
+"""
+In-process comparison of test output against .good/.bad files.
+
+Nearly every comparison sub_test makes is between identical files, so there's
+no need to start a `diff` process just to learn that. same_contents() checks
+sizes and then compares the files in chunks (via mmap); only when the files
+differ does diff() fall back to the `diff` program, so the report in the log
+is exactly what it has always been. If `diff` can't be run, a normal-format
+report is produced with difflib instead.
+
+The .bad file comparison (formerly the diff-ignoring-module-line-numbers
+script) applies the same sed filters in-process and goes through the same
+fast path.
+"""
+
+import difflib
+import mmap
+import os
+import re
+import subprocess
+import tempfile
+
+_chunk_size = 1024 * 1024
+
+# Same filters as util/test/diff-ignoring-module-line-numbers. Note that in
+# sed's bracket expression `[A-Z\-]` the backslash is a literal.
+_module_line_re = re.compile(br':[0-9:]*:')
+_chpl_version_re = re.compile(br'chpl version [0-9]*.*$')
+_internal_error_re = re.compile(
+    br'internal error: ([A-Z][A-Z\\-]*)[0-9][0-9]* chpl version mmmm')
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def same_contents(f1, f2):
+    """Return True if the two files have identical contents.
+
+    Raises IOError/OSError if either file can't be read.
+    """
+    if os.path.getsize(f1) != os.path.getsize(f2):
+        return False
+    with open(f1, 'rb') as a, open(f2, 'rb') as b:
+        size = os.fstat(a.fileno()).st_size
+        if size == 0:
+            return True
+        if size <= _chunk_size:
+            return a.read() == b.read()
+        ma = mmap.mmap(a.fileno(), 0, access=mmap.ACCESS_READ)
+        mb = mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, size, _chunk_size):
+                end = start + _chunk_size
+                if ma[start:end] != mb[start:end]:
+                    return False
+            return True
+        finally:
+            ma.close()
+            mb.close()
+
+
+def _ranges(lo, hi):
+    """Format a 0-based half-open line range the way diff does."""
+    if hi - lo <= 1:
+        return str(hi if hi > lo else lo)
+    return '{0},{1}'.format(lo + 1, hi)
+
+
+def normal_diff(lines1, lines2):
+    """Return a normal-format (`diff` with no options) report for two lists of
+    byte-string lines (as from splitlines(True))."""
+    out = []
+    matcher = difflib.SequenceMatcher(None, lines1, lines2, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag == 'delete':
+            header = '{0}d{1}'.format(_ranges(i1, i2), j1)
+        elif tag == 'insert':
+            header = '{0}a{1}'.format(i1, _ranges(j1, j2))
+        else:
+            header = '{0}c{1}'.format(_ranges(i1, i2), _ranges(j1, j2))
+        out.append(header.encode('ascii') + b'\n')
+        for line in lines1[i1:i2]:
+            out.append(b'< ' + line)
+            if not line.endswith(b'\n'):
+                out.append(b'\n\\ No newline at end of file\n')
+        if tag == 'replace':
+            out.append(b'---\n')
+        for line in lines2[j1:j2]:
+            out.append(b'> ' + line)
+            if not line.endswith(b'\n'):
+                out.append(b'\n\\ No newline at end of file\n')
+    return b''.join(out)
+
+
+def _run_diff(args, f1, f2):
+    try:
+        p = subprocess.Popen(['diff'] + args + [f1, f2],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        try:
+            report = normal_diff(_read(f1).splitlines(True),
+                                 _read(f2).splitlines(True))
+        except (IOError, OSError):
+            return 2, b''
+        return (1 if report else 0), report
+    output = p.communicate()[0]
+    return p.returncode, output
+
+
+def diff(f1, f2, text=False):
+    """Compare two files like `diff [-a] f1 f2`.
+
+    Returns (status, report): status is 0 if the files are the same, 1 if they
+    differ and 2 on trouble, and report is diff's output (bytes).
+    """
+    try:
+        if same_contents(f1, f2):
+            return 0, b''
+    except (IOError, OSError):
+        # Let diff produce its usual complaint about the missing file.
+        pass
+    return _run_diff(['-a'] if text else [], f1, f2)
+
+
+def filter_module_line_numbers(data):
+    """Apply the diff-ignoring-module-line-numbers filters to `data`."""
+    lines = data.split(b'\n')
+    for i, line in enumerate(lines):
+        orig = line
+        if b'CHPL_HOME/modules' in line:
+            line = _module_line_re.sub(b':nnnn:', line, count=1)
+        if b'chpl version ' in line:
+            line = _chpl_version_re.sub(b'chpl version mmmm', line, count=1)
+            line = _internal_error_re.sub(
+                br'internal error: \1nnnn chpl version mmmm', line, count=1)
+        if line is not orig:
+            lines[i] = line
+    return b'\n'.join(lines)
+
+
+def diff_ignoring_module_line_numbers(badfile, outfile):
+    """Compare like diff(), but with both files run through
+    filter_module_line_numbers() first."""
+    try:
+        bad = filter_module_line_numbers(_read(badfile))
+        out = filter_module_line_numbers(_read(outfile))
+    except (IOError, OSError):
+        return _run_diff([], badfile, outfile)
+    if bad == out:
+        return 0, b''
+
+    # Mismatch: let diff report on the filtered copies, as the script did.
+    paths = []
+    try:
+        for data in (bad, out):
+            fd, path = tempfile.mkstemp(prefix='filtered.')
+            paths.append(path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        return _run_diff([], paths[0], paths[1])
+    finally:
+        for path in paths:
+            os.unlink(path)
@@ -3,8 +3,11 @@
 import sys, os, shutil, time, math, re, stat
 from optparse import OptionParser
 
+import concurrent.futures
 import datetime
+import tempfile
 import fileReadHelp
+import perf_columns
 import json
 try:
     import annotate
@@ -55,6 +58,14 @@ parser.add_option('-m', '--configs', dest='multiConf',
                        'duplicated for local and --no-local both of which will '
                        'be visible by default on the web page.',
                   default='')
+parser.add_option('--incremental', dest='incremental',
+                  help='keep the output directory from the last run and only '
+                       'regenerate the graphs whose .dat files or '
+                       'descriptions have changed since then',
+                  action='store_true', default=False)
+parser.add_option('--jobs', dest='jobs', type='int',
+                  help='graphs to generate at once', metavar='N',
+                  default=os.cpu_count() or 1)
 
 if annotate:
     parser.add_option('-j', '--annotate', dest='annotation_file',
@@ -66,18 +77,66 @@ numericX = False
 multiConf = []
 defaultMultiConf = []
 
+# bump to throw away the manifests of older versions
+_manifest_version = 1
+
+# .dat files changed this close to the start of a run may have changed again
+# in the same mtime tick, so graphs made from them aren't kept in the manifest
+_racy_seconds = 2.0
+
+# the globals generating graph data depends on, for the worker processes
+# (passed with each graph: a pool initializer needs Python 3.7)
+def get_globals():
+    return (debug, verbose, numericX, multiConf)
+
+def set_globals(_globals):
+    global debug, verbose, numericX, multiConf
+    (debug, verbose, numericX, multiConf) = _globals
+
+# generate the data for a graph (in a worker process, or inline). Returns the
+# parts of the graph's description that depend on its data
+def generate_data(ginfo, datdir, _globals):
+    set_globals(_globals)
+    ginfo.generateData(datdir, ginfo.openDatFiles())
+    return ginfo.dataResult()
+
+# (mtime, size) of each .dat file, or None if it's missing
+def input_stats(filenames):
+    stats = {}
+    for fn in filenames:
+        try:
+            st = os.stat(fn)
+            stats[fn] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            stats[fn] = None
+    return stats
+
 def try_parse_float(value):
+    if isinstance(value, float):
+        return value
+    # nothing to strip if it ends in a digit
+    if value[-1:].isdigit():
+        try:
+            return float(value)
+        except ValueError:
+            pass
     try:
         # removes any trailing characters (units)
         return float(re.sub(r'[^\d,.]+$', '', value))
     except ValueError:
         return value
 
+# every key of a test repeats the same dates
+parsedDates = {}
+
 def parse_date(value, dateformat='%m/%d/%y'):
     if numericX:
         return value
     else:
-        return time.strptime(value.strip(), dateformat)
+        key = (value, dateformat)
+        if key not in parsedDates:
+            parsedDates[key] = time.strptime(value.strip(), dateformat)
+        return parsedDates[key]
 
 def show_date(value=time.localtime()):
     if numericX:
@@ -85,17 +144,9 @@ def show_date(value=time.localtime()):
     else:
         return time.strftime('%Y-%m-%d', value)
 
-# converts a csv file to json. Converts the csv file to json where the json
-# object has two members: the labels and the actual data formatted as required
-# by dygraphs
-def csv_to_json(csvFile, ginfo):
-    data = parse_csv(csvFile)
-    os.unlink(csvFile)
-
-    # rename the csv file to indicate that it's a json file
-    jsonFile = os.path.splitext(csvFile)[0]+'.json'
-    ginfo.datfname = os.path.splitext(ginfo.datfname)[0]+'.json'
-
+# writes graph data (see below) out as json. The json object has two members:
+# the labels and the actual data formatted as required by dygraphs
+def data_to_json(data, jsonFile, ginfo):
     # each label is stored in a single element array because of how it is
     # parsed, get rid of that array so labels is now a simple array of strings
     labels = [a[0] for a in data[0]]
@@ -123,7 +174,7 @@ def csv_to_json(csvFile, ginfo):
                     curLine.append(try_parse_float(seriesArr[0]))
         lines.append(curLine)
 
-    # if there was no data in the csvFile, create an empty entry for todays
+    # if there was no data, create an empty entry for todays
     # date. Dygraphs does not accept a zero length array for the data so we add
     # a single entry for today's date with null data for each series
     if len(lines) == 0:
@@ -135,9 +186,8 @@ def csv_to_json(csvFile, ginfo):
     with open(jsonFile, 'w') as f:
         f.write(json.dumps(jsonObj))
 
-# Helper functions to parse/write/sort a dygraphs compatible csv file.
-#
-# Expected form of csv file is:
+# Helper functions to sort/fill/strip graph data. The data for a graph is
+# built up in the form of a dygraphs compatible csv file:
 #
 # Date,<perfKey1>,<perfKey2>
 # YYYY-mm-dd,<key1Value>,<key2Value>
@@ -147,43 +197,38 @@ def csv_to_json(csvFile, ginfo):
 # being used), 'lowVal;medVal;highVal' for numTrials>1 (customBars are being
 # used), or '' if there was no no value for that key for that date
 #
-# Parses a csv file of the above form into a list of the form:
+# but kept in memory (it used to be written out and re-read by every step) as
+# a list of the form:
 #
 # [[['Date'], ['perfKey1'], ['perfKey2']],
 # [['YYYY-mm-dd'],[<key1Value>],[<key2Value>]],
 # [['YYYY-mm-dd'],[<key1Value>],[<key2Value>]]]
 #
-# where <keyXValue> is either a single value as a string, 3 values (low, med,
-# high) as strings, or the empty string if there was no value for that key for
-# that date
-
-def parse_csv(csvFile):
-    lines = fileReadHelp.ReadFileWithComments(csvFile)
-
-    data = []
-    for line in lines:
-        line = line.rstrip()
-        if len(line) > 0:
-            valuesString = line.split(',')
-            values = []
-            for valueString in valuesString:
-                 values.append(valueString.split(';'))
-            data.append(values)
-
-    return data
-
-def data_to_csv(data, csvFile):
-    lines = []
-    for values in data:
-        line = []
-        for value in values:
-            line.append(';'.join(value))
-        lines.append(','.join(line)+'\n')
-
-    with open(csvFile, 'w') as f:
-        f.writelines(lines)
-
-# sorts a csv of the aforementioned form. Sorts a series' keys and it's
+# where <keyXValue> is either a single value, 3 values (low, med, high), or
+# the empty string if there was no value for that key for that date. Values
+# are floats, or strings if they aren't numbers (as they'd be after a trip
+# through the csv file).
+
+# splits a line of the csv form above into a row of the list form
+def csv_row(line):
+    return [valueString.split(';') for valueString in line.rstrip().split(',')]
+
+# a row as it would come back from the csv file: values that aren't finite
+# floats would have been written as strings, which may have had commas or
+# semicolons in them
+def as_data_row(row):
+    for value in row[1:]:
+        for x in value:
+            if not (x == '' or (isinstance(x, float) and math.isfinite(x))):
+                return csv_row(','.join(';'.join('{0}'.format(x) for x in value)
+                                        for value in row))
+    return row
+
+# the rows of transposed data, as lists
+def transpose(data):
+    return [list(row) for row in zip(*data)]
+
+# sorts data of the aforementioned form. Sorts a series' keys and it's
 # corresponding values (column) from greatest to least in terms of a series
 # most recent data.
 # Takes:
@@ -196,14 +241,12 @@ def data_to_csv(data, csvFile):
 #   YYYY-mm-dd,3;4;5,1;2;3
 #
 # also works for 'val', instead of 'low;med;high' and empty values: ''
-def sort_csv(csvFile):
-    data = parse_csv(csvFile)
-
+def sort_data(data):
     if len(data) == 1:
-        return
+        return data
 
     # transpose the data so that we can sort by row
-    data = list(zip(*data))
+    data = transpose(data)
     # remove the Date perfkey and the actual dates as they screw up sorting
     dates = data.pop(0)
 
@@ -224,9 +267,7 @@ def sort_csv(csvFile):
     # add the dates back in
     data.insert(0, dates)
     # untranspose the data
-    data = list(zip(*data))
-
-    data_to_csv(data, csvFile)
+    return transpose(data)
 
 # Yield dateformat-ed dates in the range [start_date, end_date]
 def date_range(start_date, end_date, dateformat='%Y-%m-%d'):
@@ -237,12 +278,12 @@ def date_range(start_date, end_date, dateformat='%Y-%m-%d'):
     yield cur_date.strftime(dateformat)
     cur_date += datetime.timedelta(days=1)
 
-# Fill in missing dates in the csv file. Grabs the start and end date from the
-# file, and ensures that we have an entry for every date in the range.
+# Fill in missing dates in the data. Grabs the start and end date from the
+# data, and ensures that we have an entry for every date in the range.
 # We do this because annotations require an actual data point to attach to, so
 # we make sure there will always be a day available
-def fill_sparse_csv(csvFile):
-    data = parse_csv(csvFile)
+def fill_sparse_data(data):
+    data = list(data)
     keys = data.pop(0)
     if len(data) > 1:
         dates = list(zip(*data)).pop(0)
@@ -261,22 +302,21 @@ def fill_sparse_csv(csvFile):
 
         # sort our data, we don't need to convert our date strings to datetimes
         # because for ISO 8601 dates lexical order is also chronological order
-        data.sort()
+        data.sort(key=lambda values: values[0])
 
     data.insert(0, keys)
-    data_to_csv(data, csvFile)
+    return data
 
 
-# Strips all but the first 'numseries' series from a csv file. Useful for
+# Strips all but the first 'numseries' series from the data. Useful for
 # things like compiler performance testing where you want to display the top 10
 # passes. If multiple configurations are being used it grabs the series from
 # the default configuration and then finds the other configurations for those
 # series.
-def strip_series(csvFile, numseries):
-    data = parse_csv(csvFile)
+def strip_series(data, numseries):
     labels = [a[0] for a in data[0]]
     newData = []
-    data = list(zip(*data))
+    data = transpose(data)
     numFound = 0
     newData.append(data[0])
     if multiConf:
@@ -293,16 +333,13 @@ def strip_series(csvFile, numseries):
             newData.append(data[i])
 
     # untranspose the data
-    data = list(zip(*newData))
-
-    data_to_csv(data, csvFile)
+    return transpose(newData)
 
 
 # Find the series to attach annotations to. If there were multiple
 # configurations, attach to a series in the default (first listed)
 # configuration. Else attach to first series
-def get_annotation_series(csvFile):
-    data = parse_csv(csvFile)
+def get_annotation_series(data):
     labels = [a[0] for a in data[0]]
     labels = labels[1:]
 
@@ -326,7 +363,8 @@ class CouldNotReadGraphFile(Exception):
 # Global info about generating graphs
 class GraphStuff:
     def __init__(self, _name, _testdir, _perfdir, _outdir, _startdate, _enddate,
-                 _reduce, _display_bounds, _alttitle, _annotation_file):
+                 _reduce, _display_bounds, _alttitle, _annotation_file,
+                 _incremental=False, _jobs=1):
         self.numGraphs = 0
         self.config_name = _name
         self.testdir = _testdir
@@ -346,9 +384,55 @@ class GraphStuff:
         self._reduce = _reduce
         self.display_bounds = _display_bounds
         self.annotation_file = _annotation_file
+        # the manifest records, for each graph's .json file, what it was made
+        # from, so --incremental runs can keep the ones that are still current
+        self.incremental = _incremental
+        self.manifestname = self.outdir+'/'+'manifest.json'
+        self.manifest = {}
+        self.newManifest = {}
+        self.jobs = _jobs
+        self.pool = None
+        # (graph, key, inputs, result or future) for each graph, in order
+        self.graphs = list()
+
+    # what the data of every graph depends on, besides its own description
+    def manifestOptions(self):
+        return {'version': _manifest_version,
+                'generator': os.stat(os.path.realpath(__file__)).st_mtime_ns,
+                'numericX': numericX,
+                'multiConf': multiConf}
+
+    def loadManifest(self):
+        try:
+            with open(self.manifestname, 'r') as f:
+                manifest = json.load(f)
+            if manifest['options'] == self.manifestOptions():
+                self.manifest = manifest['graphs']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def saveManifest(self):
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.manifest-', dir=self.outdir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'options': self.manifestOptions(),
+                           'graphs': self.newManifest}, f)
+            os.rename(tmpname, self.manifestname)
+        except (IOError, OSError):
+            sys.stdout.write('[Warning: could not write %s]\n'%(self.manifestname))
 
     def init(self):
-        if os.path.exists(self.outdir):
+        self.started = time.time()
+        if self.incremental and os.path.isdir(self.datdir):
+            if verbose:
+                sys.stdout.write('Updating old directory %s...\n'%(self.outdir))
+            self.loadManifest()
+            # only a run that finishes makes the output good to sync again
+            try:
+                os.remove(self.outdir+'/SUCCESS')
+            except OSError:
+                pass
+        elif os.path.exists(self.outdir):
             if verbose:
                 sys.stdout.write('Removing old directory %s...\n'%(self.outdir))
             try:
@@ -356,24 +440,34 @@ class GraphStuff:
             except OSError:
                 sys.stderr.write('Error: Could not clean up directory: %s\n'%(self.outdir))
                 raise
-        if verbose:
-            sys.stdout.write('Creating directory %s...\n'%(self.outdir))
-        try:
-            os.makedirs(self.outdir)
-        except OSError:
-            sys.stderr.write('ERROR: Could not (re)create directory: %s\n'%(self.outdir))
-            raise
-        if verbose:
-            sys.stdout.write('Creating directory %s...\n'%(self.datdir))
-        try:
-            os.makedirs(self.datdir)
-        except OSError:
-            sys.stderr.write('ERROR: Could not create directory: %s\n'%(self.datdir))
-            raise
+        if not os.path.isdir(self.outdir):
+            if verbose:
+                sys.stdout.write('Creating directory %s...\n'%(self.outdir))
+            try:
+                os.makedirs(self.outdir)
+            except OSError:
+                sys.stderr.write('ERROR: Could not (re)create directory: %s\n'%(self.outdir))
+                raise
+        if not os.path.isdir(self.datdir):
+            if verbose:
+                sys.stdout.write('Creating directory %s...\n'%(self.datdir))
+            try:
+                os.makedirs(self.datdir)
+            except OSError:
+                sys.stderr.write('ERROR: Could not create directory: %s\n'%(self.datdir))
+                raise
+        # graphdata.js is written to a temporary file and renamed into place
+        # by finish(), so the page never sees a half written one
         try:
-            self.gfile = open(self.gfname, 'w')
-        except IOError:
+            fd, self.gtmpname = tempfile.mkstemp(prefix='.graphdata-',
+                                                 dir=self.outdir)
+            self.gfile = os.fdopen(fd, 'w')
+        except (IOError, OSError):
             sys.stderr.write('ERROR: Could not open file: %s\n'%(self.gfname))
+            raise
+
+        if self.jobs > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.jobs)
 
         if annotate and self.annotation_file:
             try:
@@ -419,6 +513,66 @@ class GraphStuff:
                 self.gfile.write('{ "suite" : "%s" }'%(s))
             self.gfile.write('\n];\n')
             self.gfile.close()
+            os.chmod(self.gtmpname, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(self.gtmpname, self.gfname)
+            self.gfile = None
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    # don't leave the temporary graphdata.js behind if we can't finish
+    def discard(self):
+        if self.gfile:
+            self.gfile.close()
+            self.gfile = None
+            try:
+                os.remove(self.gtmpname)
+            except OSError:
+                pass
+
+    # Generate the data for a graph, or start generating it in the pool,
+    # unless the manifest says the .json file from the last run is current
+    def addGraph(self, ginfo):
+        key = ginfo.dataKey()
+        inputs = input_stats(ginfo.datfilenames)
+        cached = self.manifest.get(ginfo.datfname)
+        if (cached and cached['key'] == key and cached['inputs'] == inputs and
+                os.path.exists(self.datdir+'/'+ginfo.datfname)):
+            if verbose:
+                sys.stdout.write('Keeping graph data for %s\n'%(ginfo.datfname))
+            result = cached['result']
+        elif self.pool:
+            result = self.pool.submit(generate_data, ginfo, self.datdir,
+                                      get_globals())
+        else:
+            result = generate_data(ginfo, self.datdir, get_globals())
+        self.graphs.append((ginfo, key, inputs, result))
+
+    # Wait for the data of every graph, in order, and describe it in
+    # graphdata.js. Then drop the .json files of graphs that are gone.
+    def finishGraphs(self):
+        racy = (self.started - _racy_seconds) * 1e9
+        for ginfo, key, inputs, result in self.graphs:
+            if isinstance(result, concurrent.futures.Future):
+                result = result.result()
+            ginfo.setDataResult(result)
+            # graphs with no data get today's date, so they aren't kept
+            if (result['firstdate'] != None and
+                    all(st == None or st[0] < racy for st in inputs.values())):
+                self.newManifest[ginfo.datfname] = {'key': key,
+                                                    'inputs': inputs,
+                                                    'result': result}
+            ginfo.setDateRange(self)
+            self.genGraphInfo(ginfo)
+
+        if self.incremental:
+            current = set(ginfo.datfname for ginfo, _, _, _ in self.graphs)
+            for fn in os.listdir(self.datdir):
+                if fn not in current:
+                    os.remove(self.datdir+'/'+fn)
+        self.saveManifest()
 
     def genGraphInfo(self, ginfo):
         if not self.firstGraph:
@@ -604,6 +758,7 @@ class GraphClass:
     # For each unique data file
     class DatFileClass:
         def __init__(self, _filename):
+            self.filename = _filename
             # lines will end up looking like:
             # lines[lineNum][trailNum][field]
             # where lineNum is the number after they are "merged"
@@ -634,31 +789,25 @@ class GraphClass:
             if hasattr(self, 'dfile'):
                 self.dfile.close()
 
-    # Generate the new data file inline in CSV format
-    def generateData(self, graphInfo, datfiles):
+    # Generate the new data file inline (see the csv helper functions above)
+    def generateData(self, datdir, datfiles):
         # An alternative is to have an off-line process incrementally
         # update a CSV data file.  Since we would still have to open
         # potentially multiple data files and read thru them and look
         # at every line for the appropriate date, I opted for
         # regenerating.
-        fname = graphInfo.datdir+'/'+self.datfname
-        f = open(fname, 'w')
-        f.write('Date,')
-        for i in range(len(self.graphkeys)):
-            f.write(self.graphkeys[i])
-            if i < len(self.graphkeys)-1:
-                f.write(',')
-            else:
-                f.write('\n')
+        data = [csv_row('Date,'+','.join(self.graphkeys))]
+        for df in datfiles.values():
+            df.transposed = (None, None)
 
         numKeys = len(self.perfkeys)
         # currLines stores the current merged line number of each dat file
         currLines = [0]*numKeys
-        startdate = self.startdate
-        enddate = self.enddate
+        # the first and last dates with data (see setDateRange)
+        self.firstdate = None
+        self.lastdate = None
         minDate = None
 
-        first = True
         done = False
         for i in range(numKeys):
             # The file may be missing (in the case where only a subdirectory
@@ -666,6 +815,8 @@ class GraphClass:
             # try to access a non-existent datfile
             if self.datfilenames[i] in datfiles:
                 df = datfiles[self.datfilenames[i]]
+                if df.lines or self.readColumns(df):
+                    continue
                 for line in sorted(df.dfile):
                     line = line.strip()
                     if line == '' or line[0] == '#':
@@ -700,33 +851,30 @@ class GraphClass:
                     if minDate==None or myDate<minDate:
                         minDate = myDate
 
-            if startdate==None:
-                startdate = minDate
-
             if done:
                 break
 
-            # We didn't print anything last iteration if there was no data
-            # found, so skip the new line in that case
-            if not first and found_data:
-                f.write('\n')
-            else:
-                first = False
+            if self.firstdate==None:
+                self.firstdate = minDate
 
             # write out the data for this date
             found_data = False
-            line_to_write = show_date(minDate)
+            row = csv_row(show_date(minDate))
             for i in range(numKeys):
                 if not self.datfilenames[i] in datfiles:
                     continue
                 try:
                     df = datfiles[self.datfilenames[i]]
                     if currLines[i] < len(df.lines):
-                        fields = list(zip(*df.lines[currLines[i]]))
+                        # the keys from a dat file all go through its
+                        # batches together, so transpose each one once
+                        if df.transposed[0] != currLines[i]:
+                            df.transposed = (currLines[i],
+                                list(zip(*df.lines[currLines[i]])))
+                        fields = df.transposed[1]
                         myDate = fields[0][0]
                         if myDate == minDate:
                             # consume this line
-                            line_to_write += ','
                             if len(fields)>df.mykeys[i] and '-' not in fields[df.mykeys[i]]:
                                 fieldId = df.mykeys[i]
                                 value = fields[fieldId][0]
@@ -751,51 +899,74 @@ class GraphClass:
                                 if self.displayrange:
                                     minval = min(fields[fieldId])
                                     maxval = max(fields[fieldId])
-                                    line_to_write += "{0};{1};{2}".format(minval, value, maxval)
+                                    row.append([minval, value, maxval])
                                 else:
-                                    line_to_write += "{0}".format(value)
+                                    row.append([value])
                                 found_data = True
+                            else:
+                                row.append([''])
                             currLines[i] += 1
                         else:
                             # no data for this date
-                            line_to_write += ','
+                            row.append([''])
                     else:
                         # no data for this date
-                        line_to_write += ','
+                        row.append([''])
                 except:
                     print('[Error parsing .dat file: {0}'.format(self.datfilenames[i]))
                     raise
 
             if found_data:
-              f.write(line_to_write)
+              data.append(as_data_row(row))
 
-            if self.enddate==None:
-                enddate = minDate
-            else:
-                enddate = self.enddate
+            self.lastdate = minDate
             minDate = None
 
-        f.write('\n')
-        f.close()
-
-        # sort the csv if sorting is enabled for this graph. This happens after
-        # the file is created instead of above because the above process
-        # appends to the file line by line and it wasn't clear to me how to get
-        # it into a better form. If instead of writing out line by line, you
-        # put the data into a list of the form described in the csv helper
-        # functions section above, you can eliminate the intermediate step.
+        # sort the data if sorting is enabled for this graph
         if self.sort:
-            sort_csv(fname)
+            data = sort_data(data)
 
-        fill_sparse_csv(fname)
+        data = fill_sparse_data(data)
 
         if self.numseries > 0:
-            strip_series(fname, self.numseries)
-
-        self.annotationSeries = get_annotation_series(fname)
-
-        csv_to_json(fname, self)
-
+            data = strip_series(data, self.numseries)
+
+        self.annotationSeries = get_annotation_series(data)
+
+        data_to_json(data, datdir+'/'+self.datfname, self)
+
+    # what generateData() left for the graph's description, in the form kept
+    # in the manifest
+    def dataResult(self):
+        result = {'annotationSeries': self.annotationSeries,
+                  'firstdate': None, 'lastdate': None}
+        if self.firstdate != None:
+            result['firstdate'] = show_date(self.firstdate)
+            result['lastdate'] = show_date(self.lastdate)
+        return result
+
+    def setDataResult(self, result):
+        self.annotationSeries = result['annotationSeries']
+        self.firstdate = None
+        self.lastdate = None
+        if result['firstdate'] != None:
+            self.firstdate = parse_date(result['firstdate'], '%Y-%m-%d')
+            self.lastdate = parse_date(result['lastdate'], '%Y-%m-%d')
+
+    # everything in the description that the .json file depends on
+    def dataKey(self):
+        return [self.perfkeys, self.graphkeys, self.datfilenames,
+                self.generate, self._reduce, self.displayrange, self.sort,
+                self.numseries]
+
+    # the dates shown for the graph: those given, else those of the data
+    def setDateRange(self, graphInfo):
+        startdate = self.startdate
+        if startdate == None:
+            startdate = self.firstdate
+        enddate = self.enddate
+        if enddate == None:
+            enddate = self.lastdate
         if startdate == None:
             startdate = time.localtime()
         if enddate == None:
@@ -811,6 +982,38 @@ class GraphClass:
 
 
 
+    # Fill in df.lines from the .dat file's columnar store, which is much
+    # quicker than parsing the text. Returns False if there's no store (and
+    # for numeric x values, which the store doesn't have).
+    def readColumns(self, df):
+        if numericX:
+            return False
+        store = perf_columns.load(df.filename)
+        if store is None:
+            return False
+        with store:
+            dates = store.dates.tolist()
+            nfields = len(store.keys) + 1
+            columns = {}
+            for fieldId in set(df.mykeys.values()):
+                if 0 < fieldId < nfields:
+                    columns[fieldId] = store.column(fieldId - 1).tolist()
+        lastDay = None
+        for row in sorted(range(len(dates)), key=dates.__getitem__):
+            day = dates[row]
+            if day != lastDay:
+                # a new batch
+                myDate = perf_columns.day_to_date(day).timetuple()
+                df.lines.append([])
+                lastDay = day
+            fields = [myDate] + ['-'] * (nfields - 1)
+            for fieldId, column in columns.items():
+                value = column[row]
+                if value == value: # not NaN
+                    fields[fieldId] = value
+            df.lines[-1].append(fields)
+        return True
+
     def generateGraphData(self, graphInfo, gnum):
         if debug:
             print('===')
@@ -819,7 +1022,7 @@ class GraphClass:
         if verbose:
             sys.stdout.write('Generating graph data for %s (graph #%d)\n'%(self.name, gnum))
 
-        self.datfname = self.name+str(gnum)+'.txt'
+        self.datfname = self.name+str(gnum)+'.json'
 
         nperfkeys = len(self.perfkeys)
         if nperfkeys != len(self.graphkeys):
@@ -916,11 +1119,12 @@ class GraphClass:
                     # and we won't generate data for any series which won't
                     # bother dygraphs
 
-            nperfkeys = len(self.perfkeys)
+        graphInfo.addGraph(self)
 
-        # create a hashmap of open datfiles
+    # create a hashmap of open datfiles
+    def openDatFiles(self):
         datfiles = {}
-        for i in range(nperfkeys):
+        for i in range(len(self.perfkeys)):
             d = self.datfilenames[i]
             if d not in datfiles:
                 datfiles[d] = self.DatFileClass(d)
@@ -938,13 +1142,7 @@ class GraphClass:
             except ValueError:
                 sys.stderr.write('ERROR: Could not find perfkey \'%s\' in %s\n'%(self.perfkeys[i], self.datfilenames[i]))
                 raise
-
-        # generate the new data files
-        self.generateData(graphInfo, datfiles)
-        graphInfo.genGraphInfo(self)
-
-        for n, d in datfiles.items():
-            del d
+        return datfiles
 
 
 ####################
@@ -1020,7 +1218,7 @@ def main():
 
     graphInfo = GraphStuff(options.name, options.testdir, perfdir, outdir,
         startdate, enddate, options.g_reduce, options.g_display_bounds,
-        alttitle, annotation_file)
+        alttitle, annotation_file, options.incremental, options.jobs)
     try:
         graphInfo.init()
     except (IOError, OSError):
@@ -1080,14 +1278,19 @@ def main():
                         sys.stdout.write('suite: %s\n'%(currSuite))
   
     # generate the graphs 
-    for graph in graphList: 
-        try:
-            graphInfo.genGraphStuff(graph[0], graph[1])
-            numGraphfiles += 1
-        except (CouldNotReadGraphFile):
-            pass  # do not increment numGraphfiles
-        except (ValueError, IOError, OSError):
-            return -1
+    try:
+        for graph in graphList: 
+            try:
+                graphInfo.genGraphStuff(graph[0], graph[1])
+                numGraphfiles += 1
+            except (CouldNotReadGraphFile):
+                pass  # do not increment numGraphfiles
+        graphInfo.finishGraphs()
+    except (ValueError, IOError, OSError):
+        graphInfo.discard()
+        return -1
+    finally:
+        graphInfo.shutdown()
 
 
     # Copy the index.html and support css and js files
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in tracing of where the testing system's own time goes (start_test
+--trace-harness <file>).
+
+start_test points $CHPL_TEST_TRACE_DIR at a scratch directory, and
+start_test, sub_test and sub_clean each append the spans they time to
+trace.<pid>.jsonl in it. At the end of the run start_test merges those into
+one Chrome trace event file, which chrome://tracing or ui.perfetto.dev can
+show on a timeline, and prints a table of the time per phase.
+
+Every span has a category:
+
+  compiler   - running the compiler
+  executable - running the test program
+  harness    - everything else: skipifs, chplenv, prediffs, diffs,
+               computePerfStats, cleaning, sub_test's own set up, ...
+
+so the table can set the harness's overhead against the time spent in the
+compiler and the tests. When $CHPL_TEST_TRACE_DIR isn't set, nothing is
+recorded and the calls below cost a dictionary lookup.
+
+Usage:
+    harness_trace.py TRACE_FILE    # print the table for a merged trace
+"""
+
+from __future__ import print_function
+
+import contextlib
+import functools
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+_env_var = 'CHPL_TEST_TRACE_DIR'
+
+_lock = threading.Lock()
+_out = None
+_out_pid = None
+
+
+def enabled():
+    return bool(os.environ.get(_env_var))
+
+
+def _write(event):
+    global _out, _out_pid
+    with _lock:
+        # a fork (sub_test --server) gets a file of its own
+        if _out is None or _out_pid != os.getpid():
+            _out_pid = os.getpid()
+            path = os.path.join(os.environ[_env_var],
+                                'trace.{0}.jsonl'.format(_out_pid))
+            _out = open(path, 'a')
+            name = '{0} {1}'.format(os.path.basename(sys.argv[0]),
+                                    os.getcwd())
+            _out.write(json.dumps({'name': 'process_name', 'ph': 'M',
+                                   'pid': _out_pid,
+                                   'args': {'name': name}}) + '\n')
+        event['pid'] = _out_pid
+        _out.write(json.dumps(event) + '\n')
+        # sub_test can leave through os._exit(), so don't buffer
+        _out.flush()
+
+
+def record(name, cat, start, end, **args):
+    """Record a span that ran from `start` to `end` (time.time() values)."""
+    if not enabled():
+        return
+    try:
+        _write({'name': name, 'cat': cat, 'ph': 'X',
+                'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                'tid': threading.current_thread().ident, 'args': args})
+    except (IOError, OSError):
+        pass
+
+
+@contextlib.contextmanager
+def span(name, cat='harness', **args):
+    """Time the body of a with statement."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, cat, start, time.time(), **args)
+
+
+def traced(name, cat='harness'):
+    """Decorator timing each call of a function."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*a, **kw):
+            if not enabled():
+                return func(*a, **kw)
+            with span(name, cat):
+                return func(*a, **kw)
+        return wrapper
+    return decorator
+
+
+def merge(trace_dir, trace_file):
+    """Combine the per-process files in `trace_dir` into `trace_file`.
+    Returns the events."""
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, 'trace.*.jsonl'))):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # cut short by a killed process
+                    pass
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return events
+
+
+def load(trace_file):
+    with open(trace_file, 'r') as f:
+        return json.load(f)['traceEvents']
+
+
+def _covered(spans):
+    """Seconds covered by at least one of the (start, end) spans, which can
+    overlap (parallel compiles, several executables at once, paratest)."""
+    covered = 0.0
+    end = None
+    for span_start, span_end in sorted(spans):
+        if end is None or span_start > end:
+            covered += span_end - span_start
+            end = span_end
+        elif span_end > end:
+            covered += span_end - end
+            end = span_end
+    return covered / 1e6
+
+
+def summary(events):
+    """Table of the time spent in each phase of a merged trace."""
+    phases = {}
+    spans = {}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        span = (event['ts'], event['ts'] + event['dur'])
+        if event['name'] == 'start_test':
+            spans.setdefault('wall', []).append(span)
+            continue
+        key = (event['cat'], event['name'])
+        count, total = phases.get(key, (0, 0.0))
+        phases[key] = (count + 1, total + event['dur'] / 1e6)
+        spans.setdefault(event['cat'], []).append(span)
+    wall = _covered(spans.get('wall', []))
+
+    def percent(secs):
+        return '{0:5.1f}%'.format(100.0 * secs / wall) if wall else '     -'
+
+    lines = ['{0:<30} {1:>7} {2:>10} {3:>7}'.format(
+        'phase', 'count', 'seconds', '% wall')]
+    # compiler and executables first, then the harness's phases by cost
+    for key in sorted(phases, key=lambda k: (k[0] == 'harness',
+                                             -phases[k][1], k[1])):
+        count, total = phases[key]
+        lines.append('{0:<30} {1:>7} {2:>10.3f} {3:>7}'.format(
+            key[1], count, total, percent(total)))
+    lines.append('')
+    # the phases above add up every span; below, time is counted once no
+    # matter how many spans of a kind ran at once, so it compares to wall
+    compiler = spans.get('compiler', [])
+    executable = spans.get('executable', [])
+    lines.append('wall time:         {0:10.3f}'.format(wall))
+    lines.append('in the compiler:   {0:10.3f} {1}'.format(
+        _covered(compiler), percent(_covered(compiler))))
+    lines.append('in executables:    {0:10.3f} {1}'.format(
+        _covered(executable), percent(_covered(executable))))
+    if wall:
+        overhead = max(wall - _covered(compiler + executable), 0.0)
+        lines.append('harness overhead:  {0:10.3f} {1}'.format(
+            overhead, percent(overhead)))
+    lines.append('(a phase adds up its spans, which overlap when they nest, '
+                 'e.g. sub_test contains\ncompile and diff, or run in '
+                 'parallel; the totals below count overlapping time once)')
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.stderr.write('usage: harness_trace.py TRACE_FILE\n')
+        return 2
+    sys.stdout.write(summary(load(argv[0])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Streaming capture of subprocess output for the testing system.
+
+Test programs can produce hundreds of MB of output, so it's accumulated in a
+bytearray (amortized linear, unlike repeated `bytes += bytes`) and handed out
+as a memoryview where possible. Two optional limits keep the harness itself
+from running out of memory:
+
+  spill_size -- once more than this many bytes have been captured, the data
+                moves to an anonymous temp file and further output is
+                appended there.
+  limit      -- keep at most this many bytes: the first and last limit/2
+                bytes are kept and the middle is replaced by a marker line
+                (the same head/tail window trim_output() shows).
+
+The defaults come from $CHPL_TEST_OUTPUT_SPILL_SIZE and $CHPL_TEST_OUTPUT_LIMIT
+(in bytes); with neither set, everything is kept in memory.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+def _env_size(var):
+    value = os.environ.get(var)
+    if not value:
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        return None
+    return size if size > 0 else None
+
+
+def default_spill_size():
+    return _env_size('CHPL_TEST_OUTPUT_SPILL_SIZE')
+
+
+def default_limit():
+    return _env_size('CHPL_TEST_OUTPUT_LIMIT')
+
+
+class OutputCapture(object):
+    """Accumulates bytes written to it, honoring the spill/limit settings."""
+
+    def __init__(self, spill_size=None, limit=None):
+        self.spill_size = spill_size
+        self.limit = limit
+        self.head = bytearray()
+        # Only used with a limit: a rolling window of the most recent output.
+        self.tail = bytearray()
+        self.size = 0
+        self.spill_file = None
+
+    def __len__(self):
+        """Number of bytes written (including any that were dropped)."""
+        return self.size
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is None:
+            if self.spill_file is not None:
+                self.spill_file.write(data)
+                return
+            self.head += data
+            if self.spill_size is not None and len(self.head) > self.spill_size:
+                self._spill()
+            return
+
+        head_size = self.limit // 2
+        if len(self.head) < head_size:
+            room = head_size - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            tail_size = self.limit - head_size
+            # Trim lazily so that a stream of small writes stays linear.
+            if len(self.tail) > 2 * tail_size:
+                del self.tail[:len(self.tail) - tail_size]
+
+    def _spill(self):
+        self.spill_file = tempfile.TemporaryFile(prefix='chpl-test-output-')
+        self.spill_file.write(self.head)
+        self.head = bytearray()
+
+    def dropped(self):
+        """Number of bytes discarded because of the limit."""
+        if self.limit is None:
+            return 0
+        kept = len(self.head) + min(len(self.tail), self.limit - self.limit // 2)
+        return self.size - kept
+
+    def _tail_window(self):
+        tail = memoryview(self.tail)
+        if self.limit is None:
+            return tail
+        return tail[max(0, len(tail) - (self.limit - self.limit // 2)):]
+
+    def _omitted_marker(self):
+        return '\n[... {0} bytes of output omitted ...]\n'.format(
+            self.dropped()).encode('utf-8')
+
+    def getbuffer(self):
+        """Return the captured bytes as a memoryview.
+
+        This is zero-copy for the common (in-memory, not truncated) case. The
+        view is only valid until the next write().
+        """
+        if self.spill_file is None and not self.dropped() and not self.tail:
+            return memoryview(self.head)
+        return memoryview(self.getvalue())
+
+    def getvalue(self):
+        """Return the captured bytes (with the omitted marker, if any)."""
+        if self.spill_file is not None:
+            self.spill_file.seek(0)
+            data = self.spill_file.read()
+            self.spill_file.seek(0, os.SEEK_END)
+            return data
+        if self.dropped():
+            return b''.join([self.head, self._omitted_marker(),
+                             self._tail_window()])
+        return b''.join([self.head, self._tail_window()])
+
+    def write_to(self, f):
+        """Copy the captured bytes to binary file object `f` without building
+        an intermediate copy."""
+        if self.spill_file is not None:
+            self.spill_file.seek(0)
+            shutil.copyfileobj(self.spill_file, f)
+            return
+        f.write(memoryview(self.head))
+        if self.dropped():
+            f.write(self._omitted_marker())
+        if self.tail:
+            f.write(self._tail_window())
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def join(captures):
+    """Concatenate several captures into one bytes object, copying once."""
+    return b''.join(c.getbuffer() for c in captures)
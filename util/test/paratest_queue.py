@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+
+"""
+Socket work queue for paratest (paratest.server -queue).
+
+The classic paratest.server/paratest.client pair coordinates through files
+in Logs/.synch: the server polls the directory every second, and workers
+signal "feed me" by recreating files there, over NFS and ssh. With the work
+queue instead:
+
+  - `serve` listens on a socket (a Unix socket when every worker is on this
+    node, TCP otherwise), starts one `client` per worker (through ssh for
+    other nodes) and hands out work units (directories, or files with
+    -filedist) in the order given, as soon as a client asks for one,
+  - each `client` connects, gets its configuration (chplenv, options),
+    repeatedly pulls a unit, runs start_test on it with the log in a
+    temporary directory under Logs (which, as with paratest.client, every
+    node shares), and reports where the log is; the server moves it into
+    place for paratest.server to collect,
+  - while a unit runs the client sends heartbeats. A client that stops
+    sending them or drops its connection is declared dead and its unit is
+    requeued for another worker (once; a unit that loses two workers is
+    reported as an error rather than risking the next),
+  - a unit running longer than --unit-timeout gets its worker declared
+    timed out, as with paratest.server -timeout, and the worker gets no
+    more work,
+  - creating a PARAHALT file in the test directory stops the handing out of
+    work, and the clients' start_tests stop before their next test,
+  - with --stop-after-failures, --max-failure-rate or --smoke-list, the
+    results are counted as units finish and the queue creates PARAHALT
+    itself when a circuit breaker (see circuit_breaker.py) trips. Smoke
+    units are handed out first, and nothing else is until they have all
+    finished.
+
+With --adaptive-start N (paratest.local), only N units run at first and a
+ResourceController adjusts that between 1 and the number of workers as the
+run goes, from MemAvailable, the load average and the memory (RSS) the
+workers' process trees have been seen to use. A directory can declare that
+its tests are heavier than most with a PARATEST_WEIGHT file holding a number:
+its units count as that many units against the limit, and are expected to
+need that many times the usual memory.
+
+Messages are JSON objects, one per line.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import circuit_breaker
+
+# Seconds without a heartbeat before a client is declared dead; clients send
+# one every third of that, or every 10 seconds at most.
+default_heartbeat_timeout = 60
+max_heartbeat_interval = 10
+
+# How many times a unit is requeued after losing its worker.
+max_requeues = 1
+
+
+def send(sock_file, lock, msg):
+    data = (json.dumps(msg) + '\n').encode('utf-8')
+    with lock:
+        sock_file.write(data)
+        sock_file.flush()
+
+
+def receive(sock_file):
+    """Return the next message, or None at EOF."""
+    line = sock_file.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def log_name(logdir, unit, node):
+    """Same log file name paratest.client uses."""
+    return os.path.join(logdir, '{0}.{1}.log'.format(unit.replace('/', '-'),
+                                                      node))
+
+
+def collect_log(msg, logfile, node):
+    """Move the log a client reported in `msg` to `logfile`, or note that
+    there wasn't one."""
+    if msg.get('log'):
+        try:
+            os.rename(msg['log'], logfile)
+            return
+        except OSError:
+            pass
+    with open(logfile, 'w') as f:
+        f.write('[Error: start_test for {0} on {1} produced no log '
+                '(exit status {2})]\n'.format(msg['unit'], node,
+                                              msg.get('status')))
+
+
+class WorkQueue(object):
+    """The units still to hand out and the ones being worked on."""
+
+    def __init__(self, units, breaker=None, smoke=()):
+        # (the lock is reentrant, so callers may hold it)
+        self.cond = threading.Condition(threading.RLock())
+        self.pending = deque(units)
+        self.total = len(self.pending)
+        self.running = {}         # worker -> (unit, node, start time)
+        self.requeues = {}        # unit -> times requeued
+        self.finished = 0
+        self.logs = []
+        self.errors = []
+        self.dead = set()
+        self.halted = False
+        self.start = time.time()
+        self.controller = None
+        self.breaker = breaker
+        self.smoke = set(smoke)
+        self.stop_reason = None
+
+    def done(self):
+        return not self.running and (not self.pending or self.halted)
+
+    def take(self, worker, node):
+        """Next unit for `worker`, or None when there's nothing more for it.
+
+        Waits while the queue is empty but other units are still running,
+        since one of those may be requeued.
+        """
+        with self.cond:
+            while True:
+                if os.path.exists('PARAHALT') and not self.halted:
+                    self.halted = True
+                    self.cond.notify_all()
+                if worker in self.dead or self.halted:
+                    return None
+                if (self.pending and not self._held(self.pending[0]) and
+                        self._admit(self.pending[0])):
+                    unit = self.pending.popleft()
+                    self.running[worker] = (unit, node, time.time())
+                    return unit
+                if not self.running:
+                    return None
+                self.cond.wait(1)
+
+    def _held(self, unit):
+        # everything else waits for the smoke tests' verdict
+        return unit not in self.smoke and any(
+            running[0] in self.smoke for running in self.running.values())
+
+    def _admit(self, unit):
+        # something always runs, however heavy
+        return (self.controller is None or not self.running or
+                self.controller.admit(unit))
+
+    def finish(self, worker, unit, logfile):
+        with self.cond:
+            if self.running.get(worker, (None,))[0] != unit:
+                # given up on (timed out); the log comes too late
+                return False
+            del self.running[worker]
+            self.finished += 1
+            self.logs.append(logfile)
+            self._check_breakers(unit, logfile)
+            self.cond.notify_all()
+            return True
+
+    def _check_breakers(self, unit, logfile):
+        if self.breaker is None and unit not in self.smoke:
+            return
+        successes, failures = circuit_breaker.count_results(logfile)
+        reason = None
+        if self.breaker is not None:
+            reason = self.breaker.add(successes, failures)
+        if reason is None and unit in self.smoke and failures:
+            reason = circuit_breaker.smoke_failed(failures, unit)
+        if reason is not None and self.stop_reason is None:
+            self.stop_reason = reason
+            circuit_breaker.halt('PARAHALT', reason)
+            self.halted = True
+            print('\n[Stopping early: {0}]'.format(reason))
+
+    def lose(self, worker, reason):
+        """`worker` is gone; requeue what it was working on."""
+        with self.cond:
+            self.dead.add(worker)
+            if worker not in self.running:
+                return
+            unit, node, _ = self.running.pop(worker)
+            requeued = self.requeues.get(unit, 0)
+            if requeued < max_requeues:
+                self.requeues[unit] = requeued + 1
+                self.pending.appendleft(unit)
+                print('\n{0} lost {1} ({2}), requeued'.format(node, unit,
+                                                              reason))
+            else:
+                self.errors.append('[Error: {0} was lost with worker {1} on '
+                                   'node {2} ({3})]'.format(unit, worker,
+                                                            node, reason))
+                print('\n{0} lost {1} ({2})'.format(node, unit, reason))
+            self.cond.notify_all()
+
+    def check_timeouts(self, unit_timeout):
+        with self.cond:
+            now = time.time()
+            for worker, (unit, node, start) in list(self.running.items()):
+                if now - start > unit_timeout:
+                    del self.running[worker]
+                    self.dead.add(worker)
+                    self.errors.append('[Error: Worker {0} on node {1} timed '
+                                       'out.]'.format(worker, node))
+            self.cond.notify_all()
+
+    def estimated_end(self):
+        elapsed = time.time() - self.start
+        left = len(self.pending) + len(self.running)
+        est_left = 1
+        if self.finished > 0:
+            est_left = int(left * elapsed / self.finished)
+        return time.strftime('%H:%M:%S', time.localtime(time.time() + est_left))
+
+
+# Adaptive sizing: seconds between samples, and at least between increases
+# (the load average takes a while to reflect a new unit).
+sample_interval = 2
+grow_interval = 10
+
+# Memory a unit is assumed to need until some have been measured.
+default_unit_rss = 1024 ** 3
+
+_weights = {}
+
+
+def unit_weight(unit):
+    """The PARATEST_WEIGHT of the directory `unit` (a directory or a test
+    file) is in, or 1."""
+    dirname = unit if os.path.isdir(unit) else os.path.dirname(unit)
+    if dirname not in _weights:
+        weight = 1.0
+        try:
+            with open(os.path.join(dirname, 'PARATEST_WEIGHT')) as f:
+                weight = max(float(f.read().split()[0]), 0.0)
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        _weights[dirname] = weight
+    return _weights[dirname]
+
+
+def meminfo():
+    """MemTotal and MemAvailable in bytes, or {} where that's unavailable."""
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] in ('MemTotal:', 'MemAvailable:'):
+                    info[fields[0][:-1]] = int(fields[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return {}
+    return info if len(info) == 2 else {}
+
+
+def process_tree_rss(roots):
+    """Resident memory of each process in `roots` plus its descendants."""
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    children = {}
+    rss = {}
+    try:
+        pids = [int(pid) for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return {}
+    for pid in pids:
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as f:
+                # the command name is in parentheses and may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * page_size
+
+    totals = {}
+    for root in roots:
+        total = 0
+        todo = [root]
+        while todo:
+            pid = todo.pop()
+            total += rss.get(pid, 0)
+            todo.extend(children.get(pid, ()))
+        totals[root] = total
+    return totals
+
+
+class ResourceController(object):
+    """Decides how many units may run at once, from live memory and load.
+
+    The limit starts at `capacity` and moves by one at a time between 1 and
+    `max_capacity`: down when memory or CPU run short, up when there's room
+    for another unit and every allowed one is in use. Independently of the
+    limit, a unit only starts if its expected memory (the average peak RSS
+    of finished units times its weight) fits in what's available.
+    """
+
+    def __init__(self, queue, capacity, max_capacity, worker_pids):
+        self.queue = queue
+        self.capacity = max(1, min(capacity, max_capacity))
+        self.max_capacity = max_capacity
+        self.worker_pids = worker_pids
+        self.cpus = os.cpu_count() or 1
+        self.mem = meminfo()
+        self.committed = 0
+        self.peaks = {}           # (worker, unit) -> peak RSS
+        self.unit_rss = default_unit_rss
+        self.measured = 0
+        self.last_change = 0
+
+    def reserve(self):
+        return max(1024 ** 3, self.mem['MemTotal'] // 20)
+
+    def running_weight(self):
+        return sum(unit_weight(unit)
+                   for unit, _, _ in self.queue.running.values())
+
+    def admit(self, unit):
+        """Called with the queue's lock held."""
+        weight = unit_weight(unit)
+        if self.running_weight() + weight > self.capacity:
+            return False
+        if self.mem:
+            need = self.unit_rss * max(weight, 1.0)
+            available = self.mem['MemAvailable'] - self.committed
+            if available - need < self.reserve():
+                return False
+            # not in MemAvailable until the next sample
+            self.committed += need
+        return True
+
+    def sample(self):
+        with self.queue.cond:
+            running = dict((worker, unit) for worker, (unit, _, _)
+                           in self.queue.running.items())
+        rss = process_tree_rss([self.worker_pids[w] for w in running])
+        for worker, unit in running.items():
+            key = (worker, unit)
+            self.peaks[key] = max(self.peaks.get(key, 0),
+                                  rss.get(self.worker_pids[worker], 0))
+        for key in list(self.peaks):
+            if running.get(key[0]) != key[1]:
+                # finished (or lost); fold its peak into the estimate
+                peak = self.peaks.pop(key) / max(unit_weight(key[1]), 1.0)
+                self.measured += 1
+                self.unit_rss += (peak - self.unit_rss) / min(self.measured,
+                                                              20)
+
+        self.mem = meminfo()
+        load = os.getloadavg()[0]
+        with self.queue.cond:
+            self.committed = 0
+            old = self.capacity
+            short_of_memory = (self.mem and
+                               self.mem['MemAvailable'] < self.reserve())
+            if short_of_memory or load > 1.25 * self.cpus:
+                self.capacity = max(1, self.capacity - 1)
+            elif (self.queue.pending and
+                  self.running_weight() >= self.capacity and
+                  load < 0.9 * self.cpus and
+                  time.time() - self.last_change >= grow_interval and
+                  (not self.mem or self.mem['MemAvailable'] - 2 * self.unit_rss
+                   >= self.reserve())):
+                self.capacity = min(self.max_capacity, self.capacity + 1)
+            if self.capacity != old:
+                self.last_change = time.time()
+                available = (self.mem['MemAvailable'] / 1024.0 ** 3
+                             if self.mem else float('nan'))
+                print('\n[paratest: running up to {0} unit(s): {1:.1f} GB '
+                      'available, load {2:.1f}]'.format(self.capacity,
+                                                        available, load))
+                self.queue.cond.notify_all()
+
+    def run(self, stop):
+        while not stop.wait(sample_interval):
+            self.sample()
+
+
+def error_summary(logfile, show_all):
+    """The :( / :) report paratest.server prints when a unit finishes."""
+    errors = []
+    try:
+        with open(logfile, 'r', errors='replace') as f:
+            for line in f:
+                if line.startswith('[Test Summary'):
+                    break
+                if line.startswith('[Error'):
+                    errors.append(line)
+                    if not show_all:
+                        break
+    except (IOError, OSError):
+        pass
+    return '\n:( ' + ''.join(errors) if errors else ':)'
+
+
+class QueueHandler(socketserver.StreamRequestHandler):
+    """One connected client."""
+
+    def handle(self):
+        server = self.server
+        queue = server.queue
+        self.request.settimeout(server.heartbeat_timeout)
+        lock = threading.Lock()
+        worker = node = None
+        try:
+            hello = receive(self.rfile)
+            if not hello or hello.get('op') != 'hello':
+                return
+            worker, node = hello['worker'], hello['node']
+            send(self.wfile, lock, {'op': 'config', 'config': server.config})
+
+            while True:
+                msg = receive(self.rfile)
+                if msg is None:
+                    queue.lose(worker, 'connection closed')
+                    return
+                op = msg.get('op')
+                if op == 'heartbeat':
+                    continue
+                if op == 'fail':
+                    print('\n failure on {0}, no more testing there\n'
+                          'Error in paratest.client: [{0}] {1}'.format(
+                              node, msg.get('reason', '')))
+                    queue.lose(worker, 'client failed')
+                    return
+                if op == 'result':
+                    unit = msg['unit']
+                    logfile = log_name(server.logdir, unit, node)
+                    collect_log(msg, logfile, node)
+                    if queue.finish(worker, unit, logfile):
+                        sys.stdout.write(error_summary(logfile,
+                                                       server.show_all_errors))
+                        sys.stdout.flush()
+                if op in ('next', 'result'):
+                    unit = queue.take(worker, node)
+                    if unit is None:
+                        send(self.wfile, lock, {'op': 'done'})
+                        return
+                    with queue.cond:
+                        left = len(queue.pending)
+                        end = queue.estimated_end()
+                    print('{0} <- {1} ({2} left, end ~{3})'.format(
+                        node, unit, left, end))
+                    send(self.wfile, lock, {'op': 'unit', 'unit': unit})
+        except socket.timeout:
+            queue.lose(worker, 'no heartbeat')
+        except (OSError, ValueError, KeyError) as e:
+            if worker is not None:
+                queue.lose(worker, str(e))
+
+
+class _QueueServerMixin(object):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TCPQueueServer(_QueueServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+class UnixQueueServer(_QueueServerMixin, socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+def client_command(address, worker, node, local_node):
+    cmd = [sys.executable if node == local_node else 'python3',
+           os.path.abspath(__file__), 'client', '--connect', address,
+           '--worker', str(worker)]
+    if node != local_node:
+        cmd = ['ssh', '-x', node] + cmd
+    return cmd
+
+
+def serve(args):
+    with open(args.work_list, 'r') as f:
+        units = [line.strip() for line in f if line.strip()]
+    nodes = args.nodes
+    breaker = circuit_breaker.CircuitBreaker(args.stop_after_failures,
+                                             args.max_failure_rate,
+                                             args.failure_rate_window)
+    smoke = []
+    if args.smoke_list:
+        with open(args.smoke_list, 'r') as f:
+            smoke = [line.strip() for line in f if line.strip()]
+    queue = WorkQueue(units, breaker if breaker.enabled() else None, smoke)
+
+    sockdir = None
+    if all(node == args.local_node for node in nodes):
+        sockdir = tempfile.mkdtemp(prefix='paratest-')
+        address = os.path.join(sockdir, 'queue.sock')
+        server = UnixQueueServer(address, QueueHandler)
+    else:
+        server = TCPQueueServer(('', 0), QueueHandler)
+        address = '{0}:{1}'.format(socket.gethostname(),
+                                   server.server_address[1])
+
+    server.queue = queue
+    server.logdir = args.logdir
+    server.show_all_errors = args.show_all_errors
+    server.heartbeat_timeout = args.heartbeat_timeout
+    server.config = {
+        'workingdir': os.getcwd(),
+        'logdir': args.logdir,
+        'chplenv': args.chplenv,
+        'futures_mode': args.futures_mode,
+        'valgrind': args.valgrind,
+        'memleaks': args.memleaks,
+        'compopts': args.compopts,
+        'execopts': args.execopts,
+        'heartbeat_interval': min(max_heartbeat_interval,
+                                  args.heartbeat_timeout / 3.0),
+    }
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    print('{0} worker(s) ({1})'.format(len(nodes), ' '.join(nodes)))
+    print('{0} test(s) ({1})'.format(len(units), ' '.join(units)))
+    client_pids = []
+    stop_controller = threading.Event()
+    if args.adaptive_start and sockdir:
+        controller = ResourceController(queue, args.adaptive_start,
+                                        len(nodes), client_pids)
+        queue.controller = controller
+        controller_thread = threading.Thread(target=controller.run,
+                                             args=(stop_controller,))
+        controller_thread.daemon = True
+        controller_thread.start()
+        print('[paratest: running up to {0} unit(s) at first, adapting to '
+              'memory and load]'.format(controller.capacity))
+
+    clients = []
+    for worker, node in enumerate(nodes):
+        clients.append(subprocess.Popen(
+            client_command(address, worker, node, args.local_node),
+            stdin=subprocess.DEVNULL))
+        client_pids.append(clients[-1].pid)
+
+    try:
+        with queue.cond:
+            while not queue.done():
+                if all(p.poll() is not None for p in clients):
+                    # every client is gone; nobody will take what's left
+                    for worker in list(queue.running):
+                        queue.lose(worker, 'client exited')
+                    break
+                queue.cond.wait(1)
+                if args.unit_timeout > 0:
+                    queue.check_timeouts(args.unit_timeout)
+                if os.path.exists('PARAHALT'):
+                    queue.halted = True
+    finally:
+        stop_controller.set()
+        server.shutdown()
+        server.server_close()
+        # Clients that timed out may never finish; as with the synch file
+        # protocol, they have to be killed by hand.
+        for p in clients:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                pass
+        if sockdir:
+            shutil.rmtree(sockdir, ignore_errors=True)
+
+    if queue.errors:
+        errlog = os.path.join(args.logdir, 'paratest-queue.{0}.log'.format(
+            args.local_node))
+        with open(errlog, 'w') as f:
+            f.write('[Error: paratest failed to exit cleanly]\n')
+            for error in queue.errors:
+                f.write(error + '\n')
+        queue.logs.append(errlog)
+        print('\n[Error: paratest failed to exit cleanly]')
+        for error in queue.errors:
+            print(error)
+
+    if queue.halted and queue.pending:
+        print('\nExiting early due to PARAHALT file')
+    if queue.stop_reason is not None:
+        # ours, not someone's request to halt; don't stop the next run too
+        try:
+            os.remove('PARAHALT')
+        except OSError:
+            pass
+    if queue.pending:
+        print('{0} directory(s) left untested: {1}'.format(
+            len(queue.pending), ' '.join(queue.pending)))
+
+    with open(args.log_list, 'w') as f:
+        for log in queue.logs:
+            f.write(log + '\n')
+    return 0
+
+
+def _start_test_args(config, node, unit, logfile):
+    """The start_test command paratest.client would run for `unit`."""
+    binpath = subprocess.check_output(
+        ['../util/chplenv/chpl_bin_subdir.py']).decode().strip()
+    compiler = '../bin/{0}/chpl'.format(binpath)
+    dirfname = unit.replace('/', '-')
+    cmd = ['nice', '../util/start_test', '-compiler', compiler,
+           '-logfile', logfile, '-futures-mode', str(config['futures_mode'])]
+    if config['valgrind'] == 1:
+        cmd.append('-valgrind')
+    elif config['valgrind'] == 2:
+        cmd.append('-valgrindexe')
+    cmd += ['-compopts', config['compopts'], '-execopts', config['execopts']]
+    if config['memleaks'] == 1:
+        cmd.append('-memleaks')
+    elif config['memleaks'] == 2:
+        cmd += ['-memleakslog', os.path.join(
+            config['logdir'], 'tmp.{0}.{1}.memleaks'.format(dirfname, node))]
+    cmd += ['-halt-file', os.path.join(config['workingdir'], 'PARAHALT')]
+    cmd += [unit, '-norecurse']
+    return compiler, cmd
+
+
+def _chplenv(chplenv):
+    """Parse the "VAR=value ..." string paratest.server packages up."""
+    env = {}
+    for item in chplenv.split():
+        key, _, value = item.partition('=')
+        if len(value) > 1 and value.startswith("'") and value.endswith("'"):
+            value = value[1:-1]
+        env[key] = value
+    return env
+
+
+def _connect(address):
+    if ':' in address and not os.path.exists(address):
+        host, port = address.rsplit(':', 1)
+        return socket.create_connection((host, int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def _heartbeat(sock_file, lock, stop, interval):
+    while not stop.wait(interval):
+        try:
+            send(sock_file, lock, {'op': 'heartbeat'})
+        except (OSError, ValueError):
+            return
+
+
+def client(args):
+    node = socket.gethostname().split('.')[0]
+    sock = _connect(args.connect)
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+    lock = threading.Lock()
+    send(wfile, lock, {'op': 'hello', 'worker': args.worker, 'node': node})
+    config = receive(rfile)['config']
+
+    def fatal(reason):
+        sys.stderr.write('Error in paratest.client: [{0}] {1}\n'.format(
+            node, reason))
+        send(wfile, lock, {'op': 'fail', 'reason': reason})
+        return 2
+
+    try:
+        os.chdir(config['workingdir'])
+    except OSError:
+        return fatal("cannot change to directory '{0}'".format(
+            config['workingdir']))
+    env = dict(os.environ)
+    env.update(_chplenv(config['chplenv']))
+    # the server moves finished logs out of here, so keep it on the same
+    # (shared) filesystem as the Logs directory
+    tmpdir = tempfile.mkdtemp(prefix='.paratest-client-', dir=config['logdir'])
+
+    try:
+        send(wfile, lock, {'op': 'next'})
+        while True:
+            msg = receive(rfile)
+            if msg is None or msg['op'] != 'unit':
+                return 0
+            unit = msg['unit']
+            logfile = log_name(tmpdir, unit, node)
+            compiler, cmd = _start_test_args(config, node, unit, logfile)
+            if not os.path.exists(compiler):
+                return fatal("cannot find or execute the compiler '{0}'"
+                             .format(compiler))
+
+            stop = threading.Event()
+            beat = threading.Thread(target=_heartbeat,
+                                    args=(wfile, lock, stop,
+                                          config['heartbeat_interval']))
+            beat.daemon = True
+            beat.start()
+            try:
+                status = subprocess.call(cmd, env=env,
+                                         stdin=subprocess.DEVNULL,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+            finally:
+                stop.set()
+                beat.join()
+
+            send(wfile, lock, {'op': 'result', 'unit': unit,
+                               'status': status,
+                               'log': (logfile if os.path.exists(logfile)
+                                       else None)})
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='paratest work queue')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='hand out work')
+    serve_parser.add_argument('--work-list', required=True,
+                              help='file listing the work units, in order')
+    serve_parser.add_argument('--nodes', nargs='+', required=True,
+                              help='node of each worker')
+    serve_parser.add_argument('--local-node', required=True)
+    serve_parser.add_argument('--logdir', default='Logs')
+    serve_parser.add_argument('--log-list', required=True,
+                              help='file to write the list of logs to')
+    serve_parser.add_argument('--chplenv', default='')
+    serve_parser.add_argument('--futures-mode', type=int, default=0)
+    serve_parser.add_argument('--valgrind', type=int, default=0)
+    serve_parser.add_argument('--memleaks', type=int, default=0)
+    serve_parser.add_argument('--compopts', default='')
+    serve_parser.add_argument('--execopts', default='')
+    serve_parser.add_argument('--unit-timeout', type=float, default=-1)
+    serve_parser.add_argument('--heartbeat-timeout', type=float,
+                              default=default_heartbeat_timeout)
+    serve_parser.add_argument('--show-all-errors', action='store_true')
+    serve_parser.add_argument('--adaptive-start', type=int, default=0,
+                              help='run this many units at first and adapt '
+                                   'to memory and load (local runs only)')
+    serve_parser.add_argument('--stop-after-failures', type=int, default=0)
+    serve_parser.add_argument('--max-failure-rate', type=float, default=0)
+    serve_parser.add_argument('--failure-rate-window', type=int,
+                              default=circuit_breaker.default_rate_window)
+    serve_parser.add_argument('--smoke-list',
+                              help='file listing the smoke test units, which '
+                                   'come first in the work list')
+
+    client_parser = subparsers.add_parser('client', help='do work')
+    client_parser.add_argument('--connect', required=True,
+                               help='socket path or host:port of the server')
+    client_parser.add_argument('--worker', type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(args)
+    if args.command == 'client':
+        return client(args)
+    parser.print_usage()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
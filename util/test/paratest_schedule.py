@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Duration-aware ordering of paratest work.
+
+paratest.server hands out test directories (or files, with -filedist) to
+whichever worker asks next. Handed out in name order, the slowest directories
+often start last and set the total wall time. Handing out the longest ones
+first (longest-processing-time-first) keeps the tail short.
+
+Durations come from the lines start_test logs already contain:
+
+    [Finished subtest "<dir or dir/test>" - N seconds]
+    [Elapsed time to compile and execute all versions of "<dir/test>" - N seconds]
+
+and are kept in a small JSON timing database that is refreshed after each
+run. New measurements are blended with the stored ones (see _weight) so one
+noisy run doesn't reorder everything.
+
+Work with no history is estimated from what is known: a directory from the
+tests under it that have been timed, otherwise the average of the known
+entries. With an empty database the order is the plain sorted one.
+
+Usage:
+    paratest_schedule.py --db FILE order LISTFILE   # print LISTFILE in LPT order
+    paratest_schedule.py --db FILE update LOG...    # fold LOGs into the database
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+
+_finished_re = re.compile(r'^\[Finished subtest "(.*)" - ([0-9.]+) seconds\]')
+_elapsed_re = re.compile(r'^\[Elapsed time to compile and execute all versions '
+                         r'of "(.*)" - ([0-9.]+) seconds\]')
+
+# Test file suffixes; entries ending in one of these are files, not dirs.
+_test_exts = ('.chpl', '.test.c', '.ml-test.c')
+
+# Weight of a new measurement against the stored duration.
+_weight = 0.5
+
+_db_version = 1
+
+
+def timed_name(name):
+    """A directory or test path as it's kept in the database: sub_test logs
+    "./dir/test" and the work list may have "dir/test/" or "./dir"."""
+    return os.path.normpath(name)
+
+
+def entry_name(entry):
+    """Name under which a directory or test file is timed: the path relative
+    to the test directory, without the test file's extension."""
+    name = timed_name(entry)
+    for ext in _test_exts:
+        if name.endswith(ext):
+            return 'file', name[:-len(ext)]
+    return 'dir', name
+
+
+def parse_log(path):
+    """Return ({dir: seconds}, {test: seconds}) from a start_test log."""
+    finished = {}
+    files = {}
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            if not line.startswith('['):
+                continue
+            m = _finished_re.match(line) or _elapsed_re.match(line)
+            if not m:
+                continue
+            name, secs = timed_name(m.group(1)), float(m.group(2))
+            if m.re is _finished_re:
+                # a directory can be run more than once (e.g. -filedist)
+                finished[name] = finished.get(name, 0.0) + secs
+            else:
+                files[name] = secs
+
+    dirs = {}
+    for name, secs in finished.items():
+        if name in files:
+            # A single-file run (-filedist, CHPL_ONETEST) is named after the
+            # test rather than the directory; its total includes the setup.
+            files[name] = max(files[name], secs)
+        else:
+            dirs[name] = secs
+    return dirs, files
+
+
+class TimingDB(object):
+    """Stored durations of directories and test files, in seconds."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = {}
+        self.files = {}
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == _db_version:
+                self.dirs = data['dirs']
+                self.files = data['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def update(self, dirs, files):
+        for known, new in ((self.dirs, dirs), (self.files, files)):
+            for name, secs in new.items():
+                if name in known:
+                    secs = _weight * secs + (1 - _weight) * known[name]
+                known[name] = round(secs, 3)
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.timings-', dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': _db_version, 'dirs': self.dirs,
+                       'files': self.files}, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _tests_under(self, dirname):
+        prefix = dirname + '/'
+        return [secs for name, secs in self.files.items()
+                if name.startswith(prefix) and '/' not in name[len(prefix):]]
+
+    def estimate(self, entry):
+        """Estimated duration of `entry`, or None if nothing is known."""
+        kind, name = entry_name(entry)
+        if kind == 'file':
+            return self.files.get(name)
+        if name in self.dirs:
+            return self.dirs[name]
+        tests = self._tests_under(name)
+        return sum(tests) if tests else None
+
+
+def order(entries, db):
+    """Return `entries` longest (estimated) first; ties in name order."""
+    entries = sorted(entries)
+    estimates = [db.estimate(entry) for entry in entries]
+    known = [secs for secs in estimates if secs is not None]
+    default = sum(known) / len(known) if known else 0.0
+    keyed = [(default if secs is None else secs, entry)
+             for secs, entry in zip(estimates, entries)]
+    # sorted() is stable, so equal estimates keep their name order
+    return [entry for _, entry in sorted(keyed, key=lambda k: -k[0])]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Order paratest work by expected duration.')
+    parser.add_argument('--db', required=True,
+                        help='timing database (created if missing)')
+    subparsers = parser.add_subparsers(dest='command')
+    order_parser = subparsers.add_parser(
+        'order', help='print the directories/files listed in a file, '
+                      'longest first')
+    order_parser.add_argument('listfile')
+    update_parser = subparsers.add_parser(
+        'update', help='record the durations in start_test logs')
+    update_parser.add_argument('logs', nargs='+')
+    args = parser.parse_args(argv)
+
+    db = TimingDB(args.db)
+    if args.command == 'order':
+        with open(args.listfile, 'r') as f:
+            entries = [line.strip() for line in f if line.strip()]
+        if ((db.dirs or db.files) and
+                all(db.estimate(entry) is None for entry in entries)):
+            sys.stderr.write('Warning: no timings in {0} match the work list; '
+                             'it stays in sorted order\n'.format(args.db))
+        for entry in order(entries, db):
+            print(entry)
+    elif args.command == 'update':
+        for log in args.logs:
+            try:
+                dirs, files = parse_log(log)
+            except (IOError, OSError) as e:
+                sys.stderr.write('Warning: could not read {0}: {1}\n'.format(
+                    log, e.strerror))
+                continue
+            db.update(dirs, files)
+        db.save()
+    else:
+        parser.print_usage()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+Columnar copies of performance .dat files, for reading perf history quickly.
+
+A .dat file is text: a "# Date<tab>key<tab>key..." header and then a row per
+run ("mm/dd/yy <tab>value<tab>value..."), with comment lines mixed in.
+Reading years of it takes a strptime and a float() (after stripping units)
+per field, every time a graph is made. Next to foo.dat, foo.dat.cols holds
+the same rows as columns: the dates as int32 days since 1970-01-01, and each
+key as float64 with NaN for "-" (or anything else that isn't a number).
+Readers map the file with mmap and get the columns as memoryviews.
+
+The .dat file stays the source of truth. A store records the size and mtime
+of the .dat file it was made from, so a .dat file that has been edited since
+(by hand, updateDatFiles.py, spliceDat, ...) is noticed and the store rebuilt
+from it when it's next loaded. perf_stats adds the rows sub_test records to
+the store in place. Comment lines, such as the ones for timed out runs, and
+units after values aren't kept.
+
+Layout (the header little endian, the columns in the byte order the header
+names):
+
+    magic, byte order, key count, row count, row capacity,
+    .dat mtime (ns), .dat size                          48 bytes
+    length and JSON list of the keys                    padded to 8 bytes
+    dates: int32[capacity]                              padded to 8 bytes
+    one float64[capacity] per key
+
+Usage:
+    perf_columns.py build DAT...    (re)build the stores for DATs
+    perf_columns.py dump DAT        print the store for DAT as a .dat file
+"""
+
+from __future__ import print_function
+
+import argparse
+import array
+import datetime
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+
+_magic = b'CHPLPDC1'
+_header = struct.Struct('<8s1s3xIQQqQ')
+_byteorder = b'<' if sys.byteorder == 'little' else b'>'
+_epoch = datetime.date(1970, 1, 1).toordinal()
+_nan = float('nan')
+
+_date_format = '%m/%d/%y'
+
+# genGraphs' try_parse_float: trailing units are ignored
+_units_re = re.compile(r'[^\d,.]+$')
+
+
+def store_name(dat_file):
+    return dat_file + '.cols'
+
+
+def day_to_date(day):
+    """The datetime.date for a stored date."""
+    return datetime.date.fromordinal(day + _epoch)
+
+
+def _pad8(n):
+    return (n + 7) & ~7
+
+
+def _capacity(nrows):
+    return nrows + max(64, nrows)
+
+
+class _Parser(object):
+    """Dates and values of .dat rows; dates are cached, since every key of
+    a test repeats them."""
+
+    def __init__(self):
+        self.days = {}
+
+    def day(self, s):
+        """Days since 1970-01-01 for mm/dd/yy `s`; raises ValueError."""
+        day = self.days.get(s)
+        if day is None:
+            day = (datetime.datetime.strptime(s, _date_format).date()
+                   .toordinal() - _epoch)
+            self.days[s] = day
+        return day
+
+    @staticmethod
+    def value(s):
+        if s[-1:].isdigit() or s[-1:] == '.':
+            try:
+                return float(s)
+            except ValueError:
+                pass
+        try:
+            return float(_units_re.sub('', s))
+        except ValueError:
+            return _nan
+
+    def row(self, line, nkeys):
+        """(day, [value, ...]) for a line of a .dat file, or None for a
+        blank or comment line. Raises ValueError for a bad date."""
+        line = line.strip()
+        if line == '' or line[0] == '#':
+            return None
+        fields = line.split()
+        values = [self.value(v) for v in fields[1:nkeys + 1]]
+        values += [_nan] * (nkeys - len(values))
+        return self.day(fields[0]), values
+
+
+def read_dat(dat_file):
+    """(keys, dates, columns) for `dat_file`, the columns as array('d')s.
+    Raises ValueError if a row's date isn't mm/dd/yy."""
+    parser = _Parser()
+    dates = array.array('i')
+    with open(dat_file, 'r') as f:
+        keys = [k.strip() for k in f.readline()[1:].split('\t')][1:]
+        nkeys = len(keys)
+        columns = [array.array('d') for k in keys]
+        for line in f:
+            row = parser.row(line, nkeys)
+            if row is None:
+                continue
+            dates.append(row[0])
+            for k in range(nkeys):
+                columns[k].append(row[1][k])
+    return keys, dates, columns
+
+
+class _Layout(object):
+    """Where things are in a store with `nkeys` keys (as JSON, `keys_json`)
+    and room for `capacity` rows."""
+
+    def __init__(self, keys_json, capacity):
+        self.keys_off = _header.size
+        self.dates_off = _pad8(self.keys_off + 4 + len(keys_json))
+        self.columns_off = _pad8(self.dates_off + 4 * capacity)
+        self.capacity = capacity
+
+    def column_off(self, k):
+        return self.columns_off + 8 * self.capacity * k
+
+    def size(self, nkeys):
+        return self.column_off(nkeys)
+
+
+def _pack(keys, dates, columns, st):
+    """The bytes of a store holding `dates` and `columns`, made from a .dat
+    file whose os.stat() was `st`."""
+    keys_json = json.dumps(keys).encode('utf-8')
+    nrows = len(dates)
+    layout = _Layout(keys_json, _capacity(nrows))
+    buf = bytearray(layout.size(len(keys)))
+    _header.pack_into(buf, 0, _magic, _byteorder, len(keys), nrows,
+                      layout.capacity, st.st_mtime_ns, st.st_size)
+    struct.pack_into('<I', buf, layout.keys_off, len(keys_json))
+    buf[layout.keys_off + 4:layout.keys_off + 4 + len(keys_json)] = keys_json
+    view = memoryview(buf)
+    view[layout.dates_off:layout.dates_off + 4 * nrows] = \
+        memoryview(dates).cast('B')
+    for k, column in enumerate(columns):
+        off = layout.column_off(k)
+        view[off:off + 8 * nrows] = memoryview(column).cast('B')
+    view.release()
+    return buf
+
+
+def _write(path, buf):
+    fd, tmp_path = tempfile.mkstemp(prefix='.cols-',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buf)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Columns(object):
+    """A store, over a buffer (usually the mmapped store file).
+
+    `keys` are the .dat file's keys, `dates` the dates of the rows (days
+    since 1970-01-01, see day_to_date()), and column(k) the values of the
+    k'th key; the latter two are memoryviews into the buffer, good until
+    close().
+    """
+
+    def __init__(self, buf, mapped=None):
+        self.mapped = mapped
+        self.buf = memoryview(buf)
+        self.dates = None
+        try:
+            (magic, byteorder, nkeys, self.nrows, capacity, self.dat_mtime,
+             self.dat_size) = _header.unpack_from(self.buf, 0)
+            (n,) = struct.unpack_from('<I', self.buf, _header.size)
+        except struct.error:
+            magic = None
+        if magic != _magic or byteorder != _byteorder:
+            self.close()
+            raise ValueError('not a store in this byte order')
+        keys_json = bytes(self.buf[_header.size + 4:_header.size + 4 + n])
+        self.keys = json.loads(keys_json.decode('utf-8'))
+        self.layout = _Layout(keys_json, capacity)
+        if len(self.keys) != nkeys or len(self.buf) < self.layout.size(nkeys):
+            self.close()
+            raise ValueError('truncated store')
+        off = self.layout.dates_off
+        self.dates = self.buf[off:off + 4 * self.nrows].cast('i')
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapped, mapped)
+        except ValueError:
+            mapped.close()
+            raise
+
+    def column(self, k):
+        off = self.layout.column_off(k)
+        return self.buf[off:off + 8 * self.nrows].cast('d')
+
+    def up_to_date(self, st):
+        return (self.dat_mtime, self.dat_size) == (st.st_mtime_ns, st.st_size)
+
+    def close(self):
+        # the views into the map have to go before it can be closed
+        if self.dates is not None:
+            self.dates.release()
+        self.buf.release()
+        if self.mapped is not None:
+            try:
+                self.mapped.close()
+            except BufferError:
+                # someone still has a column; the map goes with it
+                pass
+            self.mapped = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build(dat_file):
+    """(Re)build the store for `dat_file` and return it; None if the .dat
+    file can't be read or its dates aren't all mm/dd/yy. If the store can't
+    be written, the Columns returned are in memory."""
+    try:
+        st = os.stat(dat_file)
+        keys, dates, columns = read_dat(dat_file)
+    except (IOError, OSError, ValueError, IndexError):
+        # don't leave an out of date store behind
+        try:
+            os.unlink(store_name(dat_file))
+        except OSError:
+            pass
+        return None
+    buf = _pack(keys, dates, columns, st)
+    try:
+        _write(store_name(dat_file), buf)
+        return Columns.open(store_name(dat_file))
+    except (IOError, OSError, ValueError):
+        return Columns(buf)
+
+
+def load(dat_file):
+    """The store for `dat_file`, rebuilt first if it's missing or older than
+    the .dat file; None if there's no .dat file or it can't be stored."""
+    try:
+        st = os.stat(dat_file)
+    except OSError:
+        return None
+    try:
+        columns = Columns.open(store_name(dat_file))
+        if columns.up_to_date(st):
+            return columns
+        columns.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return build(dat_file)
+
+
+def append(dat_file, before, after, lines):
+    """Add `lines`, just appended to `dat_file`, to its store. They're read
+    just as build() would read them, so the store ends up the same either
+    way. `before` and `after` are os.stat()s of the .dat file from before
+    and after the lines were written. Unless the store was up to date with
+    `before` and has room, it's rebuilt instead."""
+    parser = _Parser()
+    try:
+        with open(store_name(dat_file), 'r+b') as f:
+            mapped = mmap.mmap(f.fileno(), 0)
+        try:
+            columns = Columns(mapped)
+        except ValueError:
+            mapped.close()
+            raise
+        try:
+            nkeys = len(columns.keys)
+            nrows = columns.nrows
+            layout = columns.layout
+            rows = [parser.row(line, nkeys) for line in lines]
+            rows = [row for row in rows if row is not None]
+            if (not columns.up_to_date(before) or
+                    nrows + len(rows) > layout.capacity):
+                raise ValueError('store needs rebuilding')
+            dates = array.array('i', [day for day, values in rows])
+            off = layout.dates_off + 4 * nrows
+            columns.buf[off:off + 4 * len(rows)] = memoryview(dates).cast('B')
+            for k in range(nkeys):
+                values = array.array('d', [v[k] for day, v in rows])
+                off = layout.column_off(k) + 8 * nrows
+                columns.buf[off:off + 8 * len(rows)] = \
+                    memoryview(values).cast('B')
+            # the header last, so that a store left half written looks
+            # out of date
+            _header.pack_into(columns.buf, 0, _magic, _byteorder, nkeys,
+                              nrows + len(rows), layout.capacity,
+                              after.st_mtime_ns, after.st_size)
+        finally:
+            columns.close()
+            mapped.close()
+    except (IOError, OSError, ValueError):
+        columns = build(dat_file)
+        if columns is not None:
+            columns.close()
+
+
+def _format_value(v):
+    if math.isnan(v):
+        return '-'
+    s = repr(v)
+    return s[:-2] if s.endswith('.0') else s
+
+
+def write_dat(columns, out):
+    """Write a store out in .dat form."""
+    out.write('# Date')
+    for key in columns.keys:
+        out.write('\t' + key)
+    out.write('\n')
+    values = [columns.column(k).tolist() for k in range(len(columns.keys))]
+    for row, day in enumerate(columns.dates.tolist()):
+        out.write(day_to_date(day).strftime(_date_format) + ' ')
+        for column in values:
+            out.write('\t' + _format_value(column[row]))
+        out.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert between performance .dat files and their '
+                    'columnar stores.')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build', help='(re)build the stores for .dat files')
+    build_parser.add_argument('dats', nargs='+')
+    dump_parser = subparsers.add_parser(
+        'dump', help='print the store for a .dat file in .dat form')
+    dump_parser.add_argument('dat')
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_usage()
+        return 2
+
+    status = 0
+    if args.command == 'build':
+        for dat in args.dats:
+            columns = build(dat)
+            if columns is None:
+                sys.stderr.write('[Error: cannot store {0}]\n'.format(dat))
+                status = 1
+            else:
+                columns.close()
+    else:
+        try:
+            columns = Columns.open(store_name(args.dat))
+        except (IOError, OSError, ValueError) as e:
+            sys.stderr.write('[Error: cannot read {0}: {1}]\n'.format(
+                store_name(args.dat), e))
+            return 1
+        with columns:
+            write_dat(columns, sys.stdout)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
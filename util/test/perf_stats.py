@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+"""
+Performance statistics for tests run with start_test -performance (and
+compiler performance runs).
+
+For every performance run of a test, the values of the keys listed in its
+.perfkeys file are looked up in the run's output and appended to the test's
+.dat file, one row per run. The .perfkeys file can also have verify/reject
+lines, patterns that the output has to (or must not) match for the run to
+count.
+
+sub_test keeps a PerfRecorder for each .dat file a test writes, so the key
+file is read and the .dat file's header checked once per test rather than
+once per trial, and rows go out through one buffered file. The rows are also
+added to the .dat file's columnar store (see perf_columns.py). computePerfStats
+is the command line version, for the nightly scripts and start_test.
+
+Usage:
+    computePerfStats test_name output_dir [keys_file [test_output_file
+                     [exec_time_out [perf_date]]]] [--verify-keys]
+"""
+
+from __future__ import print_function
+
+import argparse
+import difflib
+import os
+import re
+import string
+import sys
+import time
+
+import perf_columns
+
+
+class PerfStatsError(Exception):
+    """Something that stops a run's results from being recorded; `status`
+    is computePerfStats's exit status for it."""
+
+    def __init__(self, message, status):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# OUTPUT SCANNING
+#
+# A perfkey's value is the word after the key in the first line of output
+# that contains the key, after the last occurrence of the key if that line
+# has several. Searching the whole output for the literal key finds that
+# line without trying a regex against every line before it.
+
+_value_re = re.compile(r"\s*(\S*)")
+
+# backreferences in a verify/reject pattern count the (\s|\S) group the
+# pattern used to be prefixed with
+_backref_re = re.compile(r"\\[1-9]|\(\?P=")
+
+_verify_re = re.compile("(verify|reject):(?:(-?[1-9][0-9]*):)? ?(.+)")
+
+
+def _top_level_branch(regex):
+    r"""Whether `regex` has a | outside any group. The (\s|\S)* prefix only
+    applies to its first alternative; the others are anchored at the start
+    of the line. (The parsed pattern doesn't say, since alternatives of
+    single characters are turned into a character set.)"""
+    depth = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            # a ] right after [ or [^ is part of the set
+            i += 1
+            if regex[i:i + 1] == "^":
+                i += 1
+            if regex[i:i + 1] == "]":
+                i += 1
+            while i < len(regex) and regex[i] != "]":
+                if regex[i] == "\\":
+                    i += 1
+                i += 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth <= 0:
+            return True
+        i += 1
+    return False
+
+
+class OutputScanner(object):
+    """The test output, and the lines it's split into at "\\n"."""
+
+    def __init__(self, text):
+        self.text = text
+        self.lines = text.split("\n")
+
+    def find_key(self, key):
+        """The value of perfkey `key`, or None if no line has the key."""
+        text = self.text
+        pos = text.find(key)
+        if pos < 0:
+            return None
+        end = text.find("\n", pos)
+        if end < 0:
+            end = len(text)
+        # the key can't hold a newline, so this stays within the line
+        pos = text.rfind(key, pos, end)
+        return _value_re.match(text, pos + len(key), end).group(1)
+
+    def any_line(self, matches):
+        """Whether `matches` (from line_matcher()) holds for some line."""
+        for line in self.lines:
+            if matches(line):
+                return True
+        return False
+
+
+def line_matcher(regex):
+    r"""
+    A predicate telling whether a verify/reject pattern matches somewhere in
+    a line, i.e. re.match(r"(\s|\S)*" + regex, line), compiled once. That's
+    a search for the pattern unless it has backreferences or a top-level |,
+    which keep the prefix.
+    """
+    if _backref_re.search(regex) or _top_level_branch(regex):
+        return re.compile(r"(\s|\S)*" + regex).match
+    return re.compile(regex).search
+
+
+class Check(object):
+    """A verify/reject line of a key file."""
+
+    def __init__(self, key):
+        m = _verify_re.match(key)
+        if not m:
+            raise PerfStatsError(
+                "[Error: invalid verify/reject line '{0}']".format(key), 1)
+        self.is_reject = m.group(1) == "reject"
+        self.num = m.group(2)
+        self.regex = m.group(3)
+        self.matches = line_matcher(self.regex)
+
+    def run(self, scanner, output_file, out):
+        """Whether the output passes; says so on `out`."""
+        if not self.is_reject:
+            search_msg = "Checking for"
+            found_msg = "SUCCESS"
+            not_found_msg = "FAILURE"
+        else:
+            search_msg = "Checking for absence of"
+            found_msg = "FAILURE"
+            not_found_msg = "SUCCESS"
+
+        if self.num: # if there's a line number
+            out.write("{0} /{1}/ on line {2}... \n".format(
+                search_msg, self.regex, self.num))
+            try:
+                line = scanner.lines[int(self.num) - 1]
+            except IndexError:
+                raise PerfStatsError("[Error: {0} has no line {1}]".format(
+                    output_file, self.num), 1)
+            found = self.matches(line)
+        else: # no line number
+            out.write("{0} /{1}/ on any line... \n".format(
+                search_msg, self.regex))
+            found = scanner.any_line(self.matches)
+        out.write((found_msg if found else not_found_msg) + "\n")
+        return bool(found) != self.is_reject
+
+
+def read_key_file(keys_file):
+    """(keys, verify/reject lines, .dat file name from a "# file:" comment
+    or None) from a .perfkeys (or other) file."""
+    verify_keys = []
+    keys = []
+    data_file_name = None
+    with open(keys_file, "r") as file:
+        for line in file:
+            key = line.strip()
+            if not key:
+                continue
+            if not key[0] == "#": # not a comment
+                st_key = key[0:6]
+                if "verify" == st_key or "reject" == st_key:
+                    verify_keys.append(key)
+                else:
+                    keys.append(key)
+            else: # ignore comments unless they specify .dat
+                comment = key[1:].strip()
+                if comment[0:5] == "file:":
+                    data_file_name = comment.split()[1]
+
+    return (keys, verify_keys, data_file_name)
+
+
+def check_data_file(data_file, keys_exp, keys_file):
+    """Check that `data_file` has a header naming the keys `keys_exp` and
+    that every entry matches it."""
+    with open(data_file, "r") as file:
+        header = None
+        for line in file:
+            parsed = line.strip().split("\t")
+            if header == None and "# Date" in parsed[0]: # look for header line
+                header = parsed
+                columns = len(header)
+                keys_actual = header[1:]
+                continue
+            # ignore comments and empty lines
+            if parsed[0] == "" or "#" in parsed[0]:
+                continue
+            if header == None:
+                raise PerfStatsError("[Error: data entry prior to header or "
+                                     "missing header in {0}]".format(data_file), 2)
+            if len(parsed) != columns:
+                raise PerfStatsError("[Error: {0} entry for {1} doesn't match "
+                                     "header length.]".format(data_file, parsed[0]), 2)
+
+        if header == None: # not found
+            raise PerfStatsError("[Error: {0} has no header.]".format(data_file), 2)
+
+    keys_actual = [k.strip() for k in keys_actual]
+    keys_exp = [k.strip() for k in keys_exp]
+
+    s = difflib.SequenceMatcher(None, keys_actual, keys_exp)
+    diff = s.get_opcodes()
+
+    # the two aren't equal
+    if len(diff) > 1 or (len(diff) == 1 and diff[0][0] != "equal"):
+        msg = ["[Error: key mismatch between {0} and {1}]"
+               .format(keys_file, data_file),
+               "Changes since creation of .dat file:"]
+        for d in diff:
+            type = d[0]
+            if type == "equal":
+                continue
+            elif type == "delete":
+                for i in range(d[1], d[2]):
+                    msg.append("\t'{0}' has been removed.".format(keys_actual[i]))
+            elif type == "insert":
+                for i in range(d[3], d[4]):
+                    msg.append("\t'{0}' has been added.".format(keys_exp[i]))
+            elif type == "replace":
+                if d[2] - d[1] == 1: # singlular
+                    msg.append("\t'{0}' has been replaced with '{1}'.".format(
+                            keys_actual[d[1]], ", ".join(keys_exp[d[3]:d[4]])))
+                else: # plural
+                    msg.append("\t'{0}' have been replaced with '{1}'.".format(
+                        ", ".join(keys_actual[d[1]:d[2]]),
+                        ", ".join(keys_exp[d[3]:d[4]])))
+
+        raise PerfStatsError("\n".join(msg), 2)
+
+
+def _printable(s):
+    return ''.join(x if x in string.printable else "~" for x in s)
+
+
+def print_output(text, out):
+    """Show the output of a run that failed; if it's long, only the first
+    and last 1000 characters."""
+    out.write("output was: \n")
+    if len(text) > 2000:
+        out.write("(first 1000 followed by last 1000)\n")
+        out.write(_printable(text[:1000].strip()) + "\n")
+        out.write(" <truncated> \n")
+        out.write(_printable(text[-1000:].strip()) + "\n")
+    else:
+        out.write(_printable(text.strip()) + "\n")
+
+
+class PerfRecorder(object):
+    """Records the runs of one test in its .dat file, `test_name`.dat in
+    `output_dir` unless the key file names another one.
+
+    The key file is read, and the .dat file created and its header checked,
+    the first time they're needed; the .dat file then stays open until
+    close(), and rows are written to it buffered. close() also brings the
+    .dat file's columnar store up to date, unless `columns` is False.
+    """
+
+    def __init__(self, test_name, output_dir, keys_file=None, columns=True):
+        self.output_dir = output_dir
+        self.keys_file = keys_file or "{0}.perfkeys".format(test_name)
+        self.data_file = "{0}/{1}.dat".format(output_dir, test_name)
+        self.columns = columns
+        self.keys = None
+        self.checks = None
+        self.file = None
+        self.stat = None
+        self.rows = []
+        self.wrote = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _load_keys(self):
+        if self.keys is not None:
+            return
+        try:
+            keys, verify_keys, data_file_name = read_key_file(self.keys_file)
+        except (IOError, OSError) as e:
+            raise PerfStatsError("[Error: cannot read {0}: {1}]".format(
+                self.keys_file, e.strerror), 1)
+        if data_file_name:
+            self.data_file = os.path.join(self.output_dir, data_file_name)
+        self.keys = keys
+        self.verify_keys = verify_keys
+
+    def _open_data_file(self):
+        """Create the .dat file if it's new and check it if not."""
+        if self.file is not None:
+            return
+        try:
+            if not os.path.isfile(self.data_file):
+                with open(self.data_file, "a") as file:
+                    file.write("# Date")
+                    for key in self.keys:
+                        file.write("\t" + key)
+                    file.write("\n")
+            check_data_file(self.data_file, self.keys, self.keys_file)
+            self.stat = os.stat(self.data_file)
+            self.file = open(self.data_file, "a")
+        except (IOError, OSError) as e:
+            raise PerfStatsError("[Error: cannot open {0}: {1}]".format(
+                self.data_file, e.strerror), 2)
+
+    def verify_data_file(self, out=None):
+        """Check (or create) the .dat file; returns computePerfStats's exit
+        status."""
+        out = out or sys.stdout
+        try:
+            self._load_keys()
+            self._open_data_file()
+        except PerfStatsError as e:
+            out.write("{0}\n".format(e))
+            return e.status
+        out.write("Valid data file.\n")
+        return 0
+
+    def record(self, output_file, timed_out=False, date=None, out=None):
+        """Check the output in `output_file` and add a row with the values
+        of the keys to the .dat file (or a row saying the run timed out).
+        Progress goes to `out`; returns computePerfStats's exit status."""
+        out = out or sys.stdout
+        date = date or time.strftime("%m/%d/%y")
+        try:
+            self._load_keys()
+            try:
+                with open(output_file, "r", encoding="utf-8",
+                          errors="surrogateescape") as file:
+                    text = file.read()
+            except (IOError, OSError) as e:
+                raise PerfStatsError("[Error: cannot read {0}: {1}]".format(
+                    output_file, e.strerror), 1)
+            if self.checks is None:
+                self.checks = [Check(key) for key in self.verify_keys]
+            scanner = OutputScanner(text)
+
+            valid_output = True
+            for check in self.checks:
+                valid_output &= check.run(scanner, output_file, out)
+                if not valid_output:
+                    out.write("Error: Invalid output found in {0}\n".format(
+                        output_file))
+
+            found_everything = True
+            if valid_output:
+                self._open_data_file()
+                if timed_out:
+                    out.write("ERROR\n")
+                    self.wrote = True
+                    self.file.write("#{0} {1} ### EXECUTION TIMED OUT ###\n"
+                                    .format(date, "\t-" * len(self.keys)))
+                    return 1
+                found_everything = self._add_row(scanner, date, out)
+        except PerfStatsError as e:
+            out.write("{0}\n".format(e))
+            return e.status
+
+        if not (valid_output and found_everything) and not timed_out:
+            print_output(text, out)
+            return 1
+        return 0
+
+    def _add_row(self, scanner, date, out):
+        found_everything = True
+        row = ["{0} ".format(date)]
+        for key in self.keys:
+            out.write("Looking for {0}...".format(key))
+            value = scanner.find_key(key)
+            if value is not None:
+                out.write("found it: {0}\n".format(value))
+            else:
+                value = "-"
+                out.write("didn't find it\n")
+                found_everything = False
+            row.append("\t" + value)
+        row.append("\n")
+        row = "".join(row)
+        self.file.write(row)
+        self.rows.append(row)
+        self.wrote = True
+        return found_everything
+
+    def close(self):
+        """Flush the rows recorded so far and close the .dat file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if self.columns and self.wrote:
+                try:
+                    perf_columns.append(self.data_file, self.stat,
+                                        os.stat(self.data_file), self.rows)
+                except OSError:
+                    pass
+            self.rows = []
+            self.wrote = False
+
+
+# UTILITY FUNCTION FOR ARGUMENT PARSING
+def t_or_f(arg):
+    ua = str(arg).upper()
+    if "TRUE" in ua: return True
+    elif "FALSE" in ua: return False
+    else: return False
+
+
+def parser_setup():
+    parser = argparse.ArgumentParser(description="Compute performance"
+            "statistics")
+    parser.add_argument("test_name")
+    parser.add_argument("output_dir")
+    parser.add_argument("keys_file", nargs="?", default=False)
+    parser.add_argument("test_output_file", nargs="?", default=False)
+    parser.add_argument("exec_time_out", nargs="?", default=False, type=t_or_f)
+    parser.add_argument("perf_date", nargs="?", default=False)
+    parser.add_argument("-verify-keys", "--verify-keys", action="store_true",
+            dest="verify_keys")
+
+    return parser
+
+
+def main(argv=None):
+    """computePerfStats: record one run; returns the exit status."""
+    args = parser_setup().parse_args(argv)
+
+    if not args.test_output_file:
+        args.test_output_file = "{0}.exec.out.tmp".format(args.test_name)
+    if not args.perf_date:
+        args.perf_date = time.strftime("%m/%d/%y")
+        print("Using default date {0}".format(args.perf_date))
+    else:
+        print("Using set date {0}".format(args.perf_date))
+
+    with PerfRecorder(args.test_name, args.output_dir,
+                      args.keys_file) as recorder:
+        if args.verify_keys:
+            return recorder.verify_data_file()
+        return recorder.record(args.test_output_file, args.exec_time_out,
+                               args.perf_date)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
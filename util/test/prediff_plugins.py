@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+"""
+In-process versions of the prediff scripts shipped in util/test.
+
+A prediff (or preexec/precomp) script is run as
+
+    <script> <test executable name> <output file> <compiler> [...]
+
+and usually just filters the output file. Starting a shell or a Python
+interpreter for that costs far more than the filtering, and sub_test can run
+several of them for every variant of every test. The scripts registered here
+are run by sub_test in-process instead: each one is a function that takes the
+output text and returns the filtered text.
+
+sub_test runs a test's scripts through a Pipeline. Back to back plugins that
+edit the same file share one read and one write of it; anything that isn't a
+plugin (a test's own shell PREDIFF, say) is run as a subprocess as before,
+after the pending edits are written out.
+
+A script is run in-process when it resolves (through symlinks, e.g.
+foo.prediff -> $CHPL_HOME/util/test/sort-lines) to a registered script in this
+directory. The scripts themselves call main() below, so they still work
+when run directly.
+
+Output is handled as UTF-8 with undecodable bytes passed through unchanged,
+so binary output survives. Sorting compares code points, which is the byte
+order of the C locale start_test runs sort in.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import subprocess
+import sys
+
+import py3_compat
+
+_this_dir = os.path.dirname(os.path.realpath(__file__))
+
+_plugins = {}
+
+
+class Plugin(object):
+    """A registered script: `func(text, args)` returns the filtered text of
+    the file `target(args)` names (by default the output file, args[1])."""
+
+    def __init__(self, name, func, target):
+        self.name = name
+        self.func = func
+        self.target = target
+
+
+def register(name, target=None):
+    """Decorator registering a function as the in-process version of the
+    util/test script called `name`."""
+    def decorator(func):
+        _plugins[name] = Plugin(name, func, target or (lambda args: args[1]))
+        return func
+    return decorator
+
+
+def find(script):
+    """The plugin for `script` (a path), or None if it has to be run."""
+    path = os.path.realpath(script)
+    if os.path.dirname(path) != _this_dir:
+        return None
+    return _plugins.get(os.path.basename(path))
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8', 'surrogateescape')
+
+
+def _write(path, text):
+    with open(path, 'wb') as f:
+        f.write(text.encode('utf-8', 'surrogateescape'))
+
+
+class Pipeline(object):
+    """Runs a series of scripts on the same test's output, keeping the
+    output file in memory between plugins."""
+
+    def __init__(self):
+        self.path = None
+        self.text = None
+
+    def run(self, script, args):
+        """Run `script` with `args`; returns what it printed."""
+        plugin = find(script)
+        if plugin is None:
+            self.finish()
+            p = py3_compat.Popen([script] + list(args),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            return p.communicate()[0]
+
+        path = plugin.target(args)
+        if path != self.path:
+            self.finish()
+            try:
+                self.text = _read(path)
+            except (IOError, OSError) as e:
+                return '{0}: cannot open {1}: {2}\n'.format(
+                    plugin.name, path, e.strerror)
+            self.path = path
+        self.text = plugin.func(self.text, args)
+        return ''
+
+    def finish(self):
+        """Write out the pending edits."""
+        if self.path is not None:
+            _write(self.path, self.text)
+            self.path = None
+            self.text = None
+
+
+def main(argv):
+    """Entry point for the scripts: run the plugin named after the script
+    on the files named on the command line."""
+    pipeline = Pipeline()
+    output = pipeline.run(os.path.realpath(argv[0]), argv[1:])
+    pipeline.finish()
+    sys.stdout.write(output)
+    return 1 if output else 0
+
+
+#
+# Helpers
+#
+
+def _lines(text):
+    """Lines without their newlines, as sort and perl see them."""
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def _unlines(lines):
+    return ''.join(line + '\n' for line in lines)
+
+
+def _delete_lines(text, pattern):
+    """sed '/pattern/d': the last line keeps a missing newline."""
+    regex = re.compile(pattern)
+    return ''.join(line for line in text.splitlines(True)
+                   if not regex.search(line))
+
+
+def _grep_v(text, pattern):
+    """grep -v pattern: every line comes out newline terminated."""
+    regex = re.compile(pattern)
+    return _unlines(line for line in _lines(text) if not regex.search(line))
+
+
+def _remove_messages(text, msgs):
+    # The scripts these came from read the output in text mode, which
+    # turns \r\n and \r into \n; tests may count on that.
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    for m in msgs:
+        text = re.sub(m, '', text, flags=re.MULTILINE)
+    return text
+
+
+def _split(pattern, s):
+    """Perl's split: trailing empty fields are dropped."""
+    fields = re.split(pattern, s)
+    while fields and fields[-1] == '':
+        fields.pop()
+    return fields
+
+
+def _exec_out(args):
+    # the sort-words scripts always work on the default execution output
+    return args[0] + '.exec.out.tmp'
+
+
+#
+# The scripts
+#
+
+@register('sort-lines')
+def sort_lines(text, args):
+    return _unlines(sorted(_lines(text)))
+
+
+@register('sort-lines-uniq')
+def sort_lines_uniq(text, args):
+    return _unlines(sorted(set(_lines(text))))
+
+
+@register('sort-words-within-lines', target=_exec_out)
+def sort_words_within_lines(text, args):
+    return _unlines(' '.join(sorted(_split(' +|[{}]', line)))
+                    for line in _lines(text))
+
+
+def _sort_literal(m):
+    inner = ', '.join(sorted(_split(', *', m.group(3))))
+    return m.group(1) + m.group(2) + inner + m.group(4)
+
+
+@register('sort-words-within-literals', target=_exec_out)
+def sort_words_within_literals(text, args):
+    out = []
+    for line in _lines(text):
+        line = re.sub(r'(\{)( *)([^\}]*)(\})', _sort_literal, line)
+        line = re.sub(r'(\[)( *)([^\]]*)(\])', _sort_literal, line)
+        out.append(line)
+    return _unlines(out)
+
+
+@register('prediff-ignore-remarks')
+def ignore_remarks(text, args):
+    text = _delete_lines(text, '^remark:')
+    return _delete_lines(text, 'loop not vectorized:')
+
+
+@register('prediff-for-Jira-203')
+def jira_203(text, args):
+    return _delete_lines(text, 'Transient MPP reservation error')
+
+
+@register('prediff-for-knl_unexpected_cache_size')
+def knl_unexpected_cache_size(text, args):
+    text = _delete_lines(text, 'Unexpected KNL MCDRAM cache size')
+    return jira_203(text, args)
+
+
+@register('prediff-for-lsf')
+def lsf(text, args):
+    return text.replace('\r', '')
+
+
+@register('prediff-for-pbs-aprun')
+def pbs_aprun(text, args):
+    return _grep_v(text, 'stty -onlcr; aprun -q -cc')
+
+
+@register('prediff-for-aprun-with-moab')
+def aprun_with_moab(text, args):
+    # mandelbrot's output is binary
+    if args[0].startswith('mandelbrot'):
+        return text
+    return _grep_v(text, '.*/cray-ccm-epilogue: line .*: echo: write error: '
+                         'Broken pipe')
+
+
+_slurm_msgs = (
+r"""srun: error: .+: task [0-9]+: Exited with exit code [0-9]+
+""",
+r"""srun: error: .+: task [0-9]+: (Killed|Terminated)
+""",
+r"""srun: (Force Terminated|Terminating) job step [0-9.]+
+""",
+r"""srun: Job step aborted: Waiting up to [0-9]+ seconds for job step .*
+""",
+r"""slurmstepd: error: \*\*\* STEP [0-9.]+ ON .+ CANCELLED AT [-0-9T.:]+ \*\*\*
+""",
+r"""slurmstepd: error: .+ \[[0-9]+] .*
+""",
+r"""srun: error: spank: /opt/cray/.*: Plugin file not found
+""",
+r"""cp: cannot create regular file .*/[.]module/PrgEnv-.*: File exists
+""",
+r"""cp: failed to close .*/[.]module/PrgEnv-.*: Stale file handle
+""",
+r"""diff: .*/[.]module/PrgEnv-.*: No such file or directory
+""",
+)
+
+
+@register('prediff-for-slurm')
+def slurm(text, args):
+    return _remove_messages(text, _slurm_msgs)
+
+
+_ucx_msg = """ WARNING: ucx-conduit is experimental and should not be used for
+          performance measurements.
+          Please see `ucx-conduit/README` for more details.
+"""
+
+
+@register('prediff-for-ucx')
+def ucx(text, args):
+    return _remove_messages(text, (_ucx_msg,))
+
+
+# mpirun's reports of processes exiting with a non-zero status
+_mpirun_msgs = (
+r"""-------------------------------------------------------
+Primary job +terminated normally, but [0-9]+ process[^ ]* returned
+a non-zero exit code[.]+ Per user-direction, the job has been aborted[.]
+-------------------------------------------------------
+""",
+r"""--------------------------------------------------------------------------
+mpirun detected that one or more processes exited with non-zero status, thus causing
+the job to be terminated[.] The first process to do so was:
+
+ *Process name: +\[\[[0-9]+,[0-9]+],[0-9]+]
+ *Exit code: +[0-9]+
+--------------------------------------------------------------------------
+""",
+r"""-------------------------------------------------------
+While the primary job +terminated normally, [0-9]+ process[^ ]* returned
+a non-zero exit code[.]+ Further examination may be required[.]
+-------------------------------------------------------
+""",
+r"""--------------------------------------------------------------------------
+mpirun has exited due to process rank [0-9]+ with PID [0-9]+ on
+node [^ ]+ exiting improperly[.] There are three reasons this could occur:
+
+1[.] this process did not call "init" before exiting, but others in
+the job did[.] This can cause a job to hang indefinitely while it waits
+for all processes to call "init"[.] By rule, if one process calls "init",
+then ALL processes must call "init" prior to termination[.]
+
+2[.] this process called "init", but exited without calling "finalize"[.]
+By rule, all processes that call "init" MUST call "finalize" prior to
+exiting or it will be considered an "abnormal termination"
+
+3[.] this process called "MPI_Abort" or "orte_abort" and the mca parameter
+orte_create_session_dirs is set to false[.] In this case, the run-time cannot
+detect that the abort call was an abnormal termination[.] Hence, the only
+error message you will receive is this one[.]
+
+This may have caused other processes in the application to be
+terminated by signals sent by mpirun [(]as reported here[)][.]
+
+You can avoid this message by specifying -quiet on the mpirun command line.
+
+--------------------------------------------------------------------------
+"""
+)
+
+
+@register('prediff-for-mpirun4ofi')
+def mpirun4ofi(text, args):
+    return _remove_messages(text, _mpirun_msgs)
@@ -0,0 +1,355 @@
+"""
+Opt-in cache of test results, used by sub_test when $CHPL_TEST_RESULT_CACHE_DIR
+is set (start_test --cache-dir).
+
+Each test file gets a fingerprint built from everything that can change its
+outcome:
+
+  - the toolchain: the contents of the compiler's bin directory (chpl,
+    chpldoc) plus the size/mtime of every file under $CHPL_HOME/modules,
+    runtime/include, lib and the third-party install trees,
+  - the chplenv snapshot and the relevant environment variables,
+  - every file in the test directory except what sub_test itself leaves
+    there (the directory's test executables and their _real/variant
+    copies, *.tmp logs), so data files the test reads count too,
+  - the source files in the directory's subdirectories and in the
+    directories the compile options search (-M, -I, -L, --module-dir and
+    $CHPL_MODULE_PATH),
+  - the system-wide prediffs/preexecs.
+
+Files a test writes into its own directory while it runs change the
+fingerprint of the directory's tests, so such tests simply aren't replayed.
+
+The fingerprint covers all of a test's compopts/execopts variants, since
+they're produced together. When every variant of a test passed, the log lines
+sub_test wrote for it are stored under the fingerprint, and a later run with the
+same fingerprint replays those lines instead of compiling and running anything.
+
+Rules for bypassing the cache (no lookup, nothing stored):
+  - performance tests, since their output is timing data,
+  - futures, which are expected to fail in unpredictable ways,
+  - tests with an executable .skipif, which can consult arbitrary state,
+  - any test with a failure, timeout or other error; only passes are cached,
+    so a failure is always rerun.
+
+Recording happens at the file descriptor level, so output that child
+processes write straight to sub_test's stdout (or to its stderr, when that
+goes to the same place) is replayed as well.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+import tempfile
+import threading
+
+import chplenv_cache
+
+# Environment variables (beyond CHPL_*) that can change a test's behavior.
+_env_prefixes = ('CHPL_', 'GASNET_', 'QT_', 'FI_', 'MPIR_', 'SLURM_')
+_env_vars = ('LAUNCHCMD', 'PATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH', 'CPATH',
+             'CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS')
+
+# Harness variables that differ from run to run without affecting results.
+_volatile_env_vars = ('CHPL_TEST_TMP_DIR', 'CHPL_TEST_CHPLENV_SNAPSHOT',
+                      'CHPL_TEST_CHPLENV_CACHE_DIR', 'CHPL_TEST_RESULT_CACHE_DIR',
+                      'CHPL_TEST_CACHE_TOOLCHAIN_KEY', 'CHPL_ONETEST',
+                      'CHPL_TEST_SUB_TEST_SERVER', 'CHPL_TEST_TRACE_DIR',
+                      'CHPL_TEST_HALT_FILE')
+
+# Trees (relative to CHPL_HOME) that go into the toolchain fingerprint.
+_toolchain_trees = ('modules', os.path.join('runtime', 'include'), 'lib')
+
+# Source files (and prebuilt objects/libraries) a test may depend on through
+# `use`/`require` or the compiler's search paths.
+source_exts = ('.chpl', '.h', '.hpp', '.c', '.cc', '.cpp', '.o', '.a', '.so')
+
+# Compiler options naming a directory to search: -M/--module-dir for modules,
+# -I for headers, -L for libraries. The values of --ccflags/--ldflags are
+# searched for them as well.
+_search_opts = ('-M', '-I', '-L', '--module-dir')
+_flag_opts = ('--ccflags', '--ldflags')
+
+# What sub_test leaves in a test directory: the executables (possibly with a
+# pid and/or compopts variant number appended), their _real and launch time
+# files, and the .tmp logs.
+_artifact_re = re.compile(r'^(.*?)((?:\.\d+)*)(?:_real|_launchcmd_exec_time\.txt)?$')
+
+# How long to wait for processes a test left behind to let go of the
+# recording pipe.
+_drain_timeout = 5
+
+# Content digests of files under hashed trees, by (path, inode, size, mtime).
+_digests = {}
+
+
+def hash_file(h, path):
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    except (IOError, OSError):
+        h.update(b'<unreadable>')
+
+
+def stat_tree(h, root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            h.update('{0} {1} {2}\n'.format(path, st.st_size,
+                                            st.st_mtime_ns).encode('utf-8'))
+
+
+def _digest(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return b'<unreadable>'
+    stamp = (os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns)
+    if stamp not in _digests:
+        d = hashlib.sha1()
+        hash_file(d, path)
+        _digests[stamp] = d.digest()
+    return _digests[stamp]
+
+
+def hash_tree(h, root):
+    """Hash the contents of the source files (source_exts) under `root`."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(source_exts):
+                path = os.path.join(dirpath, name)
+                h.update(b'\0' + path.encode('utf-8', 'surrogateescape') + b'\0')
+                h.update(_digest(path))
+
+
+def search_paths(args, environ=None):
+    """Directories a compile with arguments `args` searches for sources.
+
+    These are the ones named by -M, -I or -L (as `-M dir` or `-Mdir`) or by
+    --module-dir, also inside --ccflags/--ldflags, followed by those on
+    $CHPL_MODULE_PATH. Paths are made absolute; ones that aren't
+    directories are dropped.
+    """
+    if environ is None:
+        environ = os.environ
+    words = list(args)
+    found = []
+    i = 0
+    while i < len(words):
+        word = words[i]
+        i += 1
+        for opt in _search_opts + _flag_opts:
+            if word == opt:
+                value = words[i] if i < len(words) else ''
+                i += 1
+            elif opt.startswith('--') and word.startswith(opt + '='):
+                value = word[len(opt)+1:]
+            elif not opt.startswith('--') and word.startswith(opt):
+                value = word[len(opt):]
+            else:
+                continue
+            if opt in _flag_opts:
+                try:
+                    words[i:i] = shlex.split(value)
+                except ValueError:
+                    words[i:i] = value.split()
+            else:
+                found.append(value)
+            break
+    found += environ.get('CHPL_MODULE_PATH', '').split(':')
+
+    paths = []
+    for path in found:
+        path = os.path.abspath(path) if path else None
+        if path and path not in paths and os.path.isdir(path):
+            paths.append(path)
+    return paths
+
+
+def toolchain_key(compiler, chpl_home):
+    """Fingerprint of the compiler, modules, runtime and third-party builds.
+
+    The compiler's directory is hashed by content; the (much larger) trees
+    under CHPL_HOME by path, size and mtime.
+    """
+    h = hashlib.sha1()
+    bindir = os.path.dirname(os.path.abspath(compiler))
+    for name in sorted(os.listdir(bindir)):
+        path = os.path.join(bindir, name)
+        if os.path.isfile(path):
+            h.update(name.encode('utf-8'))
+            hash_file(h, path)
+
+    for tree in _toolchain_trees:
+        stat_tree(h, os.path.join(chpl_home, tree))
+    third_party = os.path.join(chpl_home, 'third-party')
+    if os.path.isdir(third_party):
+        for pkg in sorted(os.listdir(third_party)):
+            stat_tree(h, os.path.join(third_party, pkg, 'install'))
+    return h.hexdigest()
+
+
+def environment_key(environ=None):
+    """Fingerprint of the chplenv snapshot and relevant environment."""
+    if environ is None:
+        environ = os.environ
+    h = hashlib.sha1()
+    for var, val in sorted(chplenv_cache.get().items()):
+        h.update('{0}={1}\n'.format(var, val).encode('utf-8'))
+    for var in sorted(environ):
+        if var in _volatile_env_vars:
+            continue
+        if var.startswith(_env_prefixes) or var in _env_vars:
+            h.update('{0}={1}\n'.format(var, environ[var]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def is_artifact(name, execnames):
+    """Whether `name` is something sub_test leaves in a test directory whose
+    tests build the executables `execnames`."""
+    return (name.endswith('.tmp') or
+            _artifact_re.match(name).group(1) in execnames)
+
+
+def test_key(base_key, testname, dirlist, execnames, compile_args,
+             extra_files=()):
+    """Fingerprint of one test file and all of its variants.
+
+    `base_key` combines the toolchain and environment keys, `dirlist` is the
+    (sorted) contents of the test directory, `execnames` the executable names
+    of all of its tests (see is_artifact()), `compile_args` the arguments of
+    all of the test's compiles and `extra_files` other files the test's
+    result depends on (e.g. system-wide prediffs).
+    """
+    h = hashlib.sha1()
+    h.update(base_key.encode('utf-8'))
+    h.update(os.getcwd().encode('utf-8'))
+    h.update(testname.encode('utf-8'))
+
+    for name in dirlist:
+        if os.path.isdir(name):
+            hash_tree(h, name)
+        elif not is_artifact(name, execnames) and os.path.isfile(name):
+            h.update(b'\0' + name.encode('utf-8', 'surrogateescape') + b'\0')
+            hash_file(h, name)
+    for path in search_paths(compile_args):
+        hash_tree(h, path)
+    for path in extra_files:
+        h.update(b'\0' + path.encode('utf-8') + b'\0')
+        hash_file(h, path)
+    return h.hexdigest()
+
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + '.json')
+
+
+def lookup(cache_dir, key):
+    """Return the recorded output for `key`, or None."""
+    try:
+        with open(_entry_path(cache_dir, key), 'r') as f:
+            return json.load(f)['output']
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def store(cache_dir, key, test, output):
+    """Record `output` for `key`. Failures to write are ignored."""
+    path = _entry_path(cache_dir, key)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.entry-',
+                                        dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'test': test, 'output': output}, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def cacheable_output(output):
+    """Only fully successful tests are cached, and only if all of their
+    output was recorded."""
+    return output is not None and '[Error' not in output
+
+
+class Recorder(object):
+    """Copies everything written to file descriptor 1 (by sub_test or by any
+    process it starts) while passing it through.
+
+    fd 2 is recorded too when it goes to the same place as fd 1, as it does
+    under start_test.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fds = [1]
+        try:
+            out, err = os.fstat(1), os.fstat(2)
+            if (out.st_dev, out.st_ino) == (err.st_dev, err.st_ino):
+                fds.append(2)
+        except OSError:
+            pass
+        self.saved = [(fd, os.dup(fd)) for fd in fds]
+        read_fd, write_fd = os.pipe()
+        for fd in fds:
+            os.dup2(write_fd, fd)
+        os.close(write_fd)
+        self.copier = threading.Thread(target=self._copy, args=(read_fd,))
+        self.copier.daemon = True
+        self.copier.start()
+        # sub_test may exit mid-test; pass on what's still in the pipe
+        atexit.register(self.stop)
+
+    def _copy(self, read_fd):
+        out_fd = self.saved[0][1]
+        while True:
+            data = os.read(read_fd, 64 * 1024)
+            if not data:
+                break
+            self.chunks.append(data)
+            while data:
+                data = data[os.write(out_fd, data):]
+        os.close(read_fd)
+
+    def stop(self):
+        """Put the file descriptors back. Returns the recorded output, or
+        None if something still holds the pipe so it can't all be read."""
+        if self.saved is None:
+            return None
+        atexit.unregister(self.stop)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in self.saved:
+            os.dup2(saved_fd, fd)
+        self.copier.join(_drain_timeout)
+        if self.copier.is_alive():
+            # leave the copier its descriptor; it's still passing output on
+            self.saved = None
+            return None
+        for fd, saved_fd in self.saved:
+            os.close(saved_fd)
+        self.saved = None
+        return b''.join(self.chunks).decode('utf-8', 'surrogateescape')
+
+
+def start_recording():
+    return Recorder()
+
+
+def stop_recording(recorder):
+    return recorder.stop()
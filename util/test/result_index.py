@@ -0,0 +1,217 @@
+"""
+Structured index of a start_test run, built as the log is written.
+
+start_test's Logger hands every line it writes to the log to ResultIndex.add(),
+which
+
+  - keeps the counts and the failure/suppression/future/warning lines that
+    make up the end-of-run summary, so summarize() doesn't have to read the
+    log back in and match every line against each marker,
+  - writes a JSON Lines file next to the log (<log>.results.jsonl) with one
+    record per test as soon as the test finishes, carrying the running counts
+    so that progress can be followed during a run.
+
+Records:
+
+  {"type": "start", "time": ...}
+  {"type": "test", "test": <path from the "[test: ...]" line>,
+   "time": <seconds>, "skipped": bool, "errors": [...], "warnings": [...],
+   "start": <log offset>, "end": <log offset>, "counts": {...}}
+  {"type": "end", "counts": {...}, "log_size": <bytes>, "first_line": ...}
+
+A test spans the lines from its "[test: ...]" line through its "[Elapsed
+time to compile and execute all versions of ...]" (or "[Skipping ...") line,
+the same blocks convert_start_test_log_to_junit_xml.py cuts the log into; the
+offsets let it read a test's output straight out of the log.
+"""
+
+import json
+import re
+import time
+
+# Same patterns convert_start_test_log_to_junit_xml.py uses.
+_error_re = re.compile(r'\[Error', re.IGNORECASE)
+_warning_re = re.compile(r'\[Warning', re.IGNORECASE)
+_time_re = re.compile(r' - (?P<time>-?\d+\.\d+) seconds\]$')
+
+_newline_re = re.compile(r'\r\n|\r|\n')
+
+_subtest_start = '[Starting subtest - '
+_subtest_end = '[Finished subtest '
+_test_start = '[test: '
+_test_end = '[Elapsed time to compile and execute all versions of "'
+_test_skipped = '[Skipping'
+_noperf_skipped = '[Skipping noperf test:'
+
+_count_names = ('successes', 'failures', 'futures', 'warnings',
+                'passing_suppressions', 'passing_futures',
+                'skip_stdin_redirects')
+
+
+class ResultIndex(object):
+    """Summary counts and per-test records for one log.
+
+    `success_marker` is the text that marks a success ("[Success matching",
+    "[Success compiling" or "[Success generating", depending on the run).
+    `path` is where to write the JSON Lines records, or None for counts only.
+    """
+
+    def __init__(self, success_marker, path=None):
+        self.success_re = re.compile(re.escape(success_marker))
+        self.passing_suppression_re = re.compile(
+            'Suppress.*' + re.escape(success_marker))
+        self.passing_future_re = re.compile(
+            'Future.*' + re.escape(success_marker))
+        self.skip_stdin_redirect_re = re.compile(
+            r'\[Skipping test with .stdin input')
+
+        self.counts = dict((name, 0) for name in _count_names)
+        self.failure_lines = []
+        self.suppression_lines = []
+        self.future_lines = []
+        self.warning_lines = []
+
+        self.closed = False
+        self.offset = 0
+        self.first_line = None
+        self.in_subtest = False
+        self.test = None
+
+        self.out = None
+        if path:
+            self.out = open(path, 'w')
+            self._emit({'type': 'start', 'time': time.time()})
+
+    def _emit(self, record):
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def add(self, msg, end_offset):
+        """Note a message the log just got; `end_offset` is where the log
+        ends after it."""
+        if self.closed:
+            return
+        for line in _newline_re.split(msg):
+            self._count(line)
+            if self.out is not None:
+                self._track(line, end_offset)
+        self.offset = end_offset
+
+    def _count(self, line):
+        if self.first_line is None:
+            self.first_line = line
+        counts = self.counts
+        if line.startswith('[Error'):
+            self.failure_lines.append(line + '\n')
+            counts['failures'] += 1
+        elif line.startswith('Suppress'):
+            self.suppression_lines.append(line + '\n')
+        elif line.startswith('Future'):
+            self.future_lines.append(line + '\n')
+            counts['futures'] += 1
+        elif line.startswith('[Warning'):
+            self.warning_lines.append(line + '\n')
+            counts['warnings'] += 1
+        elif self.success_re.match(line):
+            counts['successes'] += 1
+        if self.passing_suppression_re.match(line):
+            counts['passing_suppressions'] += 1
+        elif self.passing_future_re.match(line):
+            counts['passing_futures'] += 1
+        elif self.skip_stdin_redirect_re.match(line):
+            counts['skip_stdin_redirects'] += 1
+
+    def _track(self, line, end_offset):
+        # Messages are logged whole, so a test's block starts at the
+        # beginning of the message holding its "[test: " line and ends
+        # after the message holding the end line.
+        if line.startswith(_subtest_start):
+            self.in_subtest = True
+        elif not self.in_subtest:
+            return
+
+        test = self.test
+        if test is None:
+            if line.startswith(_test_start):
+                self.test = {'test': line[len(_test_start):].split(']')[0],
+                             'start': self.offset, 'errors': [],
+                             'warnings': []}
+            elif line.startswith(_subtest_end):
+                self.in_subtest = False
+            return
+
+        if _error_re.match(line):
+            test['errors'].append(line)
+        elif _warning_re.match(line):
+            test['warnings'].append(line)
+
+        if line.startswith(_test_end) or line.startswith(_subtest_end):
+            m = _time_re.search(line)
+            self._finish_test(max(float(m.group('time')), 0.0) if m else 0.0,
+                              False, end_offset)
+            if line.startswith(_subtest_end):
+                self.in_subtest = False
+        elif line.startswith(_noperf_skipped):
+            # not a real test for performance runs; no record
+            self.test = None
+        elif line.startswith(_test_skipped):
+            test['errors'] = []
+            test['warnings'] = []
+            self._finish_test(0.0, True, end_offset)
+
+    def _finish_test(self, secs, skipped, end_offset):
+        record = self.test
+        self.test = None
+        record.update({'type': 'test', 'time': secs, 'skipped': skipped,
+                       'end': end_offset, 'counts': self.counts})
+        self._emit(record)
+
+    def summary(self, date_str):
+        """The end-of-run summary start_test logs and writes to the .summary
+        file."""
+        counts = self.counts
+        parts = ['[Test Summary - {0}]\n'.format(date_str)]
+        parts += self.failure_lines
+        parts += self.suppression_lines
+        parts += self.future_lines
+        parts += self.warning_lines
+        parts.append('[Summary: #Successes = {0} | #Failures = {1} | '
+                     '#Futures = {2} | #Warnings = {3} ]\n'.format(
+                         counts['successes'], counts['failures'],
+                         counts['futures'], counts['warnings']))
+        parts.append('[Summary: #Passing Suppressions = {0} | '
+                     '#Passing Futures = {1} ]\n'.format(
+                         counts['passing_suppressions'],
+                         counts['passing_futures']))
+        parts.append('[END]\n')
+        return ''.join(parts)
+
+    def close(self):
+        """Stop indexing; later messages aren't counted."""
+        if self.out is not None:
+            self._emit({'type': 'end', 'counts': self.counts,
+                        'log_size': self.offset,
+                        'first_line': self.first_line})
+            self.out.close()
+            self.out = None
+        self.closed = True
+
+
+def index_path(log_file):
+    """Where the index for `log_file` is written."""
+    return log_file + '.results.jsonl'
+
+
+def read(path):
+    """Return the records of a complete index, or None if `path` is missing
+    or was never finished."""
+    records = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                records.append(json.loads(line))
+    except (IOError, OSError, ValueError):
+        return None
+    if not records or records[-1].get('type') != 'end':
+        return None
+    return records
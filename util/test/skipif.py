@@ -0,0 +1,118 @@
+"""
+In-process evaluation of .skipif/.suppressif/SKIPIF files.
+
+This does what the testEnv script does, without a perl process (and, before
+the chplenv snapshot was cached, a printchplenv run) per file:
+
+  - the environment is ours with the chplenv snapshot laid over it
+    (except for CHPL_HOME),
+  - an executable file is run and its output is the result,
+  - otherwise each line is a condition, and the result is 1 if any of them
+    holds, else 0. Lines are `VAR == value`, `VAR != value`, `VAR <= regex`
+    (VAR matches regex) or `VAR >= regex` (VAR doesn't match). Blank lines
+    and lines containing a '#' are ignored.
+
+evaluate() returns what testEnv would have printed and raises SkipIfError
+(a RuntimeError) where testEnv would have failed. With `strict` set, as
+sub_test uses it, anything an executable file writes to stderr is an error
+as well; otherwise its stderr is passed on, as start_test has always done.
+Results for condition files are memoized on the file contents and the values
+of the variables they mention.
+"""
+
+import hashlib
+import os
+import re
+import subprocess
+
+import chplenv_cache
+
+_blank_re = re.compile(r'^\s*$')
+_condition_re = re.compile(r'(\w*)\s*(.)=\s*(\S*)', re.ASCII)
+
+# (content hash, ((var, value), ...)) -> result
+_memo = {}
+
+
+class SkipIfError(RuntimeError):
+    pass
+
+
+def skipif_environment(util_dir=None):
+    """Return the environment skipif files are evaluated in."""
+    env = dict(os.environ)
+    for var, val in chplenv_cache.get(util_dir).items():
+        if var != 'CHPL_HOME':
+            env[var] = val
+    return env
+
+
+def _parse(text):
+    """Return the list of (var, op, value) conditions in `text`."""
+    conditions = []
+    for line in text.split('\n'):
+        if _blank_re.match(line) or '#' in line:
+            continue
+        m = _condition_re.search(line)
+        if not m or m.group(2) not in ('=', '!', '<', '>'):
+            raise SkipIfError('badly formatted line: {0}\nexit status 1'
+                              .format(line))
+        conditions.append(m.groups())
+    return conditions
+
+
+def _holds(env, var, op, value):
+    actual = env.get(var, '')
+    if op == '=':
+        return actual == value
+    if op == '!':
+        return actual != value
+    try:
+        matches = re.search(value, actual) is not None
+    except re.error as e:
+        raise SkipIfError('bad regex "{0}": {1}'.format(value, e))
+    return matches if op == '<' else not matches
+
+
+def _run_executable(path, env, strict=False):
+    p = subprocess.Popen([os.path.abspath(path)], env=env,
+                         stdout=subprocess.PIPE,
+                         stderr=(subprocess.PIPE if strict else None))
+    stdout, stderr = p.communicate()
+    stdout = stdout.decode('utf-8', 'replace')
+    stderr = (stderr or b'').decode('utf-8', 'replace').strip()
+    if stderr or p.returncode:
+        errmsg = stderr
+        if p.returncode:
+            if stderr:
+                errmsg += '\n'
+            errmsg += 'exit status {0}'.format(p.returncode)
+        raise SkipIfError(errmsg)
+    return stdout
+
+
+def evaluate(path, util_dir=None, strict=False):
+    """Evaluate the skipif file at `path`, returning its output ('1\\n' or
+    '0\\n' for condition files)."""
+    if os.access(path, os.X_OK):
+        return _run_executable(path, skipif_environment(util_dir), strict)
+
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError) as e:
+        raise SkipIfError("can't open {0} {1}\nexit status 2".format(
+            path, e.strerror))
+
+    conditions = _parse(content.decode('utf-8', 'surrogateescape'))
+    env = skipif_environment(util_dir)
+    key = (hashlib.sha1(content).hexdigest(),
+           tuple((var, env.get(var)) for var, _, _ in conditions))
+    if key not in _memo:
+        # every condition is checked (as testEnv does) so that a bad regex
+        # is reported even after a condition that holds
+        results = [_holds(env, var, op, value)
+                   for var, op, value in conditions]
+        skip = any(results)
+        _memo[key] = '{0}\n'.format(1 if skip else 0)
+    return _memo[key]
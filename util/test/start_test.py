@@ -10,10 +10,10 @@ import contextlib
 import fnmatch
 import getpass
 import glob
+import json
 import logging
 import os
 import platform
-import re
 import shutil
 import subprocess
 import sys
@@ -39,8 +39,16 @@ fixpath.update_path_env()
 from chplenv import *
 
 # these are in the test/ directory with us
+import build_cache
+import chplenv_cache
+import circuit_breaker
+import harness_trace
 import py3_compat
 import re2_supports_valgrind
+import result_cache
+import result_index
+import skipif
+import test_manifest
 
 import argparse
 try:
@@ -74,6 +82,7 @@ def main():
 
 def run_tests(tests):
     set_up_tmpdir()
+    set_up_trace()
     set_up_logger()
 
     files = []
@@ -98,6 +107,11 @@ def run_tests(tests):
     set_up_performance_testing_A() # A and B are separate in order to keep
                                    # output the same from old start_test
     set_up_executables()
+    with harness_trace.span("chplenv"):
+        set_up_chplenv_cache()
+    set_up_result_cache()
+    set_up_manifest()
+    set_up_breakers()
     set_up_performance_testing_B()
 
     # autogenerate tests from spec if no tests were given
@@ -129,6 +143,8 @@ def run_tests(tests):
     os.environ["CHPL_TEST_SINGLES"] = "1"
 
     for test in files:
+        if stopping():
+            break
         test_file(test)
 
     os.environ["CHPL_TEST_FUTURES"] = str(args.futures_mode)
@@ -144,9 +160,28 @@ def run_tests(tests):
         else:
             testruns = ["run"]
 
+    # smoke tests go first, and any failure in them stops the run
+    smoke_dirs = []
+    for smoke in args.smoke_tests or []:
+        if os.path.isdir(smoke):
+            smoke_dirs.append(os.path.abspath(smoke))
+        else:
+            logger.write("[Error: smoke test directory {0} is not a directory]"
+                    .format(smoke))
+    if smoke_dirs:
+        failures_before = logger.index.counts["failures"]
+        for tests in smoke_dirs:
+            logger.write("[Running smoke tests in {0}]".format(tests))
+            for t in testruns:
+                test_directory(tests, t)
+        smoke_failures = logger.index.counts["failures"] - failures_before
+        if smoke_failures > 0 and stop_reason is None:
+            stop(circuit_breaker.smoke_failed(smoke_failures,
+                                              " ".join(args.smoke_tests)))
+
     for tests in dirs:
         for t in testruns:
-            test_directory(tests, t)
+            test_directory(tests, t, skip=smoke_dirs)
 
     # test and graph compiler performance
     if args.comp_performance:
@@ -156,12 +191,19 @@ def run_tests(tests):
     if args.gen_graphs:
         generate_graph_files_graphs()
 
+    manifest.save()
+
 
 # ESCAPE ROUTINES AND CLEAN-UP
 
 def finish():
+    # shut down the persistent sub_test, if any
+    stop_sub_test_server()
+
     # summarize
     if not args.clean_only:
+        # a stop during the last directory hasn't been logged yet
+        stopping()
         summarize()
     else:
         logger.write("[Summary: CLEAN ONLY]")
@@ -169,6 +211,9 @@ def finish():
     logger.write()
     logger.stop()
 
+    # merge the harness trace before the tmp dir goes away
+    finish_trace()
+
     # copy log from per-pid location (if needed) and remove tmp dir
     cleanup()
 
@@ -217,11 +262,21 @@ def test_file(test):
                 generate_graphs(test)
 
 
-def test_directory(test, test_type):
+def test_directory(test, test_type, skip=()):
+    if stopping():
+        return
     logger.write("[Working from directory {0}]".format(test))
 
+    # list the whole tree up front, in parallel; the walk below still
+    # checks each directory's listing as it gets to it
+    if args.recurse:
+        with harness_trace.span("scan", dir=test):
+            manifest.scan(test)
+
     # recurse through directory
-    for root, dirs, files in os.walk(test):
+    for root, dirs, files in manifest.walk(test):
+        if stopping():
+            break
         if not os.access(root, os.X_OK):
             logger.write("[Warning: Cannot cd into {0} skipping directory]"
                     .format(root))
@@ -229,6 +284,11 @@ def test_directory(test, test_type):
         else:
             dir = os.path.abspath(root)
 
+        # the smoke tests have already been run
+        if dir in skip:
+            del dirs[:]
+            continue
+
         logger.write()
         logger.write("[Working on directory {0}]".format(root))
 
@@ -242,7 +302,7 @@ def test_directory(test, test_type):
         if not args.clean_only:
             with cd(dir): # cd into dir, and cd out later
                 # SKIP IF IMPLEMENTATIONS
-                test_env = os.path.join(util_dir, "test", "testEnv")
+                # (evaluated in-process, as util/test/testEnv would)
 
                 # The below cases are ordered to check for
                 # recursive skipping first, and then to check
@@ -267,7 +327,9 @@ def test_directory(test, test_type):
                 skip_file_name = os.path.normpath(skip_file_name)
                 if os.path.isfile(skip_file_name):
                     try:
-                        prune_if = run_command([test_env, skip_file_name]).strip()
+                        with harness_trace.span("skipif", file=skip_file_name):
+                            prune_if = skipif.evaluate(skip_file_name,
+                                                       util_dir).strip()
                         # check output and skip if true
                         if prune_if == "1" or prune_if == "True":
                             logger.write("[Skipping directory and children bas"
@@ -281,9 +343,11 @@ def test_directory(test, test_type):
                 # Skip the directory if there is a SKIPIF file that
                 # evaluates true
                 skip_test = False
-                if os.path.isfile("SKIPIF"):
+                if "SKIPIF" in files:
                     try:
-                        skip_test = run_command([test_env, "SKIPIF"]).strip()
+                        with harness_trace.span("skipif", file="SKIPIF"):
+                            skip_test = skipif.evaluate("SKIPIF",
+                                                        util_dir).strip()
                         # check output and skip if true
                         if skip_test == "1" or skip_test == "True":
                             logger.write("[Skipping directory based on SKIPIF "
@@ -293,7 +357,7 @@ def test_directory(test, test_type):
                         logger.write("[Warning: SKIPIF error.]")
 
                 # skip this directory if there is a NOTEST file
-                if os.path.isfile(os.path.join(dir, "NOTEST")):
+                if "NOTEST" in files:
                     continue
 
 
@@ -346,86 +410,26 @@ def summarize():
     logger.write("[Log file: {0} ]".format(os.path.abspath(log_file)))
     logger.write()
     logger.stop()
-    # setup regular expressions for searching
-    future_marker = r"^Future"
-    suppress_marker = r"^Suppress"
-    error_marker = r"^\[Error"
-    if not args.performance and args.gen_graphs:
-        success_marker = r"\[Success generating"
-    else:
-        if args.comp_only:
-            success_marker = r"\[Success compiling"
-        else:
-            success_marker = r"\[Success matching"
-    warning_marker = r"^\[Warning"
-    passing_suppressions_marker = ("{0}.*{1}"
-            .format(suppress_marker, success_marker))
-    passing_futures_marker = "{0}.*{1}".format(future_marker, success_marker)
-    success_marker = "^" + success_marker
-    skip_stdin_redirect_marker = r"^\[Skipping test with .stdin input"
-
-    # setup counts and blank strings to hold summaries
+
+    # the counts and summary lines were collected as the log was written
+    summary_start = time.time()
     global failures # for exit codes later
-    failures = 0
-    successes = 0
-    futures = 0
-    warnings = 0
-    passing_suppressions = 0
-    passing_futures = 0
-    skip_stdin_redirects = 0
-    failure_summary = ""
-    suppression_summary = ""
-    future_summary = ""
-    warning_summary = ""
-    summary = "[Test Summary - {0}]\n".format(date_str)
-
-    # scan line-by-line, logging failures, warnings, etc.. and updating counts
-    with open(tmp_log_file, "r") as log:
-        for line in log:
-            if re.search(error_marker, line, flags=re.M):
-                failure_summary += line
-                failures += 1
-            elif re.search(suppress_marker, line, flags=re.M):
-                suppression_summary += line
-            elif re.search(future_marker, line, flags=re.M):
-                future_summary += line
-                futures += 1
-            elif re.search(warning_marker, line, flags=re.M):
-                warning_summary += line
-                warnings += 1
-            elif re.search(success_marker, line, flags=re.M):
-                successes += 1
-            if re.search(passing_suppressions_marker, line, flags=re.M):
-                passing_suppressions += 1
-            elif re.search(passing_futures_marker, line, flags=re.M):
-                passing_futures += 1
-            elif re.search(skip_stdin_redirect_marker, line, flags=re.M):
-                skip_stdin_redirects += 1
-
-    # compile summary
-    summary += failure_summary
-    summary += suppression_summary
-    summary += future_summary
-    summary += warning_summary
+    index = logger.index
+    failures = index.counts["failures"]
+    skip_stdin_redirects = index.counts["skip_stdin_redirects"]
+    summary = index.summary(date_str)
 
     if skip_stdin_redirects > 0:
         logger.write("[Skipped {0} tests with .stdin input]"
                 .format(skip_stdin_redirects))
 
-    summary += ("[Summary: #Successes = {0} | #Failures = {1} | #Futures = {2} "
-            "| #Warnings = {3} ]\n"
-            .format(successes, failures, futures, warnings))
-    summary += ("[Summary: #Passing Suppressions = {0} | "
-            "#Passing Futures = {1} ]\n"
-            .format(passing_suppressions, passing_futures))
-    summary += "[END]\n"
-
     # log summary, and write it to its own .summary file
     logger.restart()
     logger.write(summary)
 
     with open(tmp_summary_file, "w") as log_summary:
         log_summary.write(summary)
+    harness_trace.record("summary", "harness", summary_start, time.time())
 
     # Note: Log file & summary copied tmp_log_file to log_file in cleanup
 
@@ -438,9 +442,11 @@ def clean(test=False):
         if test: # single test
             logger.write("[Starting {0} {1} {2}]"
                     .format(sub_clean, test, date_str))
-            out = run_command([sub_clean, test])
+            with harness_trace.span("sub_clean", dir=os.getcwd()):
+                out = run_command([sub_clean, test])
         else:
-            out = run_command([sub_clean])
+            with harness_trace.span("sub_clean", dir=os.getcwd()):
+                out = run_command([sub_clean])
         logger.write(out)
     except:
         logger.write("[Error: sub_clean error]")
@@ -456,7 +462,8 @@ def run_sub_test(test=False):
         logger.write("[Working on file {0}]".format(os.path.relpath(test)))
         os.environ["CHPL_ONETEST"] = os.path.basename(test)
 
-    if os.access("sub_test", os.X_OK):
+    custom_sub_test = os.access("sub_test", os.X_OK)
+    if custom_sub_test:
         sub_test = os.path.abspath("sub_test")
     else:
         sub_test = os.path.join(util_dir, "test", "sub_test")
@@ -465,7 +472,12 @@ def run_sub_test(test=False):
         sys.stderr.write("Testing {0} ... \n".format(test))
 
     logger.write("[Starting {0} {1}]".format(sub_test, date_str))
-    status = run_and_log([sub_test, compiler])
+    # directory-specific sub_test scripts always get a process of their own
+    with harness_trace.span("sub_test", dir=os.getcwd()):
+        if args.sub_test_server and not custom_sub_test:
+            status = get_sub_test_server(sub_test).run()
+        else:
+            status = run_and_log([sub_test, compiler])
     return status
 
 
@@ -497,7 +509,8 @@ def generate_graphs(test=False):
     cmd += start_date_t.split(" ")
     cmd += [args.graphs_disp_range, "-r", args.graphs_gen_default]
     cmd += graph_files
-    status = run_and_log(cmd)
+    with harness_trace.span("genGraphs", dir=basedir):
+        status = run_and_log(cmd)
 
     if status == 0:
         logger.write("[Success generating graphs for graph_files in {0} in {1}]"
@@ -678,6 +691,32 @@ def set_up_tmpdir():
     atexit.register(cleanup)
 
 
+def set_up_trace():
+    # start_test, sub_test and sub_clean write their spans to per-process
+    # files in the tmp dir; finish_trace() merges them
+    global trace_start
+    trace_start = time.time()
+    if args.trace_harness:
+        os.environ["CHPL_TEST_TRACE_DIR"] = tempfile.mkdtemp(
+                prefix="trace.", dir=chpl_test_tmp_dir)
+
+
+def finish_trace():
+    if not args.trace_harness:
+        return
+    harness_trace.record("start_test", "harness", trace_start, time.time())
+    trace_file = os.path.abspath(args.trace_harness)
+    try:
+        events = harness_trace.merge(os.environ["CHPL_TEST_TRACE_DIR"],
+                                     trace_file)
+    except (IOError, OSError) as e:
+        print("[Error writing harness trace {0}: {1}]"
+                .format(trace_file, e.strerror))
+        return
+    print("[Harness trace: {0}]".format(trace_file))
+    print(harness_trace.summary(events), end="")
+
+
 def set_up_environment():
     # compopts (note that we have to strip out our preprocessing)
     if args.compopts:
@@ -745,6 +784,19 @@ def set_up_environment():
     if args.junit_xml_file:
         args.junit_xml = True
 
+    # build cache size (in MB)
+    if args.build_cache_size is not None:
+        os.environ["CHPL_TEST_BUILD_CACHE_SIZE"] = str(args.build_cache_size)
+
+    # concurrent compopts compiles
+    if args.compopts_jobs:
+        os.environ["CHPL_TEST_COMPOPTS_JOBS"] = str(args.compopts_jobs)
+
+    # chplenv snapshot cache
+    if args.chplenv_cache_dir:
+        os.environ["CHPL_TEST_CHPLENV_CACHE_DIR"] = os.path.abspath(
+                args.chplenv_cache_dir)
+
 
 def set_up_logger():
     # log_file
@@ -752,6 +804,8 @@ def set_up_logger():
     global tmp_summary_file
     global log_file
     global summary_file
+    global tmp_index_file
+    global index_file
 
     # Compute the paths needing to be computed
     # Default log_file and tmp_log_file are set in check_environment_with_args
@@ -762,6 +816,8 @@ def set_up_logger():
 
     summary_file = log_file + ".summary"
     tmp_summary_file = tmp_log_file + ".summary"
+    index_file = result_index.index_path(log_file)
+    tmp_index_file = result_index.index_path(tmp_log_file)
 
     log_file_dir = os.path.dirname(log_file)
     if not os.access(log_file_dir, os.X_OK):
@@ -776,10 +832,20 @@ def set_up_logger():
         os.remove(log_file)
     if os.path.isfile(summary_file):
         os.remove(summary_file)
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+
+    # what counts as a success for the summary
+    if not args.performance and args.gen_graphs:
+        success_marker = "[Success generating"
+    elif args.comp_only:
+        success_marker = "[Success compiling"
+    else:
+        success_marker = "[Success matching"
 
     ## START LOGGING TO FILE ##
     global logger
-    logger = Logger()
+    logger = Logger(result_index.ResultIndex(success_marker, tmp_index_file))
 
 
 def set_up_general():
@@ -1142,6 +1208,70 @@ def set_up_executables():
         os.environ["CHPL_SYSTEM_PREDIFF"] = ','.join(chpl_system_prediff)
 
 
+def set_up_chplenv_cache():
+    # Compute the chplenv snapshot once for this run. This has to happen after
+    # set_up_executables() since that exports CHPL_* variables that are part
+    # of the snapshot key. sub_test and testEnv reuse the snapshot.
+    if args.refresh_chplenv:
+        logger.write("[Invalidating cached chplenv snapshots]")
+        chplenv_cache.invalidate()
+    chplenv_cache.get(util_dir)
+    snapshot = chplenv_cache.snapshot_path()
+    if snapshot and os.path.isfile(snapshot):
+        os.environ["CHPL_TEST_CHPLENV_SNAPSHOT"] = snapshot
+
+
+def set_up_result_cache():
+    # The toolchain fingerprint hashes the compiler and walks the runtime and
+    # module trees, so compute it once here instead of in every sub_test.
+    if not args.cache_dir and not args.build_cache_dir:
+        return
+    if args.cache_dir:
+        cache_dir = os.path.abspath(args.cache_dir)
+        logger.write('[Using test result cache: "{0}"]'.format(cache_dir))
+        os.environ["CHPL_TEST_RESULT_CACHE_DIR"] = cache_dir
+    if args.build_cache_dir:
+        build_cache_dir = os.path.abspath(args.build_cache_dir)
+        logger.write('[Using build cache: "{0}"]'.format(build_cache_dir))
+        os.environ["CHPL_TEST_BUILD_CACHE_DIR"] = build_cache_dir
+        # trim the cache once per run rather than on every store
+        evicted = build_cache.evict(build_cache_dir)
+        if evicted:
+            logger.write('[Evicted {0} build cache entries]'.format(evicted))
+    os.environ["CHPL_TEST_CACHE_TOOLCHAIN_KEY"] = result_cache.toolchain_key(
+            compiler, home)
+
+
+def set_up_breakers():
+    # A tripped circuit breaker, or anyone else (paratest's PARAHALT), stops
+    # the run by creating the halt file: sub_test checks for it before each
+    # test and test_directory() before each directory.
+    global breaker, halt_file
+    if args.halt_file:
+        halt_file = os.path.abspath(args.halt_file)
+    else:
+        halt_file = os.path.join(chpl_test_tmp_dir,
+                                 "halt.{0}".format(os.getpid()))
+    os.environ["CHPL_TEST_HALT_FILE"] = halt_file
+    breaker = circuit_breaker.CircuitBreaker(args.stop_after_failures,
+                                             args.max_failure_rate,
+                                             args.failure_rate_window)
+    if not breaker.enabled():
+        breaker = None
+
+
+def set_up_manifest():
+    # Directory listings for test_directory() and check_for_duplicates().
+    # Recursive runs keep them in the Logs directory so that the next run
+    # only re-reads the directories that have changed; nonrecursive runs
+    # (e.g. paratest's workers, many at once) don't share the file.
+    global manifest
+    path = None
+    if args.recurse:
+        path = os.path.join(logs_dir, "test-manifest.json")
+    manifest = test_manifest.Manifest(path)
+
+
 def auto_generate_tests():
     if not auto_gen_spec_tests:
         return
@@ -1177,7 +1307,7 @@ def check_for_duplicates():
 
         dat_files = []
         error = False
-        for root, dirnames, filenames in os.walk(test_dir):
+        for root, dirnames, filenames in manifest.walk(test_dir):
             for filename in fnmatch.filter(filenames, "*." + args.perflabel):
                 if filename in dat_files: # duplicate
                     logger.write("[Error: Duplicate performance data filenames"
@@ -1211,7 +1341,7 @@ def check_for_duplicates():
 
         # get absolute paths of actual .graph files
         actual_graph_files = []
-        for root, dirnames, filenames in os.walk(test_dir):
+        for root, dirnames, filenames in manifest.walk(test_dir):
             for filename in fnmatch.filter(filenames, "*.graph"):
                 actual_graph_files.append(os.path.relpath(
                     os.path.join(root, filename), test_dir))
@@ -1252,6 +1382,113 @@ def run_and_log(cmd):
     p.wait()
     return p.returncode
 
+class SubTestServer(object):
+    """
+    A long-lived `sub_test --server` process. Each call to run() hands it the
+    current directory and environment and logs its output until the job's end
+    marker, so the log looks the same as running a fresh sub_test, without
+    paying sub_test's start up costs for every directory.
+    """
+    marker = b"\0[sub_test server: job "
+
+    def __init__(self, sub_test):
+        job_r, job_w = os.pipe()
+        self.process = subprocess.Popen(
+                [sub_test, "--server", str(job_r), compiler],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                pass_fds=(job_r,))
+        os.close(job_r)
+        self.jobs = os.fdopen(job_w, "w")
+        self.next_id = 0
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self):
+        job_id = self.next_id
+        self.next_id += 1
+        job = {"id": job_id, "cwd": os.getcwd(), "env": dict(os.environ)}
+        try:
+            self.jobs.write(json.dumps(job) + "\n")
+            self.jobs.flush()
+        except (IOError, OSError):
+            pass
+
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                # the server died, report its status like a sub_test failure
+                return self.process.wait()
+            marker_start = line.find(self.marker)
+            if marker_start >= 0:
+                # a job that didn't end with a newline leaves the marker
+                # ("<marker>N exited with status S]") on its last line
+                if marker_start > 0:
+                    logger.write(str(line[:marker_start], 'utf-8'))
+                    logger.flush()
+                return int(line.split()[-1].rstrip(b"]"))
+            if sys.version_info[0] >= 3:
+                line = str(line, 'utf-8')
+            logger.write(line)
+            logger.flush()
+
+    def stop(self):
+        try:
+            self.jobs.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+breaker = None
+halt_file = None
+stop_reason = None
+stop_logged = False
+
+def check_breakers():
+    # called for every line logged, while a breaker is set and untripped
+    counts = logger.index.counts
+    reason = breaker.update(counts["successes"], counts["failures"])
+    if reason is not None:
+        stop(reason)
+
+def stop(reason):
+    # the log says so once the current test is done, in stopping()
+    global stop_reason
+    stop_reason = reason
+    circuit_breaker.halt(halt_file, reason)
+
+def stopping():
+    """
+    True once the run should stop, because a circuit breaker tripped or the
+    halt file has appeared. The first time, an error is logged so that the
+    summary counts it and the run exits nonzero.
+    """
+    global stop_reason, stop_logged
+    if stop_reason is None and halt_file and os.path.exists(halt_file):
+        stop_reason = "found {0}".format(halt_file)
+    if stop_reason is not None and not stop_logged:
+        stop_logged = True
+        logger.write()
+        logger.write("[Stopping early: {0}]".format(stop_reason))
+        logger.write("[Error: run stopped early ({0})]".format(stop_reason))
+    return stop_reason is not None
+
+sub_test_server = None
+
+def get_sub_test_server(sub_test):
+    global sub_test_server
+    if sub_test_server is None or not sub_test_server.alive():
+        sub_test_server = SubTestServer(sub_test)
+    return sub_test_server
+
+def stop_sub_test_server():
+    global sub_test_server
+    if sub_test_server is not None:
+        sub_test_server.stop()
+        sub_test_server = None
+
+
 def cleanup():
     # move the log from the temp log
     if os.path.isfile(tmp_log_file):
@@ -1265,6 +1502,12 @@ def cleanup():
             shutil.copyfile(tmp_summary_file, summary_file)
             os.remove(tmp_summary_file)
 
+    # and the result index
+    if os.path.isfile(tmp_index_file):
+        if tmp_index_file != index_file:
+            shutil.copyfile(tmp_index_file, index_file)
+            os.remove(tmp_index_file)
+
     if os.path.isdir(chpl_test_tmp_dir):
       shutil.rmtree(chpl_test_tmp_dir)
 
@@ -1465,6 +1708,64 @@ def parser_setup():
     parser.add_argument("-junit-remove-prefix", "--junit-remove-prefix",
             action="store", dest="junit_remove_prefix", metavar="<prefix>",
             help=help_all("<prefix> to remove from tests in jUnit report"))
+    # persistent sub_test
+    parser.add_argument("-sub-test-server", "--sub-test-server",
+            action="store_true", dest="sub_test_server",
+            default=bool(os.getenv("CHPL_TEST_SUB_TEST_SERVER")),
+            help=help_all("run all directories through one sub_test process"))
+    # chplenv snapshot cache
+    parser.add_argument("-chplenv-cache-dir", "--chplenv-cache-dir",
+            action="store", dest="chplenv_cache_dir", metavar="<dir>",
+            help=help_all("keep the chplenv snapshot in <dir> across runs"))
+    parser.add_argument("-refresh-chplenv", "--refresh-chplenv",
+            action="store_true", dest="refresh_chplenv",
+            help=help_all("discard cached chplenv snapshots"))
+    # concurrent compopts compiles
+    parser.add_argument("-compopts-jobs", "--compopts-jobs",
+            action="store", type=int, dest="compopts_jobs", metavar="<n>",
+            help=help_all("compile up to <n> compopts variants of a test at "
+                          "once"))
+    # test result cache
+    parser.add_argument("-cache-dir", "--cache-dir",
+            action="store", dest="cache_dir", metavar="<dir>",
+            default=os.getenv("CHPL_TEST_RESULT_CACHE_DIR"),
+            help=help_all("replay results of unchanged, previously passing "
+                          "tests from <dir>"))
+    # build cache
+    parser.add_argument("-build-cache-dir", "--build-cache-dir",
+            action="store", dest="build_cache_dir", metavar="<dir>",
+            default=os.getenv("CHPL_TEST_BUILD_CACHE_DIR"),
+            help=help_all("reuse executables from identical compiles "
+                          "stored in <dir>"))
+    parser.add_argument("-build-cache-size", "--build-cache-size",
+            action="store", type=int, dest="build_cache_size", metavar="<MB>",
+            help=help_all("trim the build cache to <MB> megabytes"))
+    # stopping early
+    parser.add_argument("-stop-after-failures", "--stop-after-failures",
+            action="store", type=int, dest="stop_after_failures", default=0,
+            metavar="<n>", help="stop the run after <n> failures")
+    parser.add_argument("-max-failure-rate", "--max-failure-rate",
+            action="store", type=float, dest="max_failure_rate", default=0,
+            metavar="<pct>", help="stop the run if more than <pct>%% of the "
+                                  "first results fail (see "
+                                  "--failure-rate-window)")
+    parser.add_argument("-failure-rate-window", "--failure-rate-window",
+            action="store", type=int, dest="failure_rate_window",
+            default=circuit_breaker.default_rate_window, metavar="<n>",
+            help="number of results --max-failure-rate looks at "
+                 "(default {0})".format(circuit_breaker.default_rate_window))
+    parser.add_argument("-smoke-tests", "--smoke-tests",
+            action="append", dest="smoke_tests", metavar="<dir>",
+            help="run the tests in <dir> first, and stop if any fail")
+    parser.add_argument("-halt-file", "--halt-file",
+            action="store", dest="halt_file", metavar="<file>",
+            help=help_all("stop when <file> appears, and create it when the "
+                          "run stops early"))
+    # harness tracing
+    parser.add_argument("-trace-harness", "--trace-harness",
+            action="store", dest="trace_harness", metavar="<file>",
+            help=help_all("write a Chrome trace of the time the test system "
+                          "spends in each phase to <file>"))
     # extra help
     parser.add_argument("-help", action="help", help=argparse.SUPPRESS)
     parser.add_argument("--help-all", action="help",
@@ -1496,7 +1797,7 @@ def escape_next_argument(args, index):
 # UTILITY ROUTINES AND CLASSES
 
 class Logger():
-    def __init__(self):
+    def __init__(self, index=None):
         self.logger = logging.getLogger("start_test")
         self.logger.setLevel(logging.DEBUG)
         # console stdout handlers
@@ -1506,9 +1807,17 @@ class Logger():
         # add them
         self.logger.addHandler(self.console_out)
         self.logger.addHandler(self.file_out)
+        # ResultIndex fed each line that goes to the log file
+        self.index = index
+        self.indexing = index is not None
 
     def write(self, msg=" "):
-        self.logger.info(msg.rstrip())
+        msg = msg.rstrip()
+        self.logger.info(msg)
+        if self.indexing:
+            self.index.add(msg, self.file_out.stream.tell())
+            if breaker is not None and stop_reason is None:
+                check_breakers()
 
     def flush(self):
         self.console_out.flush()
@@ -1518,6 +1827,10 @@ class Logger():
         self.file_out.flush()
         self.file_out.close()
         self.logger.removeHandler(self.file_out)
+        # the index covers the log up to the first stop (the summary)
+        if self.indexing:
+            self.index.close()
+            self.indexing = False
 
     def restart(self):
         self.file_out = FileHandlerWithException(tmp_log_file, mode="a")
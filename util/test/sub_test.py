@@ -57,6 +57,26 @@
 #                        for it to enforce timeout instead of using timedexec;
 #                        the value of the variable determines the option format.
 # CHPL_TEST_TIMEOUT: The default global timeout to use.
+# CHPL_TEST_OUTPUT_LIMIT: If set, keep at most this many bytes of a test's
+#                         output (the head and tail; the middle is elided).
+# CHPL_TEST_OUTPUT_SPILL_SIZE: If set, captured output larger than this many
+#                              bytes is buffered in a temp file, not memory.
+# CHPL_TEST_RESULT_CACHE_DIR: If set, replay the results of tests whose inputs
+#                             are unchanged since they last passed (see
+#                             result_cache.py).
+# CHPL_TEST_COMPOPTS_JOBS: Compile up to this many of a test's compopts
+#                          variants at once, each to its own executable.
+# CHPL_TEST_LIMIT_RUNNING_EXECUTABLES: If set, limit how many test programs
+#                         run at once on this machine (see CHPL_TEST_EXECUTION_SLOTS).
+# CHPL_TEST_EXECUTION_SLOTS: Number of test programs that may run at once when
+#                            limiting them ('auto' picks one based on cores
+#                            and memory). Defaults to 1, or to 'auto' under
+#                            paratest.local.
+# CHPL_TEST_EXECUTION_SLOT_WEIGHTING: If set, tests take execution slots in
+#                                     proportion to their numlocales and
+#                                     CHPL_RT_NUM_THREADS_PER_LOCALE.
+# CHPL_TEST_BUILD_CACHE_DIR: If set, reuse executables from identical earlier
+#                            compiles (see build_cache.py).
 # CHPL_TEST_UNIQUIFY_EXE: Uniquify the name of the test executable in the test
 #                         system. CAUTION: This wont necessarily work for all
 #                         tests, but can allow for running multiple start_tests
@@ -131,12 +151,25 @@
 
 from __future__ import with_statement
 
+import build_cache
+import chplenv_cache
 import execution_limiter
+import filediff
+import harness_trace
+import output_capture
+import perf_stats
+import prediff_plugins
 import py3_compat
+import result_cache
+import skipif
+import test_manifest
+import timed_exec
 import sys, os, subprocess, string, signal
+import concurrent.futures
 import operator
 import select, fcntl
-import fnmatch, time
+import io
+import time
 import re
 import shlex
 import datetime
@@ -168,10 +201,58 @@ def elapsed_sub_test_time():
         test_name = os.path.join(test_name, base_name)
 
     print('[Finished subtest "{0}" - {1:.3f} seconds]\n'.format(test_name, elapsed_sec))
+    harness_trace.record('sub_test (process)', 'harness', sub_test_start_time,
+                         time.time(), test=test_name)
 
 import atexit
 atexit.register(elapsed_sub_test_time)
 
+#
+# Server mode: start_test can keep a single sub_test process around for the
+#  whole run instead of starting a new one for every directory. The server
+#  does the process-wide set up once and then reads jobs (one JSON object per
+#  line with the directory and environment to use) from the given file
+#  descriptor. Each job is run in a forked copy of the server so that the
+#  per-directory code below sees a fresh process, exactly as if sub_test had
+#  been started from scratch. Once the child is done, the server writes an
+#  end-of-job marker with the child's exit status to stdout.
+#
+server_marker = '\0[sub_test server: job {0} exited with status {1}]\n'
+
+def RunServer(job_fd):
+    global sub_test_start_time
+    import json
+    jobs = os.fdopen(job_fd, 'r')
+    while True:
+        line = jobs.readline()
+        if not line:
+            break
+        job = json.loads(line)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # child: become a regular sub_test run in the job's directory
+            jobs.close()
+            os.environ.clear()
+            os.environ.update(job['env'])
+            os.chdir(job['cwd'])
+            sub_test_start_time = time.time()
+            return
+
+        (_, wait_status) = os.waitpid(pid, 0)
+        if os.WIFEXITED(wait_status):
+            status = os.WEXITSTATUS(wait_status)
+        else:
+            status = 128 + os.WTERMSIG(wait_status)
+        sys.stdout.write(server_marker.format(job['id'], status))
+        sys.stdout.flush()
+
+    # Skip the atexit handler, it reports on individual jobs only
+    sys.stdout.flush()
+    os._exit(0)
+
 #
 # Time out class:  Read from a stream until time out
 #  A little ugly but sending SIGALRM (or any other signal) to Python
@@ -187,7 +268,7 @@ def SetNonBlock(stream):
 
 def SuckOutputWithTimeout(stream, timeout):
     SetNonBlock(stream)
-    buffer = b''
+    buffer = output_capture.OutputCapture()
     end_time = time.time() + timeout
     while True:
         now = time.time()
@@ -199,11 +280,11 @@ def SuckOutputWithTimeout(stream, timeout):
             bytes = stream.read()
             if len(bytes) == 0:
                 break           # EOF
-            buffer += bytes     # Inefficient way to accumulate bytes.
+            buffer.write(bytes)
             # len(ready_set) == 0 is also an indication of timeout. However,
             # if we relied on that, we would require no data ready in order
             # to timeout  which doesn't seem quite right either.
-    return buffer
+    return buffer.getvalue()
 
 def LauncherTimeoutArgs(seconds):
     if useLauncherTimeout == 'pbs' or useLauncherTimeout == 'slurm':
@@ -249,6 +330,10 @@ def hasTestableExtension(f):
     else:
         return False
 
+# Test file name without its extension, which is also its executable's name
+def TestExecname(f):
+    return re.match(r'^(.*)\.(?:chpl|test\.c|test\.cpp|ml-test\.c|ml-test\.cpp)$', f).group(1)
+
 perflabel = '' # declare it for the following functions
 
 # file suffix: 'keys' -> '.perfkeys' etc.
@@ -263,11 +348,10 @@ def PerfDirFile(s):
 def PerfTFile(test_filename, sfx):
     return test_filename + '.' + perflabel + sfx
 
+# The chplenv snapshot is computed once (normally by start_test) and shared
+# through chplenv_cache rather than running printchplenv for every line
 def get_chplenv():
-    env_cmd = [os.path.join(utildir, 'printchplenv'), '--all', '--simple', '--no-tidy', '--internal']
-    chpl_env = py3_compat.Popen(env_cmd, stdout=subprocess.PIPE).communicate()[0]
-    chpl_env = dict(map(lambda l: l.split('=', 1), chpl_env.splitlines()))
-    return chpl_env
+    return chplenv_cache.get(utildir)
 
 # Similar to os.path.expandvars but stuff chplenv into it too
 def expandvars_chpl(path):
@@ -320,34 +404,35 @@ def ReadFileWithComments(f, ignoreLeadingSpace=True):
     return mylist
 
 # diff 2 files
+@harness_trace.traced('diff')
 def DiffFiles(f1, f2):
     sys.stdout.write('[Executing diff %s %s]\n'%(f1, f2))
-    p = py3_compat.Popen(['diff',f1,f2],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myoutput = p.communicate()[0] # grab stdout to avoid potential deadlock
-    if p.returncode != 0:
-        sys.stdout.write(trim_output(myoutput))
-    return p.returncode
+    # Identical files are detected in-process; diff only runs on a mismatch
+    returncode, myoutput = filediff.diff(f1, f2)
+    if returncode != 0:
+        sys.stdout.write(trim_output(py3_compat.bytes_to_str(myoutput)))
+    return returncode
 
+@harness_trace.traced('diff')
 def DiffBinaryFiles(f1, f2):
     sys.stdout.write('[Executing binary diff %s %s]\n'%(f1, f2))
-    p = py3_compat.Popen(['diff', '-a', f1,f2],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myoutput = p.communicate()[0] # grab stdout to avoid potential deadlock
-    if p.returncode != 0:
+    try:
+        returncode = 0 if filediff.same_contents(f1, f2) else 1
+    except (IOError, OSError):
+        returncode = 2
+    if returncode != 0:
         sys.stdout.write('Binary files differed\n')
-    return p.returncode
+    return returncode
 
 # diff output vs. .bad file, filtering line numbers out of error messages that arise
 # in module files.
+@harness_trace.traced('diff')
 def DiffBadFiles(f1, f2):
     sys.stdout.write('[Executing diff-ignoring-module-line-numbers %s %s]\n'%(f1, f2))
-    p = py3_compat.Popen([utildir+'/test/diff-ignoring-module-line-numbers', f1, f2],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    myoutput = p.communicate()[0] # grab stdout to avoid potential deadlock
-    if p.returncode != 0:
-        sys.stdout.write(myoutput)
-    return p.returncode
+    returncode, myoutput = filediff.diff_ignoring_module_line_numbers(f1, f2)
+    if returncode != 0:
+        sys.stdout.write(py3_compat.bytes_to_str(myoutput))
+    return returncode
 
 # kill process
 def KillProc(p, timeout):
@@ -412,6 +497,126 @@ def which(program):
     return None
 
 
+# Return the command and arguments used to build the current test as execname
+# with the given compopts
+def GetCompileCommand(compopts, execname):
+    args = []
+    if test_is_chpldoc:
+        args += globalChpldocOpts + shlex.split(compopts)
+    elif 'CHPL_TEST_NO_USE_O' not in os.environ or \
+         os.environ.get('CHPL_TEST_NO_USE_O') != "true":
+        args += ['-o', execname] + envCompopts + shlex.split(compopts)
+    else:
+        args += envCompopts + shlex.split(compopts)
+    args += [testname]
+
+    if is_c_or_cpp_test or is_ml_c_or_cpp_test:
+        # we need to drop envCompopts for C tests as those are options
+        # for `chpl` so don't include them here
+        args = ['-o', test_filename]+shlex.split(compopts)+[testname]
+        cmd = None
+        if is_c_test or is_ml_c_test:
+            cmd = c_compiler
+        elif is_cpp_test or is_ml_cpp_test:
+            cmd = cpp_compiler
+    elif valgrindcomp:
+        cmd = valgrindcomp
+        args = valgrindcompopts+[compiler]+args
+    else:
+        cmd = compiler
+
+    if lastcompopts:
+        args += lastcompopts
+    return (cmd, args)
+
+# Whether the current test's builds can go through the build cache: its
+#  compile has to produce just execname (and execname_real)
+def BuildCacheable():
+    return (buildCacheDir and not perftest and not valgrindcomp and
+            not test_is_chpldoc and not is_c_or_cpp_test and
+            not is_ml_c_or_cpp_test and
+            os.environ.get('CHPL_TEST_NO_USE_O') != "true")
+
+# Compile the current test (with timeout), reusing an identical earlier build
+#  from the build cache if there is one. Files matching `others` (e.g. other
+#  variants' executables) may appear in the directory meanwhile.
+def RunCompile(cmd, args, timeout, env, execname, others=()):
+    key = None
+    if BuildCacheable():
+        key = build_cache.compile_key(cacheBaseKey, cmd, args, execname,
+                                      testcompenv, compstdin)
+        cachedOutput = build_cache.fetch(buildCacheDir, key, execname)
+        if cachedOutput is not None:
+            capture = output_capture.OutputCapture()
+            capture.write(cachedOutput.encode('utf-8', 'surrogateescape'))
+            result = timed_exec.TimedExecResult(0, capture,
+                                                output_capture.OutputCapture(),
+                                                False)
+            result.cached = True
+            return result
+        before = set(os.listdir('.'))
+
+    wholecmd = ShellEscapeCommand(cmd)+' '+' '.join(map(ShellEscape, args))
+    with open(compstdin, 'r') as my_stdin:
+        result = timed_exec.run(timed_exec.shell_command(wholecmd), timeout,
+                                env=env, stdin=my_stdin, merge_stderr=True)
+
+    if key and result.status == 0 and os.path.isfile(execname):
+        # don't cache builds that leave anything else behind
+        expected = set([execname, execname+'_real'])
+        for other in others:
+            expected.update([other, other+'_real'])
+        extra = [f for f in set(os.listdir('.')) - before - expected
+                 if not f.endswith('.tmp')]
+        if not extra:
+            build_cache.store(buildCacheDir, key, execname,
+                              result.stdout.decode('utf-8', 'surrogateescape'))
+    return result
+
+# Compiles all compopts variants of the current test concurrently, each to its
+#  own executable (like CHPL_TEST_UNIQUIFY_EXE), so that the compopts loop
+#  only has to wait for results instead of running the compiler itself
+class ParallelCompiles(object):
+    def __init__(self, compoptslist, execname, timeout, jobs):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.execnames = []
+        self.futures = []
+        # (start, end) wall clock times of each variant's compile
+        self.times = [None] * len(compoptslist)
+        env = dict(list(os.environ.items()) + list(testcompenv.items()))
+        # name every variant's executable before starting any compile, so
+        #  each one knows which files the others may produce
+        commands = []
+        for i, compopts in enumerate(compoptslist):
+            # as in the compopts loop, anything after a '#' names a .good file
+            compopts = compopts.split('#')[0]
+            variant_execname = '{0}.{1}'.format(execname, i+1)
+            commands.append(GetCompileCommand(compopts, variant_execname))
+            self.execnames.append(variant_execname)
+        for i, (cmd, args) in enumerate(commands):
+            self.futures.append(self.pool.submit(self.compile, i, cmd, args,
+                                                 timeout, env))
+
+    def compile(self, i, cmd, args, timeout, env):
+        execname = self.execnames[i]
+        # other variants' executables may show up while this one builds
+        others = [e for e in self.execnames if e != execname]
+        start = time.time()
+        result = RunCompile(cmd, args, timeout, env, execname, others)
+        self.times[i] = (start, time.time())
+        return result
+
+    def result(self, i):
+        return self.futures[i].result()
+
+    # wait for any compiles we didn't use and remove their executables
+    def finish(self):
+        for future in self.futures:
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        for variant_execname in self.execnames:
+            cleanup(variant_execname)
+
 # print (compopts: XX, execopts: XX) for later decoding of failed tests
 def printTestVariation(compoptsnum, compoptslist,
                        execoptsnum=0, execoptslist=[] ):
@@ -444,6 +649,26 @@ def printEndOfTestMsg(test_name, elapsedTime):
         '{1:.3f} seconds]'.format(test_name, elapsedTime))
 
 
+# The PerfRecorders (see perf_stats.py) for the .dat files the current test
+#   writes to, by test name, directory and key file.  Keeping them for the
+#   whole test means the key file is read and the .dat file checked once, not
+#   once per trial.
+perfRecorders = {}
+
+def GetPerfRecorder(name, perfdir, keyfile):
+    key = (name, perfdir, keyfile)
+    if key not in perfRecorders:
+        perfRecorders[key] = perf_stats.PerfRecorder(name, perfdir, keyfile)
+    return perfRecorders[key]
+
+def ClosePerfRecorders():
+    for recorder in perfRecorders.values():
+        recorder.close()
+    perfRecorders.clear()
+
+atexit.register(ClosePerfRecorders)
+
+
 # return true if string is an integer
 def IsInteger(str):
     try:
@@ -542,25 +767,13 @@ def get_exec_log_name(execname, comp_opts_count=None, exec_opts_count=None):
     else:
         return '{0}.{1}-{2}{3}'.format(execname, comp_opts_count, exec_opts_count, suffix)
 
-# Use testEnv to process skipif files, it works for executable and
-# non-executable versions
+# Process skipif files the way testEnv does (in-process, see skipif.py), it
+# works for executable and non-executable versions. Errors, including any
+# stderr output from an executable one, are raised as skipif.SkipIfError, a
+# RuntimeError.
+@harness_trace.traced('skipif')
 def runSkipIf(skipifName):
-    p = py3_compat.Popen([utildir+'/test/testEnv', './'+skipifName], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    status = p.returncode
-
-    stderr = stderr.strip()
-    errmsg = ""
-    if stderr:
-        errmsg = stderr
-    if status:
-        if stderr:
-            errmsg += '\n'
-        errmsg += 'exit status %d' % (status)
-    if stderr or status:
-        raise RuntimeError(errmsg)
-
-    return stdout
+    return skipif.evaluate('./'+skipifName, utildir, strict=True)
 
 # Translate some known failures into more easily understood forms
 def translateOutput(output_in):
@@ -679,8 +892,13 @@ def filter_errors(output_in, pre_exec_output, execgoodfile, execlog):
 # Start of sub_test proper
 #
 
+server_job_fd = None
+if len(sys.argv)==4 and sys.argv[1]=='--server':
+    server_job_fd = int(sys.argv[2])
+    del sys.argv[1:3]
+
 if len(sys.argv)!=2:
-    print('usage: sub_test COMPILER')
+    print('usage: sub_test [--server JOB_FD] COMPILER')
     sys.exit(0)
 
 # Find the base installation
@@ -744,15 +962,10 @@ test_root_dir = os.environ.get('CHPL_TEST_ROOT_DIR')
 if test_root_dir is not None:
     testdir = test_root_dir
 
-# Use timedexec
-# As much as I hate calling out to another script for the time out stuff,
-#  subprocess doesn't quite cut it for this kind of stuff
+# Use timedexec semantics (process group kill, status 222 on timeout)
+# These used to come from the timedexec perl script, run through a shell for
+#  every compile and execution; timed_exec.py provides them in-process
 useTimedExec=True
-if useTimedExec:
-    timedexec=utildir+'/test/timedexec'
-    if not os.access(timedexec,os.R_OK|os.X_OK):
-        Fatal('Cannot execute timedexec script \''+timedexec+'\'')
-# sys.stdout.write('timedexec='+timedexec+'\n');
 
 # HW platform
 platform=py3_compat.Popen([utildir+'/chplenv/chpl_platform.py', '--target'], stdout=subprocess.PIPE).communicate()[0]
@@ -779,6 +992,11 @@ if systemPrediffs:
         if not os.access(sprediff,os.R_OK|os.X_OK):
             Fatal('Cannot execute system-wide prediff \''+sprediff+'\'')
 
+# Everything above is the same for every directory in a start_test run. In
+# server mode only forked children return from RunServer(), one per directory.
+if server_job_fd is not None:
+    RunServer(server_job_fd)
+
 # Use the launcher walltime option for timeout
 useLauncherTimeout = os.getenv('CHPL_LAUNCHER_TIMEOUT')
 
@@ -786,6 +1004,14 @@ uniquifyTests = False
 if os.getenv('CHPL_TEST_UNIQUIFY_EXE') != None:
     uniquifyTests = True
 
+# Number of compopts variants of a test to compile at once
+compoptsJobs = 1
+if os.getenv('CHPL_TEST_COMPOPTS_JOBS'):
+    try:
+        compoptsJobs = max(1, int(os.getenv('CHPL_TEST_COMPOPTS_JOBS')))
+    except ValueError:
+        Fatal('CHPL_TEST_COMPOPTS_JOBS must be an integer')
+
 # Get the current directory (normalize for MacOS case-sort-of-sensitivity)
 localdir = os.path.normpath(os.getcwd()).replace(testdir, '.')
 # sys.stdout.write('localdir=%s\n'%(localdir))
@@ -1133,6 +1359,8 @@ if systemPrediffs:
 # consistently look only at the files in the current directory
 dirlist=os.listdir(".")
 dirlist.sort()
+# the files belonging to each test, by the name before the '.'
+sidecars=test_manifest.sidecar_index(dirlist)
 
 onetestsrc = os.getenv('CHPL_ONETEST')
 if onetestsrc==None:
@@ -1141,16 +1369,41 @@ else:
     testsrc=list()
     testsrc.append(onetestsrc)
 
+# Result cache (start_test --cache-dir) and build cache (start_test
+#  --build-cache-dir), see result_cache.py and build_cache.py
+resultCacheDir = os.getenv('CHPL_TEST_RESULT_CACHE_DIR')
+buildCacheDir = os.getenv('CHPL_TEST_BUILD_CACHE_DIR')
+if resultCacheDir or buildCacheDir:
+    toolchainKey = os.getenv('CHPL_TEST_CACHE_TOOLCHAIN_KEY')
+    if not toolchainKey:
+        toolchainKey = result_cache.toolchain_key(compiler, chpl_home)
+    cacheBaseKey = '{0}-{1}-{2}'.format(toolchainKey, compiler,
+                                        result_cache.environment_key())
+    resultCacheFiles = (systemPreexecs or []) + (systemPrediffs or [])
+    # what all of this directory's tests build; not part of their fingerprints
+    testExecnames = set(TestExecname(f) for f in dirlist
+                        if hasTestableExtension(f))
+
 original_compiler = compiler
 
+harness_trace.record('sub_test set up', 'harness', sub_test_start_time,
+                     time.time())
+
+# start_test (a circuit breaker) or paratest (PARAHALT) stopping the run
+haltFile = os.getenv('CHPL_TEST_HALT_FILE')
+
 for testname in testsrc:
     sys.stdout.flush()
 
+    if haltFile and os.path.exists(haltFile):
+        sys.stdout.write('[Stopping early in %s: found %s]\n'%(localdir, haltFile))
+        break
+
     compiler = original_compiler
 
     # print testname
     sys.stdout.write('[test: %s/%s]\n'%(localdir,testname))
-    test_filename = re.match(r'^(.*)\.(?:chpl|test\.c|test\.cpp|ml-test\.c|ml-test\.cpp)$', testname).group(1)
+    test_filename = TestExecname(testname)
     execname = test_filename
     if uniquifyTests:
         execname += '.{0}'.format(os.getpid())
@@ -1188,7 +1441,7 @@ for testname in testsrc:
     # sys.stdout.write("lastexecopts=%s\n"%(lastexecopts))
 
     # Get the list of files starting with 'test_filename.'
-    test_filename_files = fnmatch.filter(dirlist, test_filename+'.*')
+    test_filename_files = list(sidecars.get(test_filename, []))
     # print test_filename_files, dirlist
 
     if (perftest and (test_filename_files.count(PerfTFile(test_filename,'keys'))==0) and
@@ -1494,12 +1747,43 @@ for testname in testsrc:
         sys.stdout.write('[Skipping interpretation of: %s/%s]\n'%(localdir,test_filename))
         continue # on to next test
 
+    # Replay the result of an identical earlier run, if there is one
+    resultCacheKey = None
+    if (resultCacheDir and not perftest and not testfuturesfile and
+            not os.access(test_filename+'.skipif', os.X_OK)):
+        compileArgs = list()
+        for compopts in compoptslist:
+            (cmd, args) = GetCompileCommand(compopts, execname)
+            compileArgs += cmd.split() + args
+        resultCacheKey = result_cache.test_key(cacheBaseKey, testname, dirlist,
+                                               testExecnames, compileArgs,
+                                               resultCacheFiles)
+        cachedOutput = result_cache.lookup(resultCacheDir, resultCacheKey)
+        if cachedOutput is not None:
+            sys.stdout.write('[Using cached result for %s/%s]\n'%(localdir,test_filename))
+            sys.stdout.write(cachedOutput)
+            continue # on to next test
+        resultCacheRecorder = result_cache.start_recording()
+
     clist = list()
     curFileTestStart = time.time()
 
+    # Compile the compopts variants concurrently if asked to. Tests whose
+    #  build can't be moved to a separate executable, or that need something
+    #  done before each compile, are still built one at a time.
+    parallelCompiles = None
+    if (compoptsJobs > 1 and len(compoptslist) > 1 and useTimedExec and
+            not perftest and not globalPrecomp and not precomp and
+            not test_is_chpldoc and not is_c_or_cpp_test and
+            not is_ml_c_or_cpp_test and
+            os.environ.get('CHPL_TEST_NO_USE_O') != "true"):
+        parallelCompiles = ParallelCompiles(compoptslist, execname,
+                                            4*timeout, compoptsJobs)
+    baseExecname = execname
+
     # For all compopts + execopts combos..
     compoptsnum = 0
-    for compopts in compoptslist:
+    for compoptsindex, compopts in enumerate(compoptslist):
         sys.stdout.flush()
         del clist
         # use the remaining portion as a .good file for executing tests
@@ -1515,77 +1799,54 @@ for testname in testsrc:
             del clist[:]
 
         if compopts == ' ':
-            complog=execname+'.comp.out.tmp'
+            complog=baseExecname+'.comp.out.tmp'
         else:
             compoptsnum += 1
-            complog = execname+'.'+str(compoptsnum)+'.comp.out.tmp'
+            complog = baseExecname+'.'+str(compoptsnum)+'.comp.out.tmp'
+
+        if parallelCompiles:
+            execname = parallelCompiles.execnames[compoptsindex]
 
         #
         # Run the precompile script
         #
+        scripts = prediff_plugins.Pipeline()
         if globalPrecomp:
             sys.stdout.write('[Executing ./PRECOMP]\n')
             sys.stdout.flush()
-            p = py3_compat.Popen(['./PRECOMP', execname, complog, compiler],
-                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            sys.stdout.write(p.communicate()[0])
+            with harness_trace.span('precomp', script='./PRECOMP'):
+                sys.stdout.write(scripts.run('./PRECOMP', [execname, complog, compiler]))
             sys.stdout.flush()
 
         if precomp:
             sys.stdout.write('[Executing precomp %s.precomp]\n'%(test_filename))
             sys.stdout.flush()
             test_precomp = './{0}.precomp'.format(test_filename)
-            p = py3_compat.Popen([test_precomp, execname, complog, compiler],
-                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            sys.stdout.write(p.communicate()[0])
+            with harness_trace.span('precomp', script=test_precomp):
+                sys.stdout.write(scripts.run(test_precomp, [execname, complog, compiler]))
             sys.stdout.flush()
+        scripts.finish()
 
 
         #
         # Build the test program
         #
-        args = []
-        if test_is_chpldoc:
-            args += globalChpldocOpts + shlex.split(compopts)
-        elif 'CHPL_TEST_NO_USE_O' not in os.environ or \
-             os.environ.get('CHPL_TEST_NO_USE_O') != "true":
-            args += ['-o', execname] + envCompopts + shlex.split(compopts)
-        else:
-            args += envCompopts + shlex.split(compopts)
-        args += [testname]
-
-        if is_c_or_cpp_test or is_ml_c_or_cpp_test:
-            # we need to drop envCompopts for C tests as those are options
-            # for `chpl` so don't include them here
-            args = ['-o', test_filename]+shlex.split(compopts)+[testname]
-            cmd = None
-            if is_c_test or is_ml_c_test:
-                cmd = c_compiler
-            elif is_cpp_test or is_ml_cpp_test:
-                cmd = cpp_compiler
-        else:
-            if test_is_chpldoc and not compiler.endswith('chpldoc'):
-                # For tests with .doc.chpl suffix, use chpldoc compiler. Update
-                # the compopts accordingly. Add 'doc' prefix to existing compiler.
-                compiler += 'doc'
-                cmd = compiler
-
-                if which(cmd) is None:
-                    sys.stdout.write(
-                        '[Warning: Could not find chpldoc, skipping test '
-                        '{0}/{1}]\n'.format(localdir, test_filename))
-                    break
-
-            if valgrindcomp:
-                cmd = valgrindcomp
-                args = valgrindcompopts+[compiler]+args
-            else:
-                cmd = compiler
+        if (test_is_chpldoc and not compiler.endswith('chpldoc') and
+                not (is_c_or_cpp_test or is_ml_c_or_cpp_test)):
+            # For tests with .doc.chpl suffix, use chpldoc compiler. Update
+            # the compopts accordingly. Add 'doc' prefix to existing compiler.
+            compiler += 'doc'
+
+            if which(compiler) is None:
+                sys.stdout.write(
+                    '[Warning: Could not find chpldoc, skipping test '
+                    '{0}/{1}]\n'.format(localdir, test_filename))
+                break
 
-        if lastcompopts:
-            args += lastcompopts
+        (cmd, args) = GetCompileCommand(compopts, execname)
 
         compStart = time.time()
+        compEnd = None
         #
         # Compile (with timeout)
         #
@@ -1601,20 +1862,32 @@ for testname in testsrc:
         # remember to add the cleaner solution soon.
         #
         comptimeout = 4*timeout
-        cmd=ShellEscapeCommand(cmd);
-        sys.stdout.write('[Executing compiler %s'%(cmd))
-        if args:
-            sys.stdout.write(' %s'%(' '.join(args)))
+        # log the command line a serial run would use, whatever the variant's
+        #  executable is actually called
+        (logcmd, logargs) = (cmd, args)
+        if parallelCompiles:
+            (logcmd, logargs) = GetCompileCommand(compopts, baseExecname)
+        sys.stdout.write('[Executing compiler %s'%(ShellEscapeCommand(logcmd)))
+        if logargs:
+            sys.stdout.write(' %s'%(' '.join(logargs)))
         sys.stdout.write(' < %s]\n'%(compstdin))
         sys.stdout.flush()
+        compCategory = 'compiler'
         if useTimedExec:
-            wholecmd = cmd+' '+' '.join(map(ShellEscape, args))
-            p = py3_compat.Popen([timedexec, str(comptimeout), wholecmd],
-                                 env=dict(list(os.environ.items()) + list(testcompenv.items())),
-                                 stdin=open(compstdin, 'r'),
-                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            output = p.communicate()[0]
-            status = p.returncode
+            if parallelCompiles:
+                result = parallelCompiles.result(compoptsindex)
+                # report when this variant was being built, not the time
+                # spent waiting for it
+                (compStart, compEnd) = parallelCompiles.times[compoptsindex]
+            else:
+                result = RunCompile(cmd, args, comptimeout,
+                                    dict(list(os.environ.items()) + list(testcompenv.items())),
+                                    execname)
+            if getattr(result, 'cached', False):
+                sys.stdout.write('[Using cached build of %s]\n'%(baseExecname))
+                compCategory = 'harness'
+            output = py3_compat.bytes_to_str(result.stdout)
+            status = result.status
 
             if status == 222:
                 sys.stdout.write('%s[Error: Timed out compilation for %s/%s'%
@@ -1647,13 +1920,15 @@ for testname in testsrc:
             p.poll()
             status = p.returncode
 
-        elapsedCompTime = time.time() - compStart
+        elapsedCompTime = (compEnd or time.time()) - compStart
         test_name = os.path.join(localdir, test_filename)
         if compoptsnum != 0:
             test_name += ' (compopts: {0})'.format(compoptsnum)
 
         print('[Elapsed compilation time for "{0}" - {1:.3f} '
             'seconds]'.format(test_name, elapsedCompTime))
+        harness_trace.record('compile', compCategory, compStart,
+                             compStart + elapsedCompTime, test=test_name)
 
         output = remove_clock_skew_warning(output)
 
@@ -1699,34 +1974,32 @@ for testname in testsrc:
             with open(complog, 'w') as complogfile:
                 complogfile.write('%s'%(output))
 
+            scripts = prediff_plugins.Pipeline()
+            prediffArgs = [execname, complog, compiler,
+                           ' '.join(envCompopts)+' '+compopts, ' '.join(args)]
             if systemPrediffs:
                 for sprediff in systemPrediffs:
                     sys.stdout.write('[Executing system-wide prediff %s]\n'%(sprediff))
                     sys.stdout.flush()
-                    p = py3_compat.Popen([sprediff, execname, complog, compiler,
-                                          ' '.join(envCompopts)+' '+compopts, ' '.join(args)],
-                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    sys.stdout.write(p.communicate()[0])
+                    with harness_trace.span('prediff', script=sprediff):
+                        sys.stdout.write(scripts.run(sprediff, prediffArgs))
                     sys.stdout.flush()
 
             if globalPrediff:
                 sys.stdout.write('[Executing ./PREDIFF]\n')
                 sys.stdout.flush()
-                p = py3_compat.Popen(['./PREDIFF', execname, complog, compiler,
-                                     ' '.join(envCompopts)+' '+compopts, ' '.join(args)],
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                sys.stdout.write(p.communicate()[0])
+                with harness_trace.span('prediff', script='./PREDIFF'):
+                    sys.stdout.write(scripts.run('./PREDIFF', prediffArgs))
                 sys.stdout.flush()
 
             if prediff:
                 sys.stdout.write('[Executing prediff %s.prediff]\n'%(test_filename))
                 sys.stdout.flush()
                 test_prediff = './{0}.prediff'.format(test_filename)
-                p = py3_compat.Popen([test_prediff, execname, complog, compiler,
-                                     ' '.join(envCompopts)+' '+compopts, ' '.join(args)],
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                sys.stdout.write(p.communicate()[0])
+                with harness_trace.span('prediff', script=test_prediff):
+                    sys.stdout.write(scripts.run(test_prediff, prediffArgs))
                 sys.stdout.flush()
+            scripts.finish()
 
 
             # find the compiler .good file to compare against. The compiler
@@ -1874,10 +2147,15 @@ for testname in testsrc:
                 # computePerfStats for the current test
                 sys.stdout.write('[Executing computePerfStats %s %s %s %s %s]\n'%(datFileName, tempDatFilesDir, keyfile, printpassesfile, 'False'))
                 sys.stdout.flush()
-                p = py3_compat.Popen([utildir+'/test/computePerfStats', datFileName, tempDatFilesDir, keyfile, printpassesfile, 'False'], stdout=subprocess.PIPE)
-                compkeysOutput = p.communicate()[0]
+                # (these .dat files are only read by combineCompPerfData, so
+                # they get no columnar stores)
+                with harness_trace.span('computePerfStats'):
+                    out = io.StringIO()
+                    with perf_stats.PerfRecorder(datFileName, tempDatFilesDir, keyfile,
+                                                 columns=False) as recorder:
+                        status = recorder.record(printpassesfile, out=out)
+                    compkeysOutput = out.getvalue()
                 datFiles = [tempDatFilesDir+'/'+datFileName+'.dat',  tempDatFilesDir+'/'+datFileName+'.error']
-                status = p.returncode
 
                 if status == 0:
                     sys.stdout.write('[Success finding compiler performance keys for %s/%s]\n'% (localdir, test_filename))
@@ -1936,31 +2214,30 @@ for testname in testsrc:
                 explicitexecgoodfile = explicitcompgoodfile
             del tlist
 
+            scripts = prediff_plugins.Pipeline()
             if systemPreexecs:
                 for spreexec in systemPreexecs:
                     sys.stdout.write('[Executing system-wide preexec %s]\n'%(spreexec))
                     sys.stdout.flush()
-                    p = py3_compat.Popen([spreexec, execname, execlog, compiler],
-                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    sys.stdout.write(p.communicate()[0])
+                    with harness_trace.span('preexec', script=spreexec):
+                        sys.stdout.write(scripts.run(spreexec, [execname, execlog, compiler]))
                     sys.stdout.flush()
 
             if globalPreexec:
                 sys.stdout.write('[Executing ./PREEXEC]\n')
                 sys.stdout.flush()
-                p = py3_compat.Popen(['./PREEXEC', execname, execlog, compiler],
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                sys.stdout.write(p.communicate()[0])
+                with harness_trace.span('preexec', script='./PREEXEC'):
+                    sys.stdout.write(scripts.run('./PREEXEC', [execname, execlog, compiler]))
                 sys.stdout.flush()
 
             if preexec:
                 sys.stdout.write('[Executing preexec %s.preexec]\n'%(test_filename))
                 sys.stdout.flush()
                 test_preexec = './{0}.preexec'.format(test_filename)
-                p = py3_compat.Popen([test_preexec, execname, execlog, compiler],
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                sys.stdout.write(p.communicate()[0])
+                with harness_trace.span('preexec', script=test_preexec):
+                    sys.stdout.write(scripts.run(test_preexec, [execname, execlog, compiler]))
                 sys.stdout.flush()
+            scripts.finish()
 
             pre_exec_output = ''
             if os.path.exists(execlog):
@@ -2058,11 +2335,20 @@ for testname in testsrc:
                 exec_limiter = execution_limiter.NoLock()
                 if os.getenv("CHPL_TEST_LIMIT_RUNNING_EXECUTABLES") is not None:
                     exec_name = os.path.join(localdir, test_filename)
-                    exec_limiter = execution_limiter.FileLock()
+                    threads_per_locale = testenv.get('CHPL_RT_NUM_THREADS_PER_LOCALE',
+                                                     os.getenv('CHPL_RT_NUM_THREADS_PER_LOCALE'))
+                    exec_limiter = execution_limiter.create(numlocales if numlocexecopts else 1,
+                                                            threads_per_locale)
 
                 with exec_limiter:
+                    if getattr(exec_limiter, 'wait_time', None) is not None:
+                        print('[Waited for {0} execution slot(s) for "{1}" - '
+                              '{2:.3f} seconds]'.format(exec_limiter.weight,
+                                                        exec_name,
+                                                        exec_limiter.wait_time))
                     exectimeout = False  # 'exectimeout' is specific to one trial of one execopt setting
                     launcher_error = ''  # used to suppress output/timeout errors whose root cause is a launcher error
+                    exec_captures = None  # raw timed_exec output, if output is exactly that
                     sys.stdout.write('[Executing program %s %s'%(cmd, ' '.join(args)))
                     if redirectin:
                         sys.stdout.write(' < %s'%(redirectin))
@@ -2097,18 +2383,17 @@ for testname in testsrc:
                             sys.stdout.write(trim_output(output))
 
                     elif useTimedExec:
-                        wholecmd = cmd+' '+' '.join(map(ShellEscape, args))
-
                         if redirectin == None:
                             my_stdin = sys.stdin
                         else:
                             my_stdin = open(redirectin, 'r')
-                        p = py3_compat.Popen([timedexec, str(timeout), wholecmd],
-                                             env=dict(list(os.environ.items()) + list(testenv.items())),
-                                             stdin=my_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        (stdout, stderr) = p.communicate()
-                        output = py3_compat.concat_streams(stdout, stderr)
-                        status = p.returncode
+                        wholecmd = cmd+' '+' '.join(map(ShellEscape, args))
+                        result = timed_exec.run(timed_exec.shell_command(wholecmd), timeout,
+                                                env=dict(list(os.environ.items()) + list(testenv.items())),
+                                                stdin=my_stdin)
+                        output = py3_compat.bytes_to_str(result.output())
+                        status = result.status
+                        exec_captures = [result.stdout_capture, result.stderr_capture]
 
                         if status == 222:
                             exectimeout = True
@@ -2181,6 +2466,9 @@ for testname in testsrc:
 
                 print('[Elapsed execution time for "{0}" - {1:.3f} '
                     'seconds]'.format(test_name, elapsedExecTime))
+                harness_trace.record('execute', 'executable', execStart,
+                                     execStart + elapsedExecTime,
+                                     test=test_name)
 
 
                 if execTimeWarnLimit and elapsedExecTime > execTimeWarnLimit:
@@ -2200,47 +2488,54 @@ for testname in testsrc:
                     if sys.version_info[0] >= 3 and isinstance(cat_output, bytes):
                         output = py3_compat.str_to_bytes(output)
                     output += cat_output
+                    exec_captures = None
 
                 # Sadly the scripts used below require an actual file
                 open_mode = 'w' if isinstance(output, str) else 'wb'
-                with open(execlog, open_mode) as execlogfile:
-                    if open_mode == 'wb':
-                        pre_exec_output_content = py3_compat.str_to_bytes(pre_exec_output)
-                    else:
-                        pre_exec_output_content = pre_exec_output
-                    execlogfile.write(pre_exec_output_content)
+                if exec_captures:
+                    # Output straight from timed_exec: copy the captured
+                    # bytes into the log rather than re-encoding output
+                    with open(execlog, 'wb') as execlogfile:
+                        execlogfile.write(py3_compat.str_to_bytes(pre_exec_output))
+                        for capture in exec_captures:
+                            capture.write_to(execlogfile)
+                else:
+                    with open(execlog, open_mode) as execlogfile:
+                        if open_mode == 'wb':
+                            pre_exec_output_content = py3_compat.str_to_bytes(pre_exec_output)
+                        else:
+                            pre_exec_output_content = pre_exec_output
+                        execlogfile.write(pre_exec_output_content)
 
-                    if open_mode == 'wb':
-                        output_content = py3_compat.str_to_bytes(output)
-                    else:
-                        output_content = output
-                    execlogfile.write(output_content)
+                        if open_mode == 'wb':
+                            output_content = py3_compat.str_to_bytes(output)
+                        else:
+                            output_content = output
+                        execlogfile.write(output_content)
 
                 if not exectimeout and not launcher_error:
+                    scripts = prediff_plugins.Pipeline()
+                    prediffArgs = [execname, execlog, compiler,
+                                   ' '.join(envCompopts)+' '+compopts, ' '.join(args)]
                     if systemPrediffs:
                         for sprediff in systemPrediffs:
                             sys.stdout.write('[Executing system-wide prediff %s]\n'%(sprediff))
                             sys.stdout.flush()
-                            p = py3_compat.Popen([sprediff, execname, execlog, compiler,
-                                                  ' '.join(envCompopts)+' '+compopts, ' '.join(args)],
-                                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                            sys.stdout.write(p.communicate()[0])
+                            with harness_trace.span('prediff', script=sprediff):
+                                sys.stdout.write(scripts.run(sprediff, prediffArgs))
 
                     if globalPrediff:
                         sys.stdout.write('[Executing ./PREDIFF]\n')
                         sys.stdout.flush()
-                        p = py3_compat.Popen(['./PREDIFF', execname, execlog, compiler,
-                                             ' '.join(envCompopts)+ ' '+compopts, ' '.join(args)],
-                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                        sys.stdout.write(p.communicate()[0])
+                        with harness_trace.span('prediff', script='./PREDIFF'):
+                            sys.stdout.write(scripts.run('./PREDIFF', prediffArgs))
 
                     if prediff:
                         sys.stdout.write('[Executing prediff ./%s]\n'%(prediff))
                         sys.stdout.flush()
-                        p = py3_compat.Popen(['./'+prediff, execname, execlog, compiler,
-                                             ' '.join(envCompopts)+' '+compopts, ' '.join(args)],
-                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                        sys.stdout.write(p.communicate()[0])
+                        with harness_trace.span('prediff', script='./'+prediff):
+                            sys.stdout.write(scripts.run('./'+prediff, prediffArgs))
+                    scripts.finish()
 
                     if not perftest:
                         # find the good file 
@@ -2325,13 +2620,11 @@ for testname in testsrc:
 
                     sys.stdout.write('[Executing %s/test/computePerfStats %s %s %s %s %s %s]\n'%(utildir, perfexecname, perfdir, keyfile, execlog, str(exectimeout), perfdate))
                     sys.stdout.flush()
-                    p = py3_compat.Popen([utildir+'/test/computePerfStats',
-                                         perfexecname, perfdir, keyfile, execlog, str(exectimeout), perfdate],
-                                         stdout=subprocess.PIPE)
-                    sys.stdout.write('%s'%(p.communicate()[0]))
+                    with harness_trace.span('computePerfStats'):
+                        recorder = GetPerfRecorder(perfexecname, perfdir, keyfile)
+                        status = recorder.record(execlog, exectimeout, perfdate)
                     sys.stdout.flush()
 
-                    status = p.returncode
                     if not exectimeout and not launcher_error:
                         if status == 0:
                             os.unlink(execlog)
@@ -2350,12 +2643,24 @@ for testname in testsrc:
 
         cleanup(execname)
 
+    if parallelCompiles:
+        parallelCompiles.finish()
+        execname = baseExecname
+
     del execoptslist
     del compoptslist
 
+    ClosePerfRecorders()
+
     elapsedCurFileTestTime = time.time() - curFileTestStart
     test_name = os.path.join(localdir, test_filename)
     printEndOfTestMsg(test_name, elapsedCurFileTestTime)
 
+    if resultCacheKey:
+        testOutput = result_cache.stop_recording(resultCacheRecorder)
+        if result_cache.cacheable_output(testOutput):
+            result_cache.store(resultCacheDir, resultCacheKey, test_name,
+                               testOutput)
+
 
 sys.exit(0)
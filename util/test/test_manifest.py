@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+Directory listings of the test tree, scanned in parallel and cached across
+runs.
+
+start_test walks the test directories and paratest.server gathers the
+directories (or files) to hand out. Both used to list the tree one directory
+at a time; on a network file system the walk alone takes minutes. A Manifest
+lists directories with os.scandir from a thread pool, and remembers each
+listing with the directory's mtime. A directory's mtime changes whenever an
+entry is added, removed or renamed in it, so a later run only has to stat an
+unchanged directory instead of reading it. Listings taken within a couple of
+seconds of the directory's last change aren't trusted, since another change
+in the same mtime tick wouldn't show.
+
+Listings are checked again when they're used, so a walk sees directories as
+they are at that moment, just as os.walk would, even if tests have been run
+in them since the scan.
+
+sidecar_index() groups the files of a directory by test, for sub_test.
+
+Usage (for paratest.server, which has the same rules in Perl as a fallback):
+    test_manifest.py [--cache FILE] dirs DIR...
+        print the directories under DIRs that contain tests
+    test_manifest.py [--cache FILE] files [--recursive] [--no-futures] DIR...
+        print the test files in DIRs
+"""
+
+from __future__ import print_function
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+_cache_version = 1
+
+# Listings this close to the directory's mtime may miss a change made in
+# the same mtime tick.
+_racy_seconds = 2.0
+
+
+def default_jobs():
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+class Manifest(object):
+    """Listings of directories, by absolute path, optionally kept in the JSON
+    file `path` between runs."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.listings = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == _cache_version:
+                    self.listings = data['dirs']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+    def listing(self, directory):
+        """{'files': [...], 'dirs': [...], 'links': [...]} for `directory`.
+
+        'dirs' has every entry that is a directory, including symlinks to
+        directories, which are also in 'links'; 'files' has the rest. Raises
+        OSError if the directory can't be read.
+        """
+        directory = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        cached = self.listings.get(directory)
+        if (cached is not None and cached['mtime'] == mtime and
+                cached['scanned'] - mtime / 1e9 > _racy_seconds):
+            return cached
+
+        scanned = time.time()
+        files, dirs, links = [], [], []
+        for entry in os.scandir(directory):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(entry.name)
+                if entry.is_symlink():
+                    links.append(entry.name)
+            else:
+                files.append(entry.name)
+        files.sort()
+        dirs.sort()
+        listing = {'mtime': mtime, 'scanned': scanned, 'files': files,
+                   'dirs': dirs, 'links': links}
+        with self.lock:
+            self.listings[directory] = listing
+            self.changed = True
+        return listing
+
+    def scan(self, top, jobs=None):
+        """List `top` and everything under it (not following symlinks) in
+        parallel, so that a walk finds the listings ready."""
+        def list_dir(directory):
+            try:
+                listing = self.listing(directory)
+            except OSError:
+                return []
+            return [os.path.join(directory, d) for d in listing['dirs']
+                    if d not in listing['links']]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs or default_jobs()) as pool:
+            pending = set([pool.submit(list_dir, top)])
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for sub in future.result():
+                        pending.add(pool.submit(list_dir, sub))
+
+    def walk(self, top):
+        """Like os.walk(top): yields (dirpath, dirnames, filenames) top down,
+        and dirnames can be sorted or pruned in place. Unreadable directories
+        are skipped."""
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            try:
+                listing = self.listing(directory)
+            except OSError:
+                continue
+            dirs = list(listing['dirs'])
+            yield directory, dirs, list(listing['files'])
+            stack.extend(os.path.join(directory, d) for d in reversed(dirs)
+                         if d not in listing['links'])
+
+    def save(self):
+        """Write the listings back to the cache file, if anything changed."""
+        if not self.path or not self.changed:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.manifest-', dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': _cache_version, 'dirs': self.listings}, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+def sidecar_index(filenames):
+    """Map each prefix of a file name that ends before a '.' to the files
+    with that prefix, in the order given: index['foo'] lists foo.good,
+    foo.compopts, ..., i.e. fnmatch.filter(filenames, 'foo.*')."""
+    index = {}
+    for name in filenames:
+        dot = name.find('.')
+        while dot >= 0:
+            index.setdefault(name[:dot], []).append(name)
+            dot = name.find('.', dot + 1)
+    return index
+
+
+#
+# paratest.server's find_subdirs and find_files
+#
+
+_dir_test_exts = ('.chpl', '.test.c', '.ml-test.c')
+
+
+def _visible(names):
+    return [n for n in names if not n.startswith('.')]
+
+
+def _skipped_by_skipif(skipif_file):
+    import skipif
+    try:
+        result = skipif.evaluate(skipif_file).strip()
+    except Exception:
+        return False
+    try:
+        if float(result) > 0:
+            return True
+    except ValueError:
+        pass
+    return 'true' in result.lower()
+
+
+def test_dirs(manifest, top):
+    """The directories under `top` (itself included) that contain tests.
+    Directories whose <dir>.skipif holds or that have a <dir>.notest are
+    skipped along with everything under them; symlinks aren't followed."""
+    found = []
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        listing = manifest.listing(directory)
+        names = _visible(listing['files'] + listing['dirs'])
+        if 'NOTEST' not in names and (
+                'sub_test' in names or
+                any(n.endswith(_dir_test_exts) for n in names)):
+            found.append(directory)
+        subdirs = []
+        for name in _visible(listing['dirs']):
+            if name + '.skipif' in listing['files'] and _skipped_by_skipif(
+                    '{0}/{1}.skipif'.format(directory, name)):
+                continue
+            if name + '.notest' in names:
+                continue
+            if name not in listing['links']:
+                subdirs.append('{0}/{1}'.format(directory, name))
+        stack.extend(reversed(subdirs))
+    return found
+
+
+def test_files(manifest, top, no_futures, recursive):
+    """The test files in `top`, and under it if `recursive` (symlinks
+    included); futures are left out if `no_futures`."""
+    found = []
+    listing = manifest.listing(top)
+    notest = 'NOTEST' in listing['files']
+    for name in _visible(sorted(listing['files'] + listing['dirs'])):
+        path = '{0}/{1}'.format(top, name)
+        if not notest:
+            for ext in _dir_test_exts:
+                if name.endswith(ext):
+                    future = name[:-len(ext)] + '.future'
+                    if not (no_futures and (future in listing['files'] or
+                                            future in listing['dirs'])):
+                        found.append(path)
+                    break
+        if recursive and name in listing['dirs']:
+            found += test_files(manifest, path, no_futures, recursive)
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List test directories or files.')
+    parser.add_argument('--cache', help='listing cache (created if missing)')
+    parser.add_argument('--jobs', type=int, default=default_jobs(),
+                        help='directories to read at once')
+    subparsers = parser.add_subparsers(dest='command')
+    dirs_parser = subparsers.add_parser(
+        'dirs', help='print the directories that contain tests')
+    dirs_parser.add_argument('dirs', nargs='+')
+    files_parser = subparsers.add_parser(
+        'files', help='print the test files')
+    files_parser.add_argument('--recursive', action='store_true')
+    files_parser.add_argument('--no-futures', action='store_true')
+    files_parser.add_argument('dirs', nargs='+')
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_usage()
+        return 2
+
+    manifest = Manifest(args.cache)
+    try:
+        for top in args.dirs:
+            if args.command == 'dirs' or args.recursive:
+                manifest.scan(top, args.jobs)
+            if args.command == 'dirs':
+                found = test_dirs(manifest, top)
+            else:
+                found = test_files(manifest, top, args.no_futures,
+                                   args.recursive)
+            for path in found:
+                print(path)
+    except OSError as e:
+        sys.stderr.write('Cannot open directory {0}: {1}\n'.format(
+            e.filename, e.strerror))
+        return 1
+    manifest.save()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
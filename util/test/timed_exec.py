@@ -0,0 +1,243 @@
+"""
+In-process replacement for the timedexec perl script.
+
+sub_test used to run every compile and every execution as
+
+    timedexec <timeout> "<shell escaped command line>"
+
+which costs a perl interpreter (and often a /bin/sh) per command. run() gives
+the same semantics without the perl; shell_command() turns such a command
+line into the argument list perl's exec would have run, so /bin/sh is only
+involved when the line needs it. Then:
+
+  - the command runs in its own session/process group, and on timeout the
+    whole group gets SIGTERM, then SIGKILL if it's still around after another
+    `timeout` seconds,
+  - a timeout is reported with exit status 222 and the usual
+    "timedexec Alarm Clock" / "timedexec sending SIG..." lines (plus the
+    `ps aux` snapshot) appended to stdout,
+  - death by signal is reported as exit status 1 with the usual
+    "timedexec: target program died with signal ..." line,
+  - stdin is whatever file the caller hands in (or inherited).
+
+stdout and stderr are read as they're produced (so a chatty program can't
+block on a full pipe) into output_capture.OutputCapture objects, and the
+timeout covers the whole run, including draining output.
+"""
+
+import errno
+import os
+import output_capture
+import selectors
+import signal
+import subprocess
+import time
+
+# Exit status timedexec uses for a timed out (or interrupted) command.
+TIMEOUT_STATUS = 222
+
+_read_size = 64 * 1024
+
+# What makes perl's one-argument exec (how timedexec ran its command) hand
+# the command line to /bin/sh instead of splitting it on whitespace.
+_shell_metachars = set('$&*(){}[]\'";\\|?<>~`\n')
+
+
+class TimedExecResult(object):
+    """Outcome of run(): exit status plus the stdout/stderr OutputCaptures,
+    and how long the command took (in seconds)."""
+
+    def __init__(self, status, stdout_capture, stderr_capture, timed_out,
+                 elapsed=0.0):
+        self.status = status
+        self.stdout_capture = stdout_capture
+        self.stderr_capture = stderr_capture
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+
+    @property
+    def stdout(self):
+        return self.stdout_capture.getvalue()
+
+    @property
+    def stderr(self):
+        return self.stderr_capture.getvalue()
+
+    def output(self):
+        """stdout followed by stderr, as one bytes object."""
+        return output_capture.join([self.stdout_capture, self.stderr_capture])
+
+
+class _Capture(object):
+    """Drains a set of pipes into per-pipe OutputCaptures."""
+
+    def __init__(self, pipes):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        spill_size = output_capture.default_spill_size()
+        limit = output_capture.default_limit()
+        for pipe in pipes:
+            self.buffers[pipe] = output_capture.OutputCapture(spill_size, limit)
+            self.selector.register(pipe.fileno(), selectors.EVENT_READ, pipe)
+
+    def open(self):
+        return bool(self.selector.get_map())
+
+    def pump(self, deadline):
+        """Read until every pipe hits EOF. Returns False if `deadline` passed
+        first."""
+        while self.open():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            for key, _ in self.selector.select(remaining):
+                try:
+                    chunk = os.read(key.fd, _read_size)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    chunk = b''
+                if chunk:
+                    self.buffers[key.data].write(chunk)
+                else:
+                    self.selector.unregister(key.fd)
+        return True
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fd)
+        self.selector.close()
+        for pipe in self.buffers:
+            pipe.close()
+
+
+def _reap(p, deadline):
+    """Wait for `p` to exit, until `deadline` (None means block). Returns the
+    raw wait status, or None if the deadline passed first."""
+    delay = 0.0005
+    while True:
+        flags = 0 if deadline is None else os.WNOHANG
+        try:
+            pid, status = os.waitpid(p.pid, flags)
+        except ChildProcessError:
+            # Somebody else reaped it; all we can report is "failed".
+            p.returncode = 1
+            return 1 << 8
+        if pid == p.pid:
+            # Keep Popen from trying to reap the pid again.
+            p.returncode = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                            else os.WEXITSTATUS(status))
+            return status
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
+def _kill_group(p, sig):
+    try:
+        os.killpg(p.pid, sig)
+    except OSError:
+        pass
+
+
+def _process_snapshot():
+    # Same report timedexec gave: is anything else hogging the machine?
+    p = subprocess.Popen('ps aux | sort -r -k 3 | head', shell=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return p.communicate()[0]
+
+
+def shell_command(wholecmd):
+    """The argument list timedexec ran the command line `wholecmd` as.
+
+    Like perl's exec, a line with shell metacharacters (or starting with a
+    variable assignment) goes through /bin/sh -c; anything else is split on
+    whitespace and run directly.
+    """
+    words = wholecmd.split()
+    if (any(c in _shell_metachars for c in wholecmd) or
+            (words and '=' in words[0])):
+        return ['/bin/sh', '-c', wholecmd]
+    return words
+
+
+def run(cmd, timeout, env=None, stdin=None, merge_stderr=False,
+        kill_timeout=None):
+    """Run `cmd` (an argument list, no shell involved) with a time limit.
+
+    `stdin` is a file object or None to inherit ours. If `merge_stderr` is
+    set stderr goes to the same pipe as stdout and the result's stderr is
+    empty. `kill_timeout` is how long to wait after SIGTERM before sending
+    SIGKILL; it defaults to `timeout`, as with timedexec.
+    """
+    if kill_timeout is None:
+        kill_timeout = timeout
+
+    start = time.time()
+    try:
+        p = subprocess.Popen(cmd, env=env, stdin=stdin,
+                             stdout=subprocess.PIPE,
+                             stderr=(subprocess.STDOUT if merge_stderr
+                                     else subprocess.PIPE),
+                             start_new_session=True)
+    except OSError as e:
+        message = 'timedexec failed to execute target program: {0}\n'.format(
+            e.strerror)
+        stdout = output_capture.OutputCapture()
+        stderr = output_capture.OutputCapture()
+        # with stderr merged, callers only look at stdout
+        (stdout if merge_stderr else stderr).write(message.encode('utf-8'))
+        return TimedExecResult(1, stdout, stderr, False)
+
+    pipes = [p.stdout] if merge_stderr else [p.stdout, p.stderr]
+    capture = _Capture(pipes)
+    deadline = start + timeout
+    notes = bytearray()
+    status = None
+    try:
+        try:
+            if capture.pump(deadline):
+                status = _reap(p, deadline)
+        except KeyboardInterrupt:
+            # The child is in its own session so it didn't see the ^C; don't
+            # leave it running behind us.
+            _kill_group(p, signal.SIGKILL)
+            _reap(p, None)
+            raise
+
+        if status is None:
+            notes += _process_snapshot()
+            notes += b'timedexec Alarm Clock\n'
+            # allow proper cleanup if possible
+            notes += b'timedexec sending SIGTERM\n'
+            _kill_group(p, signal.SIGTERM)
+            kill_deadline = time.time() + kill_timeout
+            capture.pump(kill_deadline)
+            if _reap(p, kill_deadline) is None:
+                # hit it with the big hammer
+                notes += b'timedexec sending SIGKILL\n'
+                _kill_group(p, signal.SIGKILL)
+                _reap(p, None)
+    finally:
+        capture.close()
+
+    stdout = capture.buffers[p.stdout]
+    stderr = (output_capture.OutputCapture() if merge_stderr
+              else capture.buffers[p.stderr])
+    elapsed = time.time() - start
+
+    if status is None:
+        stdout.write(notes)
+        return TimedExecResult(TIMEOUT_STATUS, stdout, stderr, True, elapsed)
+
+    if os.WIFSIGNALED(status):
+        stdout.write(('timedexec: target program died with signal {0}, {1} '
+                      'coredump\n'.format(os.WTERMSIG(status),
+                                          'with' if os.WCOREDUMP(status)
+                                          else 'without')).encode('utf-8'))
+        return TimedExecResult(1, stdout, stderr, False, elapsed)
+
+    return TimedExecResult(os.WEXITSTATUS(status), stdout, stderr, False,
+                           elapsed)